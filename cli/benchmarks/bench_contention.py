@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks parallel writers of one cluster, committing version.json with compare-and-swap.
+
+Every writer applies given number of single rule updates, in two layouts
+  - modules : every writer updates a different module (ratelimiter, access, router, fallback)
+  - same : all the writers update the ratelimiter module
+and it reports the committed updates per second and the commits retried on conflict.
+
+Run it against a local S3 stand-in with conditional writes (If-Match) by setting S3_ENDPOINT,
+or hermetically on local disk with a file:// S3_BASE_BUCKET.
+usage : S3_ENDPOINT=localhost:9000 AWS_ACCESS_KEY_ID=<key> AWS_SECRET_ACCESS_KEY=<secret> \
+  S3_BASE_BUCKET=s3://bench python benchmarks/bench_contention.py --writers 1 2 4 --updates 20
+usage : S3_BASE_BUCKET=file:///tmp/bench python benchmarks/bench_contention.py --writers 1 2 4 --updates 20
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg_s3cli"))
+
+from bg_s3cli.conf import s3
+from bg_s3cli.scripts.persistence_factory import PersistenceFactory
+from bg_s3cli.scripts.s3Persistence import S3Persistence
+from bg_s3cli.scripts.utils import storage
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "template", "nginx.conf.bg.template")
+
+def ratelimiter_operation(writer, index):
+  return { "module" : "ratelimiter", "method" : "add", "rule_type" : "param", "rule_uri" : "/api/v1/core/",
+           "rule_key" : "writer%d" % writer, "rule_value" : str(index), "rule_threshold" : "3" }
+
+def access_operation(writer, index):
+  return { "module" : "access", "method" : "add", "rule_type" : "param", "rule_uri" : "/api/v1/core/",
+           "rule_key" : "writer%d" % writer, "rule_value" : str(index), "rule_access" : "deny" }
+
+def router_operation(writer, index):
+  return { "module" : "router", "method" : "add", "rule_type" : "param", "rule_uri" : "/api/v1/core/",
+           "rule_key" : "writer%d" % writer, "rule_value" : str(index), "rule_endpoint" : "localhost:8080" }
+
+def fallback_operation(writer, index):
+  return { "module" : "fallback", "method" : "add", "rule_uri" : "/api/v1/writer%d/%d/" % (writer, index),
+           "rule_errors" : ["502"], "rule_fallbacks" : ["localhost:80"], "rule_params" : {}, "rule_headers" : {} }
+
+MODULE_OPERATIONS = [ratelimiter_operation, access_operation, router_operation, fallback_operation]
+
+def run(base_path, layout, num_writers, num_updates):
+  cluster_id = "bench-contention-%s-%d" % (layout, num_writers)
+  PersistenceFactory.buildPersistence(cluster_id, 8080, 8081, base_path, ["localhost"]).deleteCluster()
+  retVal, msg = PersistenceFactory.buildPersistence(cluster_id, 8080, 8081, base_path, ["localhost"]).bootstrapCluster(TEMPLATE)
+  if retVal != 0:
+    raise Exception(msg)
+
+  retries = []
+  failures = []
+  def writer(writer_index):
+    operation = MODULE_OPERATIONS[writer_index % len(MODULE_OPERATIONS)] if layout == "modules" else ratelimiter_operation
+    persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None)
+    for index in range(num_updates):
+      retVal, msg = persistence.applyBatch([operation(writer_index, index)])
+      if retVal != 0:
+        failures.append(msg)
+    retries.append(persistence.commit_retries)
+
+  threads = [threading.Thread(target=writer, args=(writer_index,)) for writer_index in range(num_writers)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+
+  commits = num_writers * num_updates - len(failures)
+  print "%-7s writers=%d commits=%d failed=%d retries=%d time=%.2fs throughput=%.1f commits/s" % (
+    layout, num_writers, commits, len(failures), sum(retries), elapsed, commits / elapsed if elapsed else 0)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark of parallel writers of a cluster")
+  parser.add_argument("--writers", type=int, nargs="+", default=[1, 2, 4], help="number of parallel writers")
+  parser.add_argument("--updates", type=int, default=20, help="number of updates per writer")
+  args = parser.parse_args()
+
+  sys.stderr = open(os.devnull, "w") # silence per put logging
+  S3Persistence.commit_attempts = 100
+  base_path = s3.get_cluster_info_base_paths()
+  for layout in ["modules", "same"]:
+    for num_writers in args.writers:
+      run(base_path, layout, num_writers, args.updates)
+  print storage.format_stats()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks the cluster removal (s3_util.delete_dir) throughput.
+
+It populates a prefix with given number of keys, and times the delete in two modes
+  - serial : one key per delete request on a single worker, the way s3cmd del -r deletes
+  - bulk : multi-object delete of 1000 keys per request across parallel workers
+
+Run it against a local S3 stand-in (minio, moto_server, ...) by setting S3_ENDPOINT.
+usage : S3_ENDPOINT=localhost:9000 AWS_ACCESS_KEY_ID=<key> AWS_SECRET_ACCESS_KEY=<secret> \
+  python benchmarks/bench_delete_dir.py --bucket bench --keys 10000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bg_s3cli.scripts.utils import s3_util
+
+def populate(bucket, prefix, num_keys):
+  """
+  Puts num_keys small objects under the prefix
+  """
+  items = [("s3://%s/%s/%08d.rules" % (bucket, prefix, index), "[]") for index in range(num_keys)]
+  chunk = 1000
+  for start in range(0, num_keys, chunk):
+    s3_util.put_items_from_strings(items[start:start + chunk], max_workers=32)
+
+def run(bucket, num_keys, mode, max_workers, batch_size):
+  prefix = "bench/delete_dir/%s" % mode
+  populate(bucket, prefix, num_keys)
+
+  s3_util.reset_stats()
+  start = time.time()
+  deleted, failures = s3_util.delete_dir("s3://%s/%s/" % (bucket, prefix), max_workers=max_workers, batch_size=batch_size)
+  elapsed = time.time() - start
+  requests = sum(entry["requests"] for entry in s3_util.get_stats().values())
+
+  print "%-6s keys=%d deleted=%d failed=%d requests=%d time=%.2fs throughput=%.0f keys/s" % (
+    mode, num_keys, deleted, len(failures), requests, elapsed, deleted / elapsed if elapsed else 0)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark of s3_util.delete_dir")
+  parser.add_argument("--bucket", required=True, help="bucket used for the benchmark, created if missing")
+  parser.add_argument("--keys", type=int, default=10000, help="number of keys to delete")
+  parser.add_argument("--workers", type=int, default=s3_util.MAX_WORKERS, help="parallel workers of bulk delete")
+  args = parser.parse_args()
+
+  connection = s3_util.get_connection()
+  if connection.lookup(args.bucket) is None:
+    connection.create_bucket(args.bucket)
+
+  sys.stderr = open(os.devnull, "w") # silence per put logging
+  run(args.bucket, args.keys, "serial", 1, 1)
+  run(args.bucket, args.keys, "bulk", args.workers, s3_util.DELETE_BATCH_SIZE)
+
+if __name__ == "__main__":
+  main()
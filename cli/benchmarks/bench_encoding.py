@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks the encoding of rules files (codec.encode / codec.decode).
+
+It generates access rules of given sizes, serialized the way they are pushed to s3,
+and reports the bytes transferred and encode/decode time for plain, gzip and zstd.
+No s3 access is needed.
+usage : python benchmarks/bench_encoding.py --rules 10000 100000 1000000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg_s3cli"))
+
+from bg_s3cli.scripts.utils import codec
+from bg_s3cli.scripts.utils import utils
+
+def generate_rules(num_rules):
+  """
+  Access rules with the repetitive shape of production rules
+  """
+  types = ["remote_addr", "http_user_agent", "http_referer"]
+  return [{ "type" : types[index % len(types)], "key" : "" if index % len(types) == 0 else "header",
+            "value" : "10.%d.%d.%d" % ((index >> 16) & 255, (index >> 8) & 255, index & 255),
+            "api" : "/api/v1/core/%d" % (index % 50), "action" : "DENY" } for index in range(num_rules)]
+
+def run(num_rules, encodings):
+  contents = utils.serialize_rules(generate_rules(num_rules))
+  print "rules=%d plain bytes=%d" % (num_rules, len(contents))
+  for encoding in encodings:
+    start = time.time()
+    encoded = codec.encode(contents, encoding)
+    encode_time = time.time() - start
+    start = time.time()
+    decoded = codec.decode(encoded)
+    decode_time = time.time() - start
+    assert decoded == contents
+    print "  %-5s bytes=%d ratio=%.1fx encode=%.3fs decode=%.3fs" % (
+      encoding, len(encoded), float(len(contents)) / len(encoded), encode_time, decode_time)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark of rules encoding")
+  parser.add_argument("--rules", type=int, nargs="+", default=[10000, 100000, 1000000], help="number of rules")
+  args = parser.parse_args()
+
+  encodings = [codec.GZIP]
+  if codec.zstandard is not None:
+    encodings.append(codec.ZSTD)
+  for num_rules in args.rules:
+    run(num_rules, encodings)
+
+if __name__ == "__main__":
+  main()
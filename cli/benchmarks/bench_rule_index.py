@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks the load time of module rules at plugin init, with the python reference loader
+  - rules : decode of the rules file and build of the lookup tables, what a plugin does in init
+  - index : decode of the precompiled index (rule_index.load_index), the tables are ready as is
+It also reports the compile time of the index, paid once by the cli when the rules are pushed,
+and the size of both files. No s3 access is needed.
+usage : python benchmarks/bench_rule_index.py --module ratelimiter --rules 10000 100000 1000000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg_s3cli"))
+
+from bg_s3cli.scripts.utils import rule_index
+from bg_s3cli.scripts.utils import utils
+
+PHASES = { "access" : "access", "ratelimiter" : "access", "router" : "access", "fallback" : "error" }
+
+def build_rule(module, index):
+  api = "/api/v1/core/%d" % (index % 50)
+  if module == "fallback":
+    errors = ["500", "502", "503", "504"][:index % 4 + 1]
+    return { "api" : "%s/%d" % (api, index), "errors" : errors, "key" : "%s/%d_%s" % (api, index, "_".join(errors)),
+             "endpoints" : [{ "1" : { "name" : "fallback%d:80" % (index % 10), "params" : {}, "headers" : {} } }] }
+  rule = { "type" : "param" if index % 3 else "header", "api" : api, "key" : "account_id", "value" : str(index) }
+  if module == "access":
+    rule["access"] = "deny"
+  elif module == "ratelimiter":
+    rule["threshold"] = "100"
+  elif module == "router":
+    rule["endpoint"] = "localhost:%d" % (8080 + index % 4)
+  return rule
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark of plugin rule load with and without the precompiled index")
+  parser.add_argument("--module", default="ratelimiter", choices=sorted(PHASES), help="module of the rules")
+  parser.add_argument("--rules", type=int, nargs="+", default=[10000, 100000, 1000000], help="number of rules of the module")
+  args = parser.parse_args()
+
+  phase = PHASES[args.module]
+  for num_rules in args.rules:
+    rules_contents = utils.serialize_rules([build_rule(args.module, index) for index in xrange(num_rules)])
+    version = utils.get_content_version(rules_contents)
+
+    start = time.time()
+    index_contents = rule_index.build_index(phase, args.module, version, json.loads(rules_contents))
+    compiled = time.time() - start
+
+    start = time.time()
+    rules_tables = rule_index.compile_tables(args.module, json.loads(rules_contents))
+    from_rules = time.time() - start
+
+    start = time.time()
+    index_tables = rule_index.load_index(index_contents, phase, args.module, version)
+    from_index = time.time() - start
+
+    assert index_tables == json.loads(json.dumps(rules_tables))
+    print "%-11s rules=%-8d load rules=%.3fs index=%.3fs speedup=%.1fx (compile %.3fs, rules %dKB, index %dKB)" % (
+      args.module, num_rules, from_rules, from_index, from_rules / from_index if from_index else 0,
+      compiled, len(rules_contents) / 1024, len(index_contents) / 1024)
+
+if __name__ == "__main__":
+  main()
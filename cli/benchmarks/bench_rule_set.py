@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks add/remove of rules on a module of given size, the way batch updates apply them
+  - linear : rule_present scan of the rules list for every operation
+  - indexed : module_rule_utils.RuleSet, indexed once and then O(1) per operation
+Each operation is an upsert of a new rule and a remove of an existing one. The linear scan is
+timed over fewer operations (--linear_ops), it is reported per operation like the indexed one.
+No s3 access is needed.
+usage : python benchmarks/bench_rule_set.py --rules 1000 100000 1000000 --ops 10000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg_s3cli"))
+
+from bg_s3cli.scripts.s3Persistence import S3Persistence
+from bg_s3cli.scripts.utils import module_rule_utils
+
+def build_rule(index):
+  return { "type" : "param", "key" : "account_id", "value" : str(index), "api" : "/api/v1/core/%d" % (index % 50), "threshold" : "100" }
+
+def rule_present(existing_rules, rule):
+  """
+  Linear scan for rule in existing_rules, the way rules were matched before RuleSet
+  returns (True, index) if present, (False, -1) if absent
+  """
+  for index, existing_rule in enumerate(existing_rules):
+    if (existing_rule["type"] == rule["type"] and existing_rule["key"] == rule["key"]
+        and existing_rule["value"] == rule["value"] and existing_rule["api"] == rule["api"]):
+      return True, index
+  return False, -1
+
+def run_linear(rules, num_rules, num_ops):
+  start = time.time()
+  for op in xrange(num_ops):
+    new_rule = build_rule(num_rules + op)
+    present, index = rule_present(rules, new_rule)
+    if not present:
+      rules.append(new_rule)
+    present, index = rule_present(rules, build_rule(op * 7 % num_rules))
+    if present:
+      del rules[index]
+  return time.time() - start
+
+def run_indexed(rules, num_rules, num_ops):
+  start = time.time()
+  rule_set = module_rule_utils.RuleSet(rules)
+  indexed = time.time() - start
+  for op in xrange(num_ops):
+    S3Persistence.add_rule(rule_set, build_rule(num_rules + op))
+    S3Persistence.remove_rule(rule_set, build_rule(op * 7 % num_rules))
+  serialize_start = time.time()
+  rule_set.to_list()
+  return indexed, time.time() - start - indexed, time.time() - serialize_start
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark of linear vs indexed rule add/remove")
+  parser.add_argument("--rules", type=int, nargs="+", default=[1000, 100000, 1000000], help="number of rules in the module")
+  parser.add_argument("--ops", type=int, default=10000, help="add+remove operations applied with RuleSet")
+  parser.add_argument("--linear_ops", type=int, default=200, help="add+remove operations applied with linear scan")
+  args = parser.parse_args()
+
+  for num_rules in args.rules:
+    rules = [build_rule(index) for index in xrange(num_rules)]
+    linear_ops = min(args.linear_ops, args.ops)
+    linear = run_linear(list(rules), num_rules, linear_ops)
+    indexed, applied, serialized = run_indexed(rules, num_rules, args.ops)
+    print "rules=%-8d linear=%.1fus/op indexed=%.2fus/op (index build %.3fs, to_list %.3fs) speedup=%.0fx" % (
+      num_rules, linear / linear_ops * 1e6, applied / args.ops * 1e6, indexed, serialized,
+      (linear / linear_ops) / (applied / args.ops) if applied else 0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks memory and throughput of a ratelimiter module held as rule_table.RuleTable against
+the baseline list of rule dicts.
+
+Every layout runs in its own process, so its peak RSS is not affected by the other
+  - dicts : list of rule dicts, filtered, deduped and sorted with plain python
+  - table : RuleTable columns (numpy when installed, array module otherwise)
+For each it reports the time to load the rules file, to filter on api and threshold, to dedup,
+to sort and to serialize back, along with the peak RSS. No s3 access is needed.
+usage : python benchmarks/bench_rule_table.py --rules 100000 1000000
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg_s3cli"))
+
+from bg_s3cli.scripts.utils import module_rule_utils
+from bg_s3cli.scripts.utils import rule_table
+from bg_s3cli.scripts.utils import stream
+from bg_s3cli.scripts.utils import utils
+
+LAYOUTS = ["dicts", "table"]
+FILTER_API = "/api/v1/core/7"
+FILTER_THRESHOLD = 100
+
+def generate_rules(num_rules):
+  """
+  Generates ratelimiter rules with the shape of production rules, a few of them repeated
+  """
+  for index in xrange(num_rules):
+    account = index if index % 20 else index / 2
+    yield { "type" : "param", "key" : "account_id", "value" : str(account), "api" : "/api/v1/core/%d" % (account % 50),
+            "threshold" : str(10 + account % 500) }
+
+def run_dicts(contents):
+  timings = []
+  start = time.time()
+  rules = list(stream.iter_array(stream.iter_decoded([contents])))
+  timings.append(("load", time.time() - start))
+
+  start = time.time()
+  matched = [rule for rule in rules if rule.get("api") == FILTER_API and int(rule.get("threshold", -1)) > FILTER_THRESHOLD]
+  timings.append(("filter", time.time() - start))
+
+  start = time.time()
+  deduped = OrderedDict()
+  for rule in rules:
+    identity = module_rule_utils.rule_identity(module_rule_utils.ratelimiter_module, rule)
+    deduped.pop(identity, None)
+    deduped[identity] = rule
+  timings.append(("dedup", time.time() - start))
+
+  start = time.time()
+  sorted(rules, key=lambda rule: (rule["api"], rule["type"], rule["key"], rule["value"]))
+  timings.append(("sort", time.time() - start))
+
+  start = time.time()
+  utils.serialize_rules(rules)
+  timings.append(("dump", time.time() - start))
+  return len(rules), len(matched), len(deduped), timings
+
+def run_table(contents):
+  timings = []
+  start = time.time()
+  table = rule_table.RuleTable.from_json(contents)
+  timings.append(("load", time.time() - start))
+
+  start = time.time()
+  matched = table.filter({ "api" : FILTER_API }, threshold_above=FILTER_THRESHOLD)
+  timings.append(("filter", time.time() - start))
+
+  start = time.time()
+  deduped = table.dedup()
+  timings.append(("dedup", time.time() - start))
+
+  start = time.time()
+  table.sort()
+  timings.append(("sort", time.time() - start))
+
+  start = time.time()
+  table.to_json()
+  timings.append(("dump", time.time() - start))
+  return len(table), len(matched), len(deduped), timings
+
+def run_layout(layout, filename):
+  with open(filename, "rb") as infile:
+    contents = infile.read()
+  # baseline of the process, before any rule is loaded
+  base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  num_rules, matched, deduped, timings = (run_dicts if layout == "dicts" else run_table)(contents)
+  # ru_maxrss is in KB on linux
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if layout == "table":
+    layout = "table(%s)" % ("numpy" if rule_table.numpy is not None else "array")
+  print "%-12s rules=%d matched=%d deduped=%d %s peak_rss=%.1fMB (+%.1fMB)" % (
+    layout, num_rules, matched, deduped, " ".join("%s=%.2fs" % timing for timing in timings), peak_rss / 1024.0, (peak_rss - base_rss) / 1024.0)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark of columnar rule table against list of rule dicts")
+  parser.add_argument("--rules", type=int, nargs="+", default=[100000, 1000000], help="number of rules")
+  parser.add_argument("--layout", choices=LAYOUTS, help=argparse.SUPPRESS)
+  parser.add_argument("--file", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.layout:
+    run_layout(args.layout, args.file)
+    return
+
+  for num_rules in args.rules:
+    fd, filename = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as outfile:
+      for chunk in stream.iter_encoded_array(generate_rules(num_rules)):
+        outfile.write(chunk)
+    try:
+      for layout in LAYOUTS:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), "--layout", layout, "--file", filename])
+    finally:
+      os.remove(filename)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks peak memory and time of whole-string vs streaming (de)serialization of rules files.
+
+Every mode runs in its own process, so its peak RSS is not affected by the others
+  - loads : json.loads of the whole file read as a string
+  - stream : stream.iter_array over chunks of the file, rules are counted not retained
+  - dumps : json.dumps of the rules into a string
+  - spool : stream.spool_array of the rules into a spool
+No s3 access is needed.
+usage : python benchmarks/bench_stream.py --rules 100000 1000000 [--encoding gzip]
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg_s3cli"))
+
+from bg_s3cli.scripts.utils import stream
+from bg_s3cli.scripts.utils import utils
+
+MODES = ["loads", "stream", "dumps", "spool"]
+
+def generate_rules(num_rules):
+  """
+  Generates access rules with the shape of production rules
+  """
+  for index in xrange(num_rules):
+    yield { "type" : "remote_addr", "key" : "", "value" : "10.%d.%d.%d" % ((index >> 16) & 255, (index >> 8) & 255, index & 255),
+            "api" : "/api/v1/core/%d" % (index % 50), "action" : "DENY" }
+
+def iter_file_chunks(filename):
+  with open(filename, "rb") as infile:
+    while True:
+      chunk = infile.read(stream.CHUNK_SIZE)
+      if not chunk:
+        return
+      yield chunk
+
+def run_mode(mode, filename, num_rules, encoding):
+  start = time.time()
+  if mode == "loads":
+    with open(filename, "rb") as infile:
+      count = len(utils.json.loads(utils.codec.decode(infile.read())))
+  elif mode == "stream":
+    count = sum(1 for _ in stream.iter_array(stream.iter_decoded(iter_file_chunks(filename))))
+  elif mode == "dumps":
+    contents = utils.serialize_rules(list(generate_rules(num_rules)))
+    count = len(contents)
+  else:
+    spool = stream.spool_array(generate_rules(num_rules), encoding)
+    count = spool.size
+    spool.fp.close()
+  elapsed = time.time() - start
+  # ru_maxrss is in KB on linux
+  print "%-6s rules=%d result=%d time=%.2fs peak_rss=%.1fMB" % (
+    mode, num_rules, count, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark of streaming rules (de)serialization")
+  parser.add_argument("--rules", type=int, nargs="+", default=[100000, 1000000], help="number of rules")
+  parser.add_argument("--encoding", default=None, help="gzip/zstd encoding of the rules file")
+  parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+  parser.add_argument("--file", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.mode:
+    run_mode(args.mode, args.file, args.rules[0], args.encoding)
+    return
+
+  for num_rules in args.rules:
+    spool = stream.spool_array(generate_rules(num_rules), args.encoding)
+    fd, filename = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as outfile:
+      outfile.write(spool.read())
+    try:
+      for mode in MODES:
+        command = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--file", filename, "--rules", str(num_rules)]
+        if args.encoding:
+          command += ["--encoding", args.encoding]
+        subprocess.check_call(command)
+    finally:
+      os.remove(filename)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks validation of a bulk load of rules against the module schema
+  - uncached : jsonschema.validate per rule, which checks the schema and builds a validator every time
+  - compiled : the cached validator of validation.get_validator, without the pre-check
+  - validate_many : pre-check of the common rule shapes, schema only for the rest, in process
+  - pool : validate_many spread across --processes processes
+A share of the rules (--invalid) is invalid, so the schema path is exercised as well.
+The uncached run is timed over fewer rules (--uncached_rules), it is reported per rule like the others.
+No s3 access is needed.
+usage : python benchmarks/bench_validate.py --module ratelimiter --rules 10000 100000 --processes 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import jsonschema
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg_s3cli"))
+
+from bg_s3cli.scripts.utils import validation
+
+def build_rule(module, index, invalid):
+  rule = { "type" : "param", "api" : "/api/v1/core/%d" % (index % 50), "key" : "account_id", "value" : str(index) }
+  if index % 10 == 0:
+    rule.update({ "type" : "header", "key" : "remote_addr", "value" : "10.0.%d.%d" % (index / 256 % 256, index % 256) })
+  if module == "access":
+    rule["access"] = "deny" if not invalid else "block"
+  elif module == "ratelimiter":
+    rule["threshold"] = "100" if not invalid else "100a"
+  elif module == "router":
+    rule["endpoint"] = "localhost:8080" if not invalid else "localhost"
+  return rule
+
+def build_rules(module, num_rules, invalid_share):
+  every = int(1 / invalid_share) if invalid_share else 0
+  return [build_rule(module, index, every and index % every == every - 1) for index in xrange(num_rules)]
+
+def timed(validate, rules):
+  start = time.time()
+  errors = validate(rules)
+  return time.time() - start, errors
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark of bulk rule validation")
+  parser.add_argument("--module", default="ratelimiter", choices=["access", "ratelimiter", "router"], help="module of the rules")
+  parser.add_argument("--rules", type=int, nargs="+", default=[10000, 100000], help="number of rules validated")
+  parser.add_argument("--invalid", type=float, default=0.01, help="share of invalid rules")
+  parser.add_argument("--uncached_rules", type=int, default=2000, help="number of rules validated with jsonschema.validate")
+  parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="processes of the pool")
+  args = parser.parse_args()
+
+  schema = validation.SCHEMAS[args.module].schema
+  def uncached(rules):
+    errors = []
+    for index, rule in enumerate(rules):
+      try:
+        jsonschema.validate(rule, schema)
+      except jsonschema.exceptions.ValidationError:
+        errors.append(index)
+    return errors
+  def compiled(rules):
+    return [index for index, rule in enumerate(rules) if validation.validate(rule, schema)[0] != 0]
+
+  for num_rules in args.rules:
+    rules = build_rules(args.module, num_rules, args.invalid)
+    uncached_rules = rules[:min(args.uncached_rules, num_rules)]
+    results = [
+      ("uncached", len(uncached_rules)) + timed(uncached, uncached_rules),
+      ("compiled", num_rules) + timed(compiled, rules),
+      ("validate_many", num_rules) + timed(lambda rules: validation.validate_many(args.module, rules, processes=1), rules),
+      ("pool", num_rules) + timed(lambda rules: validation.validate_many(args.module, rules, processes=args.processes, min_parallel=0), rules),
+    ]
+    baseline = results[0][2] / results[0][1]
+    for mode, validated, elapsed, errors in results:
+      print "%-13s rules=%-8d invalid=%-6d time=%.2fs %.1fus/rule speedup=%.0fx" % (
+        mode, validated, len(errors), elapsed, elapsed / validated * 1e6, baseline / (elapsed / validated) if elapsed else 0)
+
+if __name__ == "__main__":
+  main()
@@ -18,19 +18,81 @@
 
 import os
 
-def get_base_path():
+def get_base_paths():
   """
-  s3 base bucket where the module level and nginx conf are stored
+  s3 base buckets (s3://bucket) where the module level and nginx conf are stored, one per region,
+  or a local directory (file:///path) for staging and testing without s3.
+  S3_BASE_BUCKET is a comma separated list, the first one is the primary which serves the reads.
   """
   s3_base_bucket = os.getenv('S3_BASE_BUCKET', None)
   if not s3_base_bucket:
     raise Exception("Environment S3_BASE_BUCKET is not set. To use this utiliy, pl. provide it.")
-  return s3_base_bucket
+  return [base_path.strip() for base_path in s3_base_bucket.split(",") if base_path.strip()]
+
+def get_base_path():
+  """
+  primary s3 base bucket, see get_base_paths
+  """
+  return get_base_paths()[0]
+
+def get_cluster_info_base_paths():
+  """
+  cluster info base path of every region, the primary first
+  """
+  return ["%s/bloomgateway/cluster"%(base_path) for base_path in get_base_paths()]
 
 def get_cluster_info_base_path():
   """
   All the configs specific to cluster are stored under,
   s3 base bucket + /bloomgateway/cluster
   """
-  return "%s/bloomgateway/cluster"%(get_base_path())
+  return get_cluster_info_base_paths()[0]
 
+def get_endpoint():
+  """
+  Optional s3 compatible endpoint (host:port) to be used instead of AWS S3,
+  e.g. a local S3 stand-in for testing and benchmarks. None for AWS S3.
+  """
+  return os.getenv('S3_ENDPOINT', None)
+
+def get_cache_dir():
+  """
+  Optional local directory for caching s3 objects across the runs of cli. None disables the cache.
+  """
+  return os.getenv('BG_S3CLI_CACHE_DIR', None)
+
+def get_cache_max_bytes():
+  """
+  Size bound of the local cache, 256MB by default
+  """
+  return int(os.getenv('BG_S3CLI_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+def get_encoding():
+  """
+  Optional encoding (gzip/zstd) of rules and nginx.conf artifacts pushed to s3. None keeps them plain.
+  """
+  return os.getenv('BG_S3CLI_ENCODING', None)
+
+def get_read_deadline():
+  """
+  Time budget in seconds of a single s3 read including its retries, 30 by default
+  """
+  return float(os.getenv('BG_S3CLI_READ_DEADLINE', 30))
+
+def get_read_attempts():
+  """
+  Maximum attempts of a s3 read failing with transient errors (5xx, throttling, connection errors), 5 by default
+  """
+  return int(os.getenv('BG_S3CLI_READ_ATTEMPTS', 5))
+
+def get_hedge_reads():
+  """
+  Whether a duplicate GET is sent once a read is slower than the p95 latency of the reads so far, off by default
+  """
+  return os.getenv('BG_S3CLI_HEDGE_READS', '').lower() in ('1', 'true', 'yes')
+
+def get_mirror_db():
+  """
+  Local SQLite database mirroring the rules of all the clusters for the sync and query commands, ~/.bg_s3cli/mirror.db by default
+  """
+  return os.getenv('BG_S3CLI_MIRROR_DB', os.path.expanduser(os.path.join('~', '.bg_s3cli', 'mirror.db')))
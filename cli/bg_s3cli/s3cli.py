@@ -86,16 +86,134 @@ usage : python s3cli.py --cmd update --cluster_id test.fe --type conf --data '{
 4. Delete Cluster : Delete the complete cluster.
 usage : python s3cli.py --cmd delete --cluster_id test.fe
 
+5. Batch Update : Applies many add/remove rule operations across modules in one transaction.
+The file is either a JSON array or JSON lines, each operation is the --data of a module update
+along with "module" name. All the operations are validated upfront and applied together,
+each touched module gets one new version with a single write of version.json.
+usage : python s3cli.py --cmd batch --cluster_id test.fe --file operations.jsonl
+operations.jsonl :
+{"module" : "access", "method" : "add", "rule_type" : "param", "rule_uri" : "/api/v1/core/", "rule_key" : "account_id", "rule_value" : "1234", "rule_access" : "deny"}
+{"module" : "ratelimiter", "method" : "remove", "rule_type" : "param", "rule_uri" : "/api/v1/core/", "rule_key" : "account_id", "rule_value" : "1234", "rule_threshold" : "3"}
+
+6. Apply Desired State : Reconciles the rules of the cluster with the complete desired rules
+per module. The file is a JSON object of module name to list of rules, in the same format as
+the rules are stored. Modules missing from the file are left untouched. It prints the plan of
+adds, removes and updates, and pushes only the modules whose content changed, in one transaction.
+Use --dry_run to only print the plan.
+usage : python s3cli.py --cmd apply --cluster_id test.fe --file desired.json
+desired.json :
+{
+  "access" : [{"type" : "param", "api" : "/api/v1/core/", "key" : "account_id", "value" : "1234", "access" : "deny"}],
+  "ratelimiter" : [{"type" : "api", "api" : "/api/v1/core/", "threshold" : "100"}],
+  "router" : [],
+  "fallback" : []
+}
+
+7. Journal Mode : For modules with frequent changes, module updates (update/batch/apply) accept
+--journal_threshold N. A change is then written as a small delta segment on top of the snapshot of
+the module instead of rewriting all of its rules, and the segments are folded into a new snapshot
+once a module has N segments. Pull-mode nodes fetch the new segments of a module and replay them on
+the rules they have, so a journaled change is applied by the nodes right away, and the bundle of the
+version is not pushed again. The compact command folds the journal of all the modules right away.
+usage : python s3cli.py --cmd update --cluster_id test.fe --type module --module ratelimiter --journal_threshold 20 --data '{...}'
+usage : python s3cli.py --cmd compact --cluster_id test.fe
+
+8. Garbage Collection : Every update leaves the previous versions of rules, nginx.conf and cluster.json
+behind. gc deletes the versions which are not referenced by version.json, except the newest --keep
+versions (10 by default) of each and the versions younger than --max_age. Versions younger than an hour
+are always retained, whatever --max_age is, as an update pushes the rules of its version before committing it.
+Use --dry_run to only print what would be reclaimed.
+usage : python s3cli.py --cmd gc --cluster_id test.fe --keep 5 --max_age 7d
+
+9. Clone Cluster : Creates a new cluster as a copy of the current version of an existing one.
+The rules and nginx.conf are copied with server side s3 copies, no rules pass through the cli.
+The optional --data overrides service_port, ping_port, nodes and upstream_server of the new cluster;
+overriding ports or upstream server needs upstream_server and nginx_conf_template, as nginx.conf is rendered again.
+usage : python s3cli.py --cmd clone --from test.fe --to test2.fe --data '{
+  "nodes" : ["service3.net"],
+  "service_port" : <port number>,
+  "upstream_server" : "<upstream host:port>",
+  "nginx_conf_template"  : "../template/nginx.conf.bg.template"
+}'
+
+10. Regions : S3_BASE_BUCKET can be a comma separated list of base buckets, one per region, the first one
+is the primary. Every artifact is published to all the regions concurrently, version.json is committed to
+the primary with compare-and-swap and then to every other region, once the artifacts have landed there.
+Reads are served by the primary. After every commit a verification pass checks that all the regions agree
+on version.json, the verify command runs it on its own.
+usage : S3_BASE_BUCKET=s3://bg-us-east,s3://bg-eu-west python s3cli.py --cmd verify --cluster_id test.fe
+
+11. Registry : <base>/bloomgateway/registry.json indexes all the clusters with their current versions, ports,
+nodes and number of rules per module. Every create, update and delete records the cluster in it with a
+compare-and-swap, so list and describe answer with a single GET instead of walking the clusters.
+The rebuild command regenerates the registry from the clusters, e.g. for clusters created before it.
+usage : python s3cli.py --cmd list
+usage : python s3cli.py --cmd describe --cluster_id test.fe
+usage : python s3cli.py --cmd rebuild
+
+12. Rule Mirror : sync mirrors the current rules of all the clusters into a local indexed SQLite database
+(BG_S3CLI_MIRROR_DB, ~/.bg_s3cli/mirror.db by default). It is incremental, only the modules whose version
+changed since the last sync are fetched. query filters the mirrored rules across clusters on --cluster_id,
+--module, --api, --key, --value (exact, or a glob pattern with * and ?) and --threshold_above/--threshold_below.
+usage : python s3cli.py --cmd sync
+usage : python s3cli.py --cmd query --module access --key account_id --value 1234
+usage : python s3cli.py --cmd query --module ratelimiter --api /api/v1/core/ --threshold_above 100
+
+13. Optimize : Removes the rules which make no difference to the nodes, and pushes the remaining rules as a
+new version of the modules which had any. A rule is removed when a later rule of same identity overrides it,
+when it is a ratelimiter header rule with the same threshold as the * rule of its key, or when it is a fallback
+rule whose errors are all taken by later rules. Ratelimiter param rules covered by the * rule are removed only
+with --collapse_params, as the * rule does not apply to a param repeated in the query string. --module limits
+it to one module, use --dry_run to only print the rules it would remove.
+usage : python s3cli.py --cmd optimize --cluster_id test.fe --dry_run
+usage : python s3cli.py --cmd optimize --cluster_id test.fe --module ratelimiter --collapse_params
+
+Any of the above commands accepts --stats, which prints the number of s3 requests
+and bytes transferred per s3 command (GET, PUT, HEAD, DELETE) at the end of execution,
+along with hits and misses of the local cache.
+usage : python s3cli.py --cmd delete --cluster_id test.fe --stats
+
+Bootstrap Bundle : Every commit packs nginx.conf, the rules of all the modules and version.json in one
+  tar.gz (<base>/<cluster>/bundle/<id>.tar.gz), referenced as "bundle" in version.json, and copies it
+  to bundle/latest.tar.gz. A new node warms up from the latest bundle with a single GET, and a node
+  fetches the bundle of the version instead of the files when more than one of them has changed.
+
+Local Storage : S3_BASE_BUCKET can be a local directory (file:///path) instead of a s3 bucket, for staging
+and testing without s3. The same <base>/bloomgateway/cluster/<cluster>/... tree is laid out on local disk,
+every file is written with write-then-rename, and version.json is committed with compare-and-swap under a lock file.
+usage : S3_BASE_BUCKET=file:///tmp/bg python s3cli.py --cmd create --cluster_id test.fe --data '{...}'
+
+Local Cache : Set BG_S3CLI_CACHE_DIR to cache s3 objects on local disk across runs (bounded by
+BG_S3CLI_CACHE_MAX_BYTES, 256MB by default). The versioned rules and cluster.json files are immutable
+and never re-downloaded, version.json and cluster_version.json are revalidated with a conditional GET.
+
+Concurrent Updates : There is no cluster lock. Every update commits version.json with a conditional
+write on its ETag, and if another update committed first, the changes are re-applied on top of it and
+retried, so updates of different modules of a cluster run in parallel. The S3 endpoint must support
+conditional writes (If-Match / If-None-Match).
+
+Read Retries : Every s3 read has a deadline (BG_S3CLI_READ_DEADLINE, 30 seconds by default) and transient
+failures (5xx, throttling, broken connections) are retried up to BG_S3CLI_READ_ATTEMPTS times (5 by default)
+with jittered exponential backoff. Set BG_S3CLI_HEDGE_READS=1 to send a duplicate GET once a read is slower
+than the p95 latency of the reads so far. --stats reports the retries and hedges.
+
+Encoding : Set BG_S3CLI_ENCODING to gzip (or zstd, needs zstandard python package) to push the
+rules and nginx.conf encoded. The encoding is recorded in object metadata, and both the cli and
+pull-mode nodes decode them transparently.
+
 """
 
 import argparse
 import json
 import sys
+import time
 
 from conf import s3
-from scripts.s3Persistence import S3Persistence
+from scripts.persistence_factory import PersistenceFactory
 from scripts.utils import utils
 from scripts.utils import module_rule_utils
+from scripts.utils import storage
+from scripts.utils.mirror import RuleMirror
 
 def bootstrap_cluster(cluster_id, data):
   """
@@ -112,9 +230,10 @@ def bootstrap_cluster(cluster_id, data):
   if not data["nginx_conf_template"]:
     data["nginx_conf_template"] = "../template/nginx.conf.bg.template"
 
-  base_path = s3.get_cluster_info_base_path()
-  persistence = S3Persistence(cluster_id, data["service_port"], data["ping_port"], base_path, data["nodes"], data["upstream_server"])
-  persistence.bootstrapCluster(data["nginx_conf_template"])
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, data["service_port"], data["ping_port"], base_path, data["nodes"], data["upstream_server"])
+  (response, msg) = persistence.bootstrapCluster(data["nginx_conf_template"])
+  print msg
 
 def delete_cluster(cluster_id):
   """
@@ -122,8 +241,8 @@ def delete_cluster(cluster_id):
   """
   print "executing delete_cluster"
   assert cluster_id
-  base_path = s3.get_cluster_info_base_path()
-  persistence = S3Persistence(cluster_id, None, None, base_path, None, None)
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None, None)
   (response, msg) = persistence.deleteCluster()
   print msg
 
@@ -145,12 +264,12 @@ def update_nginx_conf(cluster_id, data):
   if not data["nginx_conf_template"]:
     data["nginx_conf_template"] = "../template/nginx.conf.bg.template"
 
-  base_path = s3.get_cluster_info_base_path()
-  persistence = S3Persistence(cluster_id, data["service_port"], data["ping_port"], base_path, None, data["upstream_server"])
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, data["service_port"], data["ping_port"], base_path, None, data["upstream_server"])
   (response, msg) = persistence.updateNginxConfig(data["nginx_conf_template"])
   print msg
 
-def update_access_rules(cluster_id, data):
+def update_access_rules(cluster_id, data, journal_threshold=None):
   """
   Updates the Access Module Configs/Rule for a given cluster_id
   """
@@ -163,8 +282,8 @@ def update_access_rules(cluster_id, data):
   assert data["rule_value"]
   assert data["rule_access"] and (data["rule_access"] == "deny")
 
-  base_path = s3.get_cluster_info_base_path()
-  persistence = S3Persistence(cluster_id, None, None, base_path, None)
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None, journal_threshold=journal_threshold)
   (response, msg) = (None, None)
   if data["method"] == "add":
     (response, msg) = persistence.updateModuleRule(utils.ACCESS_PHASE, utils.ACCESS_MODULE, data["method"], data)
@@ -176,7 +295,7 @@ def update_access_rules(cluster_id, data):
 
   print msg
 
-def update_ratelimiter_rules(cluster_id, data):
+def update_ratelimiter_rules(cluster_id, data, journal_threshold=None):
   """
   Updates the RateLimiter Module Configs/Rule for a given cluster_id
   """
@@ -189,8 +308,8 @@ def update_ratelimiter_rules(cluster_id, data):
   assert data["rule_value"]
   assert data["rule_threshold"]
 
-  base_path = s3.get_cluster_info_base_path()
-  persistence = S3Persistence(cluster_id, None, None, base_path, None)
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None, journal_threshold=journal_threshold)
   (response, msg) = (None, None)
   if data["method"] == "add":
     (response, msg) = persistence.updateModuleRule(utils.ACCESS_PHASE, utils.RATELIMITER_MODULE, data["method"], data)
@@ -202,7 +321,7 @@ def update_ratelimiter_rules(cluster_id, data):
 
   print msg
 
-def update_router_rules(cluster_id, data):
+def update_router_rules(cluster_id, data, journal_threshold=None):
   """
   Updates the Router Module Configs/Rule for a given cluster_id
   """
@@ -215,8 +334,8 @@ def update_router_rules(cluster_id, data):
   assert data["rule_value"]
   assert data["rule_endpoint"]
 
-  base_path = s3.get_cluster_info_base_path()
-  persistence = S3Persistence(cluster_id, None, None, base_path, None)
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None, journal_threshold=journal_threshold)
   (response, msg) = (None, None)
   if data["method"] == 'add':
     response, msg = persistence.updateModuleRule(module_rule_utils.access_phase, module_rule_utils.router_module, data["method"], data)
@@ -228,7 +347,7 @@ def update_router_rules(cluster_id, data):
 
   print msg
 
-def update_fallback_rules(cluster_id, data):
+def update_fallback_rules(cluster_id, data, journal_threshold=None):
   """
   Updates the Fallback Module Configs/Rule for a given cluster_id
   """
@@ -245,8 +364,8 @@ def update_fallback_rules(cluster_id, data):
   if not data.get("rule_headers", None):
     data["rule_headers"] = {}
 
-  base_path = s3.get_cluster_info_base_path()
-  persistence = S3Persistence(cluster_id=cluster_id, service_port=None, ping_port=None, s3_base_path=base_path, nodes=None)
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id=cluster_id, service_port=None, ping_port=None, base_path=base_path, nodes=None, journal_threshold=journal_threshold)
 
   (response, msg) = (None, None)
   if data["method"] == 'add':
@@ -259,21 +378,222 @@ def update_fallback_rules(cluster_id, data):
 
   print msg
 
+def load_json_records(filename):
+  """
+  Reads a JSON array (or a single JSON object) or JSON lines file as a list of objects
+  """
+  with open(filename, "r") as infile:
+    contents = infile.read()
+
+  try:
+    records = json.loads(contents)
+  except ValueError:
+    records = [json.loads(line) for line in contents.splitlines() if line.strip()]
+
+  if isinstance(records, dict):
+    records = [records]
+  return records
+
+def apply_batch(cluster_id, filename, journal_threshold=None):
+  """
+  Applies all the rule operations of a given file to cluster_id in one transaction
+  """
+  print "executing apply_batch"
+  assert cluster_id
+  assert filename
+
+  operations = load_json_records(filename)
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None, journal_threshold=journal_threshold)
+  (response, msg) = persistence.applyBatch(operations)
+  print msg
+
+def apply_desired_state(cluster_id, filename, dry_run, journal_threshold=None):
+  """
+  Reconciles the rules of cluster_id with the desired state given in file
+  """
+  print "executing apply_desired_state"
+  assert cluster_id
+  assert filename
+
+  with open(filename, "r") as infile:
+    desired_state = json.load(infile)
+
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None, journal_threshold=journal_threshold)
+  (response, msg) = persistence.applyDesiredState(desired_state, dry_run)
+  print msg
+
+def compact_journal(cluster_id):
+  """
+  Folds the journal of every journaled module of cluster_id into new snapshot
+  """
+  print "executing compact_journal"
+  assert cluster_id
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None)
+  (response, msg) = persistence.compactJournal()
+  print msg
+
+def collect_garbage(cluster_id, keep, max_age, dry_run):
+  """
+  Deletes the old versions of rules, nginx.conf and cluster.json of cluster_id not retained by the policy
+  """
+  print "executing collect_garbage"
+  assert cluster_id
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None)
+  (response, msg) = persistence.collectGarbage(keep, utils.parse_duration(max_age) if max_age else None, dry_run)
+  print msg
+
+def optimize_rules(cluster_id, modules, collapse_params, dry_run):
+  """
+  Removes the redundant rules of the modules of cluster_id, all the modules when modules is None
+  """
+  print "executing optimize_rules"
+  assert cluster_id
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None)
+  (response, msg) = persistence.optimizeRules(modules, collapse_params, dry_run)
+  print msg
+
+def clone_cluster(from_cluster_id, to_cluster_id, data):
+  """
+  Creates cluster to_cluster_id as a copy of from_cluster_id, data optionally overrides
+  service_port, ping_port, nodes and upstream_server of the new cluster
+  """
+  print "executing clone_cluster"
+  assert from_cluster_id
+  assert to_cluster_id
+  data = data or {}
+
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(to_cluster_id, data.get("service_port"), data.get("ping_port"), base_path, data.get("nodes"), data.get("upstream_server"))
+  (response, msg) = persistence.cloneCluster(from_cluster_id, data.get("nginx_conf_template"))
+  print msg
+
+def verify_regions(cluster_id):
+  """
+  Verifies all the regions agree on version.json of cluster_id
+  """
+  print "executing verify_regions"
+  assert cluster_id
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None)
+  (response, msg) = persistence.verifyRegions()
+  print msg
+
+def list_clusters():
+  """
+  Lists all the clusters from the registry
+  """
+  print "executing list_clusters"
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(None, None, None, base_path, None)
+  (response, msg) = persistence.listClusters()
+  print msg
+
+def describe_cluster(cluster_id):
+  """
+  Describes the versions, ports, nodes and rule counts of cluster_id from the registry
+  """
+  print "executing describe_cluster"
+  assert cluster_id
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(cluster_id, None, None, base_path, None)
+  (response, msg) = persistence.describeCluster()
+  print msg
+
+def rebuild_registry():
+  """
+  Regenerates the registry from all the clusters
+  """
+  print "executing rebuild_registry"
+  base_path = s3.get_cluster_info_base_paths()
+  persistence = PersistenceFactory.buildPersistence(None, None, None, base_path, None)
+  (response, msg) = persistence.rebuildRegistry()
+  print msg
+
+def sync_mirror():
+  """
+  Mirrors the current rules of all the clusters into the local SQLite database
+  """
+  print "executing sync_mirror"
+  mirror = RuleMirror(s3.get_mirror_db())
+  start = time.time()
+  stats = mirror.sync()
+  mirror.close()
+  print "synced %d cluster(s) in %.2fs : %d module(s) fetched, %d unchanged, %d removed, %d rule(s) mirrored" % (
+    stats["clusters"], time.time() - start, stats["fetched"], stats["unchanged"], stats["removed"], stats["rules"])
+
+def query_mirror(filters, threshold_above, threshold_below):
+  """
+  Prints the mirrored rules of all the clusters matching the filters
+  """
+  print "executing query_mirror"
+  mirror = RuleMirror(s3.get_mirror_db())
+  start = time.time()
+  results = mirror.query(filters, threshold_above, threshold_below)
+  elapsed = time.time() - start
+  mirror.close()
+  for cluster_id, module, rule in results:
+    print "%s %s %s" % (cluster_id, module, json.dumps(rule, sort_keys=True))
+  print "%d rule(s) in %.1fms" % (len(results), elapsed * 1000)
+
 def main():
   parser = argparse.ArgumentParser(description = "Utility for updating bloomgateway rules to s3, it uses boto")
-  parser.add_argument("--cmd", required=True, choices=['create', 'update', 'delete'], help="choose the action to be performed")
-  parser.add_argument("--cluster_id", required=True, help="Name of the cluster")
+  parser.add_argument("--cmd", required=True, choices=['create', 'update', 'delete', 'batch', 'apply', 'compact', 'gc', 'clone', 'verify', 'list', 'describe', 'rebuild', 'sync', 'query', 'optimize'], help="choose the action to be performed")
+  parser.add_argument("--cluster_id", required=False, help="Name of the cluster, needed by all the commands except clone, list and rebuild")
+  parser.add_argument("--from", dest="from_cluster", required=False, help="source cluster of clone command")
+  parser.add_argument("--to", dest="to_cluster", required=False, help="new cluster of clone command")
   parser.add_argument("--data", required=False, help="data is a json string for choosen command, see the examples.")
+  parser.add_argument("--file", required=False, help="file of rule operations for batch command, or desired state for apply command")
+  parser.add_argument("--dry_run", required=False, action="store_true", help="only print the plan of apply, gc or optimize command")
   parser.add_argument("--type", required=False, choices=['conf', 'module'], help="type of configs needs to be updated")
   parser.add_argument("--module", required=False, choices=['fallback', 'access', 'ratelimiter', 'router'],  help="Name of the module for which we need to update the rules")
+  parser.add_argument("--journal_threshold", required=False, type=int, help="journal mode for rule updates, compact the journal of a module once it reaches these many segments")
+  parser.add_argument("--keep", required=False, type=int, default=10, help="gc retains these many newest versions of every module, nginx.conf and cluster.json")
+  parser.add_argument("--max_age", required=False, help="gc retains the versions younger than it, like 3600, 30m, 12h or 7d, and always the versions younger than an hour")
+  parser.add_argument("--api", required=False, help="query filter on api of the rules")
+  parser.add_argument("--key", required=False, help="query filter on key of the rules")
+  parser.add_argument("--value", required=False, help="query filter on value of the rules")
+  parser.add_argument("--threshold_above", required=False, type=int, help="query filter on threshold of ratelimiter rules")
+  parser.add_argument("--threshold_below", required=False, type=int, help="query filter on threshold of ratelimiter rules")
+  parser.add_argument("--collapse_params", required=False, action="store_true", help="optimize also removes the ratelimiter param rules covered by the * rule of their key")
+  parser.add_argument("--stats", required=False, action="store_true", help="print the s3 requests and bytes per s3 command")
 
   args = parser.parse_args()
-  data = json.loads(args.data) if args.cmd != "delete" else None
+  data = json.loads(args.data) if args.data else None
 
   if args.cmd == "create":
     bootstrap_cluster(args.cluster_id, data)
   elif args.cmd == "delete":
     delete_cluster(args.cluster_id)
+  elif args.cmd == "batch":
+    apply_batch(args.cluster_id, args.file, args.journal_threshold)
+  elif args.cmd == "apply":
+    apply_desired_state(args.cluster_id, args.file, args.dry_run, args.journal_threshold)
+  elif args.cmd == "compact":
+    compact_journal(args.cluster_id)
+  elif args.cmd == "clone":
+    clone_cluster(args.from_cluster, args.to_cluster, data)
+  elif args.cmd == "gc":
+    collect_garbage(args.cluster_id, args.keep, args.max_age, args.dry_run)
+  elif args.cmd == "verify":
+    verify_regions(args.cluster_id)
+  elif args.cmd == "list":
+    list_clusters()
+  elif args.cmd == "describe":
+    describe_cluster(args.cluster_id)
+  elif args.cmd == "rebuild":
+    rebuild_registry()
+  elif args.cmd == "sync":
+    sync_mirror()
+  elif args.cmd == "query":
+    filters = { "cluster" : args.cluster_id, "module" : args.module, "api" : args.api, "key" : args.key, "value" : args.value }
+    query_mirror(filters, args.threshold_above, args.threshold_below)
+  elif args.cmd == "optimize":
+    optimize_rules(args.cluster_id, [args.module] if args.module else None, args.collapse_params, args.dry_run)
   else:
     assert args.type
     if args.type == "conf":
@@ -281,13 +601,17 @@ def main():
     else:
       assert args.module
       if args.module == "access":
-        update_access_rules(args.cluster_id, data)
+        update_access_rules(args.cluster_id, data, args.journal_threshold)
       elif args.module == "ratelimiter":
-        update_ratelimiter_rules(args.cluster_id, data)
+        update_ratelimiter_rules(args.cluster_id, data, args.journal_threshold)
       elif args.module == "router":
-        update_router_rules(args.cluster_id, data)
+        update_router_rules(args.cluster_id, data, args.journal_threshold)
       elif args.module == "fallback":
-        update_fallback_rules(args.cluster_id, data)
+        update_fallback_rules(args.cluster_id, data, args.journal_threshold)
+
+  if args.stats:
+    print storage.format_stats()
+    print utils.format_cache_stats()
 
   print "Finish execution!!"
 
@@ -0,0 +1,32 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from s3Persistence import S3Persistence
+from utils import storage
+
+class FilesystemPersistence(S3Persistence):
+  """
+  Local disk hook for persisting nginx config or rules, for staging and testing without s3.
+  It lays out the same <base>/<cluster>/modules/... tree as S3Persistence under a file:// base path.
+  Every file is written to a temporary file renamed over the target, and version.json is committed
+  with compare-and-swap under a lock file, so concurrent writers behave the same as on s3.
+  """
+
+  def __init__(self, cluster_id, service_port, ping_port, base_path, nodes, upstream_server='localhost:7072', journal_threshold=None):
+    primary_base_path = base_path[0] if isinstance(base_path, list) else base_path
+    if not storage.is_local(primary_base_path):
+      raise ValueError("FilesystemPersistence needs a file:// base path, got %s" % primary_base_path)
+    super(FilesystemPersistence, self).__init__(cluster_id, service_port, ping_port, base_path, nodes, upstream_server, journal_threshold)
@@ -0,0 +1,34 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###knows how to build persistence based on the scheme of base path
+
+from s3Persistence import S3Persistence
+from filesystemPersistence import FilesystemPersistence
+from utils import storage
+
+class PersistenceFactory:
+
+  @staticmethod
+  def buildPersistence(cluster_id, service_port, ping_port, base_path, nodes, upstream_server='localhost:7072', journal_threshold=None):
+    """builds the persistence of base path
+    FilesystemPersistence for file:// base path, S3Persistence for s3:// base path.
+    With a list of base paths (one per region), it is built for the primary (first) one.
+    """
+    primary_base_path = base_path[0] if isinstance(base_path, list) else base_path
+    if storage.is_local(primary_base_path):
+      return FilesystemPersistence(cluster_id, service_port, ping_port, base_path, nodes, upstream_server, journal_threshold)
+    return S3Persistence(cluster_id, service_port, ping_port, base_path, nodes, upstream_server, journal_threshold)
@@ -16,15 +16,19 @@
 #
 import json
 import os
+import random
+import sys
 import time
 
 from persistence import Persistence
 import template
 from utils import utils
-from schemas import access
-from schemas import ratelimiter
+from utils import bundle
 from utils import module_rule_utils
-from utils import s3_util
+from utils import rule_index
+from utils import rule_optimizer
+from utils import validation
+from utils import storage
 from module_rule_factory import ModuleRuleFactory
 
 class S3Persistence(Persistence):
@@ -38,9 +42,39 @@ class S3Persistence(Persistence):
   rule_threshold = "rule_threshold"
   rule_type = { "param":1, "header":2 }
 
-  def __init__(self, cluster_id, service_port, ping_port, s3_base_path, nodes, upstream_server='localhost:7072'):
+  # compare-and-swap attempts of version.json, and the base of jittered exponential backoff (seconds) between them
+  commit_attempts = 10
+  commit_backoff = 0.05
+  # checks of the regions agreeing on version.json after a commit, a concurrent commit may be replicating meanwhile
+  verify_attempts = 3
+  # gc never collects versions younger than it (seconds), whatever max_age is. A writer pushes or touches the
+  # rules of a version before committing version.json, so gc can not collect them in between.
+  gc_min_age = 3600
+
+  def __init__(self, cluster_id, service_port, ping_port, s3_base_path, nodes, upstream_server='localhost:7072', journal_threshold=None):
     # TODO : remove the default value
-    super(S3Persistence, self).__init__(cluster_id, service_port, ping_port, s3_base_path, nodes, upstream_server)
+    # s3_base_path is a base path, or a list of them with one per region, the first one is the primary
+    base_paths = s3_base_path if isinstance(s3_base_path, list) else [s3_base_path]
+    super(S3Persistence, self).__init__(cluster_id, service_port, ping_port, base_paths[0], nodes, upstream_server)
+    # every artifact is published to all the regions concurrently
+    self.regions = storage.Regions(base_paths)
+    # registry of all the clusters, next to the clusters of every region
+    self.registry_regions = storage.Regions([base_path.rsplit("/", 1)[0] for base_path in base_paths])
+    self.registry_path = utils.get_registry_path(base_paths[0])
+    # journal mode : with a threshold, rule changes are written as small delta segments on top of
+    # the snapshot version of a module, and folded into a new snapshot once threshold is reached.
+    self.journal_threshold = journal_threshold
+    # rules of modules as loaded, to compute the delta of a journal segment
+    self.loaded_rules = {}
+    # rules per (phase, module, version, journal segments) loaded by this instance
+    self.loaded_versions = {}
+    # number of rules per (phase, module, version, journal segments) known to this instance, for the registry
+    self.rule_counts = {}
+    # bundle members pushed by this instance, member name to (version, segment), packed into the next bundle
+    # without fetching them back
+    self.bundle_members = {}
+    # number of commits retried because version.json is changed by another writer
+    self.commit_retries = 0
 
 
   @staticmethod
@@ -64,26 +98,6 @@ class S3Persistence(Persistence):
 
     return rule
 
-  def lock_cluster_for_update(self):
-    """
-    An helper function to aquire s3 file base lock
-    """
-    lock_file_path = self.base_path + "/" + self.cluster_id + "/cluster.lock"
-
-    #throw error when cluster config is locked for update
-    file_present = s3_util.get_item(lock_file_path)
-    if file_present != None:
-      raise ValueError("cluster config locked for update. Cluster lock file ..%s" % lock_file_path)
-
-    s3_util.put_item_from_string(lock_file_path, "")
-
-  def unlock_cluster_for_update(self):
-    """
-    An helper function to release s3 file base lock
-    """
-    lock_file_path = self.base_path + "/" + self.cluster_id + "/cluster.lock"
-    s3_util.delete_item(lock_file_path)
-
   def validate_rule_data(self, module, rule_data):
     if module == S3Persistence.ratelimiter:
       if int(rule_data["rule_threshold"]) <= 0:
@@ -113,267 +127,1023 @@ class S3Persistence(Persistence):
     """
     An helper method to get version data from s3
     """
-    return s3_util.get_json_to_obj(version_file_path_s3)
+    return json.loads(utils.get_decoded_contents(version_file_path_s3))
 
   @staticmethod
-  def is_rule_defined(existing_rules, new_rule):
+  def get_version_data_with_etag(version_file_path_s3):
     """
-    An helper method to check if new rule is already exists
+    Gives (version data, etag) of version file, etag is the precondition of its compare-and-swap
     """
+    contents, etag = utils.get_contents_with_etag(version_file_path_s3)
+    if contents is None:
+      raise ValueError("version file %s does not exist" % version_file_path_s3)
+    return json.loads(contents), etag
 
-    #default condition for rule not found and new rule to be added
-    old_rule = None
-    key_matched = False
-    index_val = -1
+  @staticmethod
+  def build_rule(module, rule_data, validate=True):
+    """
+    Builds the rule of a given module from rule data, and validates it against
+    the module schema when asked. Raises exception for invalid rule data.
+    """
+    if module == module_rule_utils.fallback_module:
+      new_rule = S3Persistence.create_fallback_rule(rule_data)
+    else:
+      module_rule = ModuleRuleFactory.buildModule(module, rule_data)
+      if module_rule is None:
+        raise ValueError("Un-supported module %s" % module)
+      new_rule = module_rule.build()
 
-    new_rule_errors = new_rule["errors"]
-    no_of_errors_passed = len(new_rule_errors)
-    index = 0
-    for rule in existing_rules:
-      if new_rule["api"] == rule["api"]:
-        no_of_errors_rule = len(rule["errors"])
-        no_of_errors_matched = 0
-        for error in new_rule_errors:
-          if error in rule["key"]:
-            no_of_errors_matched += 1
+    if validate:
+      retVal, err = validation.validate_rule(module, new_rule)
+      if retVal != 0:
+        raise Exception(err)
+    return new_rule
 
-        if no_of_errors_passed == no_of_errors_rule and no_of_errors_matched == no_of_errors_passed: #complete key matched (rule should be updated)
-          key_matched = True
-          old_rule = rule
-          return old_rule, key_matched, index
+  @staticmethod
+  def add_rule(existing_rules, new_rule):
+    """
+    Adds new rule to the in-memory existing rules (RuleSet), or replaces the rule with same type, key, value and api.
+    returns (0, msg) when rules are changed, (-1, msg) when the rule is already present.
+    """
+    existing_rule = existing_rules.get(new_rule)
+    if existing_rule == new_rule:
+      return -1, "Rule is already present in datastore"
+    existing_rules.upsert(new_rule)
+    return 0, "Rule has been added/updated successfully"
 
-        if no_of_errors_matched > 0:
-          old_rule = rule
-          return old_rule, key_matched, index
+  @staticmethod
+  def remove_rule(existing_rules, new_rule):
+    """
+    Removes the rule from the in-memory existing rules (RuleSet).
+    returns (0, msg) when rules are changed, (-1, msg) when the rule is not found.
+    """
+    if existing_rules.delete(new_rule) is None:
+      return -1, "Rule was not found in datastore"
+    return 0, "Rule has been deleted successfully"
 
-      index += 1
+  @staticmethod
+  def add_fallback_rule(existing_rules, new_rule):
+    """
+    Adds new fallback rule to the in-memory existing rules (FallbackRuleSet), or replaces the rule with same api and errors.
+    returns (0, msg) when rules are changed, (-2, msg) when errors partially match an existing rule.
+    """
+    _, overlapping_rule = existing_rules.find(new_rule)
+    if overlapping_rule is not None:
+      return -2, "Errors passed %s .Provide all errors available in key [%s] (and no other errors) for updating the rule"% (new_rule["errors"], overlapping_rule["key"])
+    existing_rules.upsert(new_rule)
+    return 0, "Fallback rule has been added/updated successfully"
 
-    return old_rule, key_matched, index_val
+  @staticmethod
+  def remove_fallback_rule(existing_rules, new_rule):
+    """
+    Removes the fallback rule from the in-memory existing rules (FallbackRuleSet).
+    returns (0, msg) when rules are changed, (-1, msg) when not found, (-2, msg) on partial match of errors.
+    """
+    old_rule, overlapping_rule = existing_rules.find(new_rule)
+    if overlapping_rule is not None:
+      return -2, "Errors passed %s .Provide all errors available in key [%s] (and no other errors) for updating the rule"% (new_rule["errors"], overlapping_rule["key"])
+    if old_rule is None:
+      return -1, "Rule doesn't exists in the datastore!!"
+    existing_rules.delete(new_rule)
+    return 0, "Fallback rule has been deleted successfully"
 
-  def push_updated_rules_to_S3(self, updated_rules, module, phase, version_data_dict, version_file_path_s3):
+  @staticmethod
+  def apply_rule(existing_rules, module, method, new_rule):
     """
-    Updates the in-memory rules of a module to appropriate s3 path
+    Applies add/remove of a built rule to the in-memory rules of a module
     """
+    if module == module_rule_utils.fallback_module:
+      if method == "add":
+        return S3Persistence.add_fallback_rule(existing_rules, new_rule)
+      return S3Persistence.remove_fallback_rule(existing_rules, new_rule)
 
-    version = utils.get_timestamped_version()
-    module_rules_file_new_path_s3 = utils.get_module_s3_path(self.cluster_id, phase, module, version)
-    s3_util.put_obj_to_json(module_rules_file_new_path_s3, updated_rules)
+    if method == "add":
+      return S3Persistence.add_rule(existing_rules, new_rule)
+    return S3Persistence.remove_rule(existing_rules, new_rule)
+
+  @staticmethod
+  def build_operation(operation, validate=True):
+    """
+    Validates a batch operation and builds its rule, the rule of an add is validated against the module schema
+    unless validate is False.
+    An operation is the --data json of a module update along with "module" name.
+    returns (phase, module, method, rule), raises exception for invalid operation.
+    """
+    module = operation.get("module", None)
+    method = operation.get("method", None)
+    if module not in module_rule_utils.module_phases:
+      raise ValueError("Un-supported module %s, supported modules are (%s)" % (module, "/".join(sorted(module_rule_utils.module_phases))))
+    if method not in ("add", "remove"):
+      raise ValueError("Wrong method %s, supported methods are (add/remove)" % method)
+
+    if module == module_rule_utils.fallback_module:
+      if not operation.get(module_rule_utils.rule_params, None):
+        operation[module_rule_utils.rule_params] = {}
+      if not operation.get(module_rule_utils.rule_headers, None):
+        operation[module_rule_utils.rule_headers] = {}
 
-    # update version information
-    version_data_dict["modules"][phase][module] = version
-    s3_util.put_obj_to_json(version_file_path_s3, version_data_dict)
+    try:
+      new_rule = S3Persistence.build_rule(module, operation, validate=(validate and method == "add"))
+    except KeyError as e:
+      raise ValueError("missing field %s" % e)
+    return module_rule_utils.module_phases[module], module, method, new_rule
 
-  def removeFallbackRule(self, phase, module, rule_data):
+  def get_module_rules(self, version_data_dict, phase, module):
     """
-    Helps to remove the fallback rule
+    Returns the rules of the current version of a module.
+    The rules of a version are loaded once per instance, a rebased commit reuses them.
     """
-    unlock_cluster = False
-    retVal = 0
-    response = "Fallback rule has been deleted successfully"
+    module_version = version_data_dict[module_rule_utils.modules][phase][module]
+    segments = utils.get_journal_segments(version_data_dict, phase, module)
+    rules = list(self.load_rules(phase, module, module_version, segments))
+    self.loaded_rules[(phase, module)] = list(rules)
+    return rules
+
+  def load_rules(self, phase, module, module_version, segments):
+    """
+    Gives the rules of a version of a module with its journal segments replayed, loaded once per instance
+    """
+    loaded_key = (phase, module, module_version, tuple(segments))
+    if loaded_key not in self.loaded_versions:
+      self.loaded_versions[loaded_key] = utils.get_existing_rules(self.cluster_id, phase, module, module_version, segments)
+      self.rule_counts[loaded_key] = len(self.loaded_versions[loaded_key])
+    return self.loaded_versions[loaded_key]
+
+  def push_nginx_conf(self, nginx_conf_file_path_s3, nginx_conf, version):
+    """
+    Pushes the rendered nginx config of given version to every region, encoded with configured encoding
+    """
+    encoded_nginx_conf, encoding = utils.encode_contents(nginx_conf)
+    if not self.regions.put_item_from_string(nginx_conf_file_path_s3, encoded_nginx_conf, encoding):
+      raise Exception("Failed to push nginx config %s" % nginx_conf_file_path_s3)
+    self.bundle_members["nginx.conf"] = (version, bundle.pack_member("nginx.conf", nginx_conf))
+
+  def pack_module_members(self, phase, module, version, spool, index_contents):
+    """
+    Packs the bundle members of the rules of a module version from their spool, and of its index
+    """
+    name = utils.get_module_member_name(phase, module)
+    self.bundle_members[name] = (version, bundle.pack_spool(name, spool))
+    self.bundle_members[name + rule_index.SUFFIX] = (version, bundle.pack_member(name + rule_index.SUFFIX, index_contents))
+
+  def push_rule_blobs(self, artifacts):
+    """
+    Pushes the (s3 path, spool) of content addressed rules files to every region in parallel, streamed
+    from their spools. A rules file already stored at its content path is not uploaded again, it is
+    touched to refresh its last modified time for gc.
+    """
+    def push_task(s3path, spool):
+      def task():
+        if not self.regions.put_item_from_spool(s3path, spool):
+          raise Exception("Failed to push rules to %s" % s3path)
+      return task
+
     try:
-      self.lock_cluster_for_update()
-      unlock_cluster = True
-      version_file_path_s3 = utils.get_version_path(self.cluster_id)
-      version_data_dict = S3Persistence.get_version_data(version_file_path_s3)
+      storage.run_parallel([push_task(s3path, spool) for s3path, spool in artifacts])
+      for s3path, spool in artifacts:
+        utils.cache_spool(s3path, spool)
+    finally:
+      for _, spool in artifacts:
+        spool.fp.close()
+
+  def push_rule_indexes(self, indexes):
+    """
+    Pushes the (s3 path, contents) of precompiled rule indexes to every region in parallel, encoded with
+    configured encoding. An index is pushed along with the rules of its version, see rule_index.
+    """
+    def push_task(s3path, contents):
+      def task():
+        encoded_contents, encoding = utils.encode_contents(contents)
+        if not self.regions.put_item_from_string(s3path, encoded_contents, encoding):
+          raise Exception("Failed to push rule index to %s" % s3path)
+      return task
+    storage.run_parallel([push_task(s3path, contents) for s3path, contents in indexes])
+
+  def publish_module_rules(self, updated_modules, version_data_dict, compact=False):
+    """
+    Pushes the in-memory rules of every updated (phase, module) in parallel, and sets their new versions
+    in version_data_dict, which is committed by the caller (see commit_version) once all of them are pushed.
+    The version of a module is the hash of its serialized rules, so a module whose content is
+    same as its current version is skipped, and nothing is pushed when no module changed.
+    In journal mode, only the delta is pushed as a new journal segment until the journal reaches
+    the threshold, then the rules are pushed as new snapshot. compact forces a new snapshot.
+    A snapshot is pushed along with the precompiled index of its rules, which the plugins load.
+    returns dict of (phase, module) to new version for the changed modules
+    """
+    changed_modules = {}
+    artifacts = []
+    indexes = []
+    journal = version_data_dict.get(utils.JOURNAL, {})
+    for (phase, module), rules in updated_modules.items():
+      snapshot_version = version_data_dict[module_rule_utils.modules][phase][module]
+      segments = utils.get_journal_segments(version_data_dict, phase, module)
+
+      if self.journal_threshold and not compact and len(segments) + 1 < self.journal_threshold:
+        delta = module_rule_utils.get_delta(module, self.loaded_rules[(phase, module)], rules)
+        if not delta:
+          continue
+        spool = utils.spool_rules(delta)
+        segment = spool.get_version()
+        journal.setdefault(phase, {})[module] = segments + [segment]
+        # the next change of this instance starts from these rules without fetching the journal
+        self.loaded_versions[(phase, module, snapshot_version, tuple(segments + [segment]))] = list(rules)
+        self.rule_counts[(phase, module, snapshot_version, tuple(segments + [segment]))] = len(rules)
+        changed_modules[(phase, module)] = "%s+journal/%s" % (snapshot_version, segment)
+        artifacts.append((utils.get_journal_segment_s3_path(self.cluster_id, phase, module, snapshot_version, segment), spool))
+        continue
+
+      spool = utils.spool_rules(rules)
+      version = spool.get_version()
+      if version == snapshot_version and not segments:
+        spool.fp.close()
+        continue
+      journal.get(phase, {}).pop(module, None)
+      changed_modules[(phase, module)] = version
+      self.rule_counts[(phase, module, version, ())] = len(rules)
+      artifacts.append((utils.get_module_s3_path(self.cluster_id, phase, module, version), spool))
+      index_contents = rule_index.build_index(phase, module, version, rules)
+      indexes.append((utils.get_module_index_s3_path(self.cluster_id, phase, module, version), index_contents))
+      self.pack_module_members(phase, module, version, spool, index_contents)
+      version_data_dict[module_rule_utils.modules][phase][module] = version
+
+    if not changed_modules:
+      return changed_modules
+
+    for phase in journal.keys():
+      if not journal[phase]:
+        del journal[phase]
+    if journal:
+      version_data_dict[utils.JOURNAL] = journal
+    else:
+      version_data_dict.pop(utils.JOURNAL, None)
+
+    storage.run_parallel([lambda: self.push_rule_blobs(artifacts), lambda: self.push_rule_indexes(indexes)])
+    return changed_modules
+
+  def push_bundle(self, version_data_dict):
+    """
+    Pushes the node bootstrap bundle of a version, holding nginx.conf, rules of all the modules, version.json
+    and a manifest of member versions, so a node can warm up with a single GET. The members pushed by this
+    instance are packed as they were pushed (see bundle_members), the segments of the others are reused from
+    the previous bundle, and only the members in neither are fetched. The bundle is streamed from a spool.
+    The journal segments are not bundled (see utils.get_bundle_version), pull-mode nodes fetch and replay
+    them, so a commit which only adds segments keeps the previous bundle and nothing is pushed.
+    Sets the id of the bundle (hash of its manifest) in version_data_dict, returns s3 path of the new
+    bundle, None when the version keeps the previous bundle.
+    """
+    previous_bundle_id = version_data_dict.pop(utils.BUNDLE, None)
+    bundle_version = utils.get_bundle_version(version_data_dict)
+    members = utils.get_bundle_members(self.cluster_id, version_data_dict)
+    manifest = { "version" : bundle_version, "members" : dict((name, version) for name, version, _ in members) }
+    manifest_contents = json.dumps(manifest, sort_keys=True)
+    bundle_id = utils.get_content_version(manifest_contents)
+    version_data_dict[utils.BUNDLE] = bundle_id
+    held, self.bundle_members = self.bundle_members, {}
+    if bundle_id == previous_bundle_id:
+      return None
+    bundle_s3_path = utils.get_bundle_s3_path(self.cluster_id, bundle_id)
+
+    segments = dict((name, held[name][1]) for name, version, _ in members if held.get(name, (None,))[0] == version)
+    if previous_bundle_id and len(segments) < len(members):
+      previous_bundle = utils.get_contents(utils.get_bundle_s3_path(self.cluster_id, previous_bundle_id), immutable=True)
+      if previous_bundle:
+        previous_segments = bundle.unpack_segments(previous_bundle)
+        previous_members = json.loads(bundle.read_member(previous_segments[bundle.MANIFEST])[1])["members"]
+        for name, version, _ in members:
+          if name not in segments and name in previous_segments and previous_members.get(name) == version:
+            segments[name] = previous_segments[name]
+
+    # e.g. the artifacts copied by a clone, or of a cluster whose previous bundle is gone
+    missing = [(name, s3path) for name, _, s3path in members if name not in segments]
+    contents = storage.run_parallel([lambda s3path=s3path: utils.get_decoded_contents(s3path, immutable=True) for _, s3path in missing])
+    for (name, s3path), member_contents in zip(missing, contents):
+      if member_contents is None:
+        if utils.is_optional_member(name):
+          continue
+        raise Exception("Failed to bundle %s, it does not exist" % s3path)
+      segments[name] = bundle.pack_member(name, member_contents)
+
+    bundle_spool = bundle.spool([(bundle.MANIFEST, bundle.pack_member(bundle.MANIFEST, manifest_contents)),
+                                 ("version.json", bundle.pack_member("version.json", json.dumps(bundle_version)))] +
+                                [(name, segments[name]) for name, _, _ in members if name in segments])
+    try:
+      if not self.regions.put_item_from_spool(bundle_s3_path, bundle_spool):
+        raise Exception("Failed to push bundle %s" % bundle_s3_path)
+      utils.cache_spool(bundle_s3_path, bundle_spool)
+    finally:
+      bundle_spool.fp.close()
+    return bundle_s3_path
+
+  def publish_latest_bundle(self, bundle_s3_path):
+    """
+    Copies the bundle of a committed version as the latest bundle, which booting nodes fetch.
+    It is only a warm up hint, nodes follow version.json afterwards, so a failure is not fatal.
+    """
+    try:
+      self.regions.copy_item(bundle_s3_path, utils.get_bundle_s3_path(self.cluster_id, utils.LATEST_BUNDLE))
+    except Exception as e:
+      print >> sys.stderr, "Failed to publish latest bundle %s : %s" % (bundle_s3_path, str(e))
 
-      ##Note: removed if block only here, no other change. If block was not required
-      module_version = version_data_dict["modules"][phase][module]
-      existing_rules = utils.get_existing_rules(self.cluster_id, phase, module, module_version)
-      new_rule = S3Persistence.create_fallback_rule(rule_data)
-      old_rule, key_matched, index = S3Persistence.is_rule_defined(existing_rules, new_rule)
-      if old_rule is None:
-        response = "Rule doesn't exists in the datastore!!"
-      else:
-        if key_matched is False:
-          response = "Errors passed %s .Provide all errors available in key [%s] (and no other errors) for updating the rule"% (new_rule["errors"], old_rule["key"])
-          retVal = -2
-        else:
-          del existing_rules[index]
-          self.push_updated_rules_to_S3(existing_rules, module, phase, version_data_dict, version_file_path_s3)
+  def get_region_versions(self):
+    """
+    Gives [(version file path, version data)] of every region, the primary first.
+    version data is None in the regions where version.json does not exist.
+    """
+    return [(path, json.loads(contents) if contents is not None else None)
+            for path, contents in self.regions.get_items(utils.get_version_path(self.cluster_id))]
+
+  def get_drifted_regions(self):
+    """
+    Verification pass of the regions, gives (region versions, version file paths of the regions which disagree with the primary)
+    """
+    region_versions = self.get_region_versions()
+    return region_versions, [path for path, version_data_dict in region_versions[1:] if version_data_dict != region_versions[0][1]]
+
+  def check_regions(self):
+    """
+    Verifies all the regions agree on version.json after a commit, raises exception when they do not
+    """
+    if len(self.regions.base_paths) < 2:
+      return
+    for attempt in range(S3Persistence.verify_attempts):
+      if attempt > 0:
+        time.sleep(S3Persistence.commit_backoff * (2 ** attempt))
+      region_versions, drifted = self.get_drifted_regions()
+      if not drifted:
+        return
+    raise Exception("version.json is committed to %s, but the regions %s disagree with it" % (region_versions[0][0], ", ".join(drifted)))
+
+  def get_registry(self):
+    """
+    Gives (registry, etag) of the registry of all the clusters, an empty registry when it does not exist yet
+    """
+    contents, etag = utils.get_contents_with_etag(self.registry_path)
+    if contents is None:
+      return { "clusters" : {} }, None
+    return json.loads(contents), etag
+
+  def commit_registry(self, change):
+    """
+    Lock free update of the registry with compare-and-swap on its ETag, like commit_version.
+    change(registry) changes the registry in place and returns whether it is to be written,
+    it is run again on the latest registry when another writer committed first.
+    """
+    for attempt in range(S3Persistence.commit_attempts):
+      if attempt > 0:
+        time.sleep(random.uniform(0, S3Persistence.commit_backoff * (2 ** min(attempt, 6))))
+      registry, etag = self.get_registry()
+      if not change(registry):
+        return
+      if self.registry_regions.put_item_if_match(self.registry_path, json.dumps(registry, sort_keys=True), etag):
+        return
+    raise Exception("registry %s is changed concurrently by other writers, gave up after %d attempts" % (self.registry_path, S3Persistence.commit_attempts))
+
+  def build_registry_entry(self, cluster_id, version_data_dict, cluster_data, cluster_version, previous, count_rules=False):
+    """
+    Gives the registry entry of a cluster : its current versions, ports, nodes and number of rules per module.
+    The number of rules of a module is the one known to this instance, or the one of previous entry when the
+    module is still at its version; otherwise it is counted when count_rules is set, and None (unknown) if not.
+    """
+    modules = {}
+    previous_modules = previous.get(module_rule_utils.modules, {})
+    for phase, phase_modules in version_data_dict[module_rule_utils.modules].items():
+      for module, module_version in phase_modules.items():
+        segments = utils.get_journal_segments(version_data_dict, phase, module)
+        known = previous_modules.get(phase, {}).get(module, {})
+        rules = self.rule_counts.get((phase, module, module_version, tuple(segments))) if cluster_id == self.cluster_id else None
+        if rules is None and known.get("version") == module_version and known.get(utils.JOURNAL, []) == segments:
+          rules = known.get("rules")
+        if rules is None and count_rules:
+          rules = len(utils.get_existing_rules(cluster_id, phase, module, module_version, segments))
+        modules.setdefault(phase, {})[module] = { "version" : module_version, utils.JOURNAL : segments, "rules" : rules }
+
+    return {
+      "cluster_version" : cluster_version,
+      "service_port" : cluster_data.get("service_port"),
+      "ping_port" : cluster_data.get("ping_port"),
+      "nodes" : cluster_data.get("nodes"),
+      "nginx_conf" : version_data_dict["nginx_conf"],
+      utils.BUNDLE : version_data_dict.get(utils.BUNDLE),
+      module_rule_utils.modules : modules,
+      "updated" : utils.get_registry_time()
+    }
 
+  def register_cluster(self, cluster_data=None, cluster_version=None, source_cluster_id=None):
+    """
+    Records the current state of the cluster in the registry, after a commit. version.json is read after
+    the registry, so the registry update of an older commit never overwrites the one of a newer commit.
+    cluster_data and cluster_version are given on create, the other commits keep the ones in the registry.
+    The rule counts of a clone are taken from its source. The registry is only an index, which the rebuild
+    command regenerates from the clusters, so a failure to update it does not fail the commit.
+    """
+    def change(registry):
+      clusters = registry.setdefault("clusters", {})
+      version_data_dict, _ = S3Persistence.get_version_data_with_etag(utils.get_version_path(self.cluster_id))
+      previous = clusters.get(self.cluster_id) or clusters.get(source_cluster_id) or {}
+      data, data_version = cluster_data, cluster_version
+      if data is None and previous.get("cluster_version") is None:
+        data_version = utils.get_cluster_version_info(self.cluster_id)["cluster_version"]
+        data = utils.get_cluster_info(self.cluster_id)
+      elif data is None:
+        data, data_version = previous, previous["cluster_version"]
+      clusters[self.cluster_id] = self.build_registry_entry(self.cluster_id, version_data_dict, data, data_version, previous)
+      return True
+
+    try:
+      self.commit_registry(change)
     except Exception as e:
-        (retVal, response) = (-1, str(e))
+      print >> sys.stderr, "Failed to update registry %s with cluster (%s), regenerate it with rebuild : %s" % (self.registry_path, self.cluster_id, str(e))
 
-    if unlock_cluster is True:
-      self.unlock_cluster_for_update()
-    return retVal, response
+  def unregister_cluster(self):
+    """
+    Removes the cluster from the registry once it is deleted, a failure is not fatal (see register_cluster)
+    """
+    def change(registry):
+      return registry.get("clusters", {}).pop(self.cluster_id, None) is not None
+
+    try:
+      self.commit_registry(change)
+    except Exception as e:
+      print >> sys.stderr, "Failed to remove cluster (%s) from registry %s, regenerate it with rebuild : %s" % (self.cluster_id, self.registry_path, str(e))
+
+  def commit_version(self, update):
+    """
+    Lock free update of version.json with compare-and-swap on its ETag.
+    update(version_data_dict) pushes the new artifacts, changes the version data in place and
+    returns (write, result). The bundle of the new version is pushed before version.json, which
+    is written only if no other writer committed since it is read;
+    otherwise update is run again on the latest version data (rebase), after a jittered backoff.
+    returns result of the committed update
+    """
+    version_file_path_s3 = utils.get_version_path(self.cluster_id)
+    for attempt in range(S3Persistence.commit_attempts):
+      if attempt > 0:
+        self.commit_retries += 1
+        time.sleep(random.uniform(0, S3Persistence.commit_backoff * (2 ** min(attempt, 6))))
+
+      version_data_dict, etag = S3Persistence.get_version_data_with_etag(version_file_path_s3)
+      write, result = update(version_data_dict)
+      if not write:
+        return result
+      bundle_s3_path = self.push_bundle(version_data_dict)
+      if self.regions.put_item_if_match(version_file_path_s3, json.dumps(version_data_dict), etag):
+        if bundle_s3_path is not None:
+          self.publish_latest_bundle(bundle_s3_path)
+        self.register_cluster()
+        self.check_regions()
+        return result
+
+    raise Exception("version file %s is changed concurrently by other writers, gave up after %d attempts" % (version_file_path_s3, S3Persistence.commit_attempts))
+
+  def commit_module_changes(self, build_changes, compact=False):
+    """
+    Commits the module changes given by build_changes(version_data_dict), which applies the changes on the
+    latest rules of the modules and returns (dict of (phase, module) to updated rules, result).
+    On a concurrent commit, the changes are re-applied on top of it, so writers of different modules
+    never block each other, and the rules of the modules it did not change are not fetched again.
+    returns (result, dict of (phase, module) to new version of the changed modules)
+    """
+    def update(version_data_dict):
+      updated_modules, result = build_changes(version_data_dict)
+      changed_modules = {}
+      if updated_modules:
+        changed_modules = self.publish_module_rules(updated_modules, version_data_dict, compact)
+      return bool(changed_modules), (result, changed_modules)
+    return self.commit_version(update)
+
+  @staticmethod
+  def format_versions(changed_modules):
+    return ", ".join("%s/%s@%s" % (phase, module, changed_modules[(phase, module)]) for (phase, module) in sorted(changed_modules))
+
+  def removeFallbackRule(self, phase, module, rule_data):
+    """
+    Helps to remove the fallback rule
+    """
+    try:
+      new_rule = S3Persistence.create_fallback_rule(rule_data)
+    except Exception as e:
+      return -1, str(e)
+    return self.apply_module_rule(phase, module, lambda existing_rules: S3Persistence.remove_fallback_rule(existing_rules, new_rule))
 
   def updateFallbackRule(self, phase, module, rule_data):
     """
     This method helps to add new fallback rule or update existing one.
     """
-    unlock_cluster = False
-    retVal = 0
-    response = "Fallback rule has been added/updated successfully"
-
     try:
-      self.lock_cluster_for_update()
-      unlock_cluster = True
-      version_file_path_s3 = utils.get_version_path(self.cluster_id)
-      version_data_dict = S3Persistence.get_version_data(version_file_path_s3)
+      new_rule = S3Persistence.build_rule(module, rule_data)
+    except Exception as e:
+      return -1, str(e)
+    return self.apply_module_rule(phase, module, lambda existing_rules: S3Persistence.add_fallback_rule(existing_rules, new_rule))
 
-      ##Note: removed if block only here, no other change. If block was not required
-      module_version = version_data_dict["modules"][phase][module]
-      existing_rules = utils.get_existing_rules(self.cluster_id, phase, module, module_version)
-      new_rule = S3Persistence.create_fallback_rule(rule_data)
-      old_rule, key_matched, index = S3Persistence.is_rule_defined(existing_rules, new_rule)
-      if old_rule is None:
-        existing_rules.append(new_rule)
-        self.push_updated_rules_to_S3(existing_rules, module, phase, version_data_dict, version_file_path_s3)
-      else:
-        if key_matched is False:
-          response = "Errors passed %s .Provide all errors available in key [%s] (and no other errors) for updating the rule"% (new_rule["errors"], old_rule["key"])
-          retVal = -2
-        else:
-          del existing_rules[index]
-          existing_rules.append(new_rule)
-          self.push_updated_rules_to_S3(existing_rules, module, phase, version_data_dict, version_file_path_s3)
+  def removeModuleRule(self, phase, module, method, rule_data):
+    """
+    This is a generic method to remove a rule of a given module.
+    """
+    try:
+      new_rule = S3Persistence.build_rule(module, rule_data, validate=False)
+    except Exception as e:
+      return -1, str(e)
+    return self.apply_module_rule(phase, module, lambda existing_rules: S3Persistence.remove_rule(existing_rules, new_rule))
 
+  def updateModuleRule(self, phase, module, method, rule_data):
+    """
+    Generic method to add new existing rule or update existing one for given module
+    """
+    try:
+      new_rule = S3Persistence.build_rule(module, rule_data)
     except Exception as e:
-      (response, response) = (-1, str(e))
+      return -1, str(e)
+    return self.apply_module_rule(phase, module, lambda existing_rules: S3Persistence.add_rule(existing_rules, new_rule))
+
+  def apply_module_rule(self, phase, module, change):
+    """
+    Applies change(existing_rules), an add/remove of a rule returning (retVal, response), to the latest rules
+    of a module, and commits the rules when they are changed (retVal 0).
+    """
+    def build_changes(version_data_dict):
+      existing_rules = module_rule_utils.build_rule_set(module, self.get_module_rules(version_data_dict, phase, module))
+      retVal, response = change(existing_rules)
+      if retVal != 0:
+        return {}, (retVal, response)
+      return {(phase, module) : list(existing_rules)}, (retVal, response)
 
-    if unlock_cluster is True:
-      self.unlock_cluster_for_update()
+    try:
+      (retVal, response), _ = self.commit_module_changes(build_changes)
+    except Exception as e:
+      (retVal, response) = (-1, str(e))
     return retVal, response
 
-  def removeModuleRule(self, phase, module, method, rule_data):
+  def applyBatch(self, operations):
     """
-    This is a generic method to remove a rule of a given module.
+    Applies many add/remove rule operations across modules as one transaction.
+    All the operations are validated upfront and applied in memory on the latest rules.
+    Every touched module gets one new version, committed with a single compare-and-swap of version.json.
+    Nothing is written if any operation fails; adding an already present rule is a no-op.
     """
-    unlock_cluster = False
-    response = "Rule has been deleted successfully"
+    built_operations = []
+    errors = []
+    added_rules = {}
+    for index, operation in enumerate(operations):
+      try:
+        built_operation = S3Persistence.build_operation(operation, validate=False)
+      except Exception as e:
+        errors.append((index, str(e)))
+        continue
+      built_operations.append(built_operation)
+      phase, module, method, new_rule = built_operation
+      if method == "add":
+        added_rules.setdefault(module, ([], []))
+        added_rules[module][0].append(index)
+        added_rules[module][1].append(new_rule)
+
+    # the added rules are validated in bulk per module
+    for module, (indexes, rules) in added_rules.items():
+      errors.extend((indexes[index], message) for index, message in validation.validate_many(module, rules))
+    errors = ["operation %d : %s" % error for error in sorted(errors)]
+
+    if errors:
+      return -2, "Batch rejected, %d invalid operation(s)\n%s" % (len(errors), "\n".join(errors))
+
+    def build_changes(version_data_dict):
+      module_rules = {}
+      updated_modules = {}
+      unchanged = 0
+      errors = []
+      for index, (phase, module, method, new_rule) in enumerate(built_operations):
+        if (phase, module) not in module_rules:
+          module_rules[(phase, module)] = module_rule_utils.build_rule_set(module, self.get_module_rules(version_data_dict, phase, module))
+        existing_rules = module_rules[(phase, module)]
+
+        status, msg = S3Persistence.apply_rule(existing_rules, module, method, new_rule)
+        if status == 0:
+          updated_modules[(phase, module)] = existing_rules
+        elif method == "add" and status == -1:
+          unchanged += 1
+        else:
+          errors.append("operation %d : %s" % (index, msg))
+
+      if errors:
+        return {}, (-2, "Batch aborted, nothing is written. %d operation(s) failed\n%s" % (len(errors), "\n".join(errors)))
+      if not updated_modules:
+        return {}, (-1, "Batch of %d operation(s) did not change any rule" % len(built_operations))
+      return dict((name, list(rules)) for name, rules in updated_modules.items()), (0, unchanged)
+
     retVal = 0
+    response = None
     try:
-      self.lock_cluster_for_update()
-      unlock_cluster = True
-
-      version_file_path_s3 = utils.get_version_path(self.cluster_id)
-      version_data_dict = S3Persistence.get_version_data(version_file_path_s3)
-      module_version = version_data_dict[module_rule_utils.modules][module_rule_utils.access_phase][module]
-      existing_rules = utils.get_existing_rules(self.cluster_id, phase, module, module_version)
-      module_rule = ModuleRuleFactory.buildModule(module, rule_data)
-      new_rule = module_rule.build()
-      present, index = module_rule_utils.rule_present(existing_rules, new_rule)
-      if present == False:
-        retVal = -1
-        response = "Rule was not found in datastore"
+      (retVal, result), changed_modules = self.commit_module_changes(build_changes)
+      if retVal != 0:
+        response = result
+      elif not changed_modules:
+        (retVal, response) = (-1, "Batch of %d operation(s) did not change the content of any module" % len(built_operations))
       else:
-        del existing_rules[index]
-        version = utils.get_timestamped_version()
-        module_rules_file_new_path_s3 = utils.get_module_s3_path(self.cluster_id, phase, module, version)
-        s3_util.put_obj_to_json(module_rules_file_new_path_s3, existing_rules)
-        version_data_dict[module_rule_utils.modules][module_rule_utils.access_phase][module] = version
-        s3_util.put_obj_to_json(version_file_path_s3, version_data_dict)
+        response = "Batch of %d operation(s) applied (%d unchanged), modules updated [%s]" % (len(built_operations), result, S3Persistence.format_versions(changed_modules))
 
     except Exception as e:
-      (response, response) = (-1, str(e))
-
-    if unlock_cluster is True:
-      self.unlock_cluster_for_update()
+      (retVal, response) = (-1, str(e))
     return retVal, response
 
-  def updateModuleRule(self, phase, module, method, rule_data):
+  @staticmethod
+  def format_plan(plans):
     """
-    Generic method to add new existing rule or update existing one for given module
+    Gives a printable plan of the adds, removes and updates per module
+    """
+    lines = []
+    for (phase, module) in sorted(plans):
+      plan = plans[(phase, module)]
+      if module_rule_utils.is_empty_plan(plan):
+        lines.append("%s/%s : no change" % (phase, module))
+        continue
+      lines.append("%s/%s : %d add, %d remove, %d update" % (phase, module, len(plan["add"]), len(plan["remove"]), len(plan["update"])))
+      for rule in plan["add"]:
+        lines.append("  + %s" % json.dumps(rule, sort_keys=True))
+      for rule in plan["remove"]:
+        lines.append("  - %s" % json.dumps(rule, sort_keys=True))
+      for old_rule, new_rule in plan["update"]:
+        lines.append("  ~ %s => %s" % (json.dumps(old_rule, sort_keys=True), json.dumps(new_rule, sort_keys=True)))
+    return "\n".join(lines)
+
+  def applyDesiredState(self, desired_state, dry_run=False):
     """
-    unlock_cluster=False
-    response = "Rule has been added/updated successfully"
+    Reconciles the rules of the cluster with desired state, a dict of module name to complete list of rules.
+    Modules missing from desired state are left untouched. The plan is printed before anything is pushed,
+    and printed again if the commit is rebased on a concurrent one. Only the modules whose content actually
+    changed are pushed, and committed together with a single compare-and-swap of version.json.
+    """
+    errors = []
+    for module, rules in desired_state.items():
+      if module not in module_rule_utils.module_phases:
+        errors.append("Un-supported module %s" % module)
+        continue
+      if not isinstance(rules, list):
+        errors.append("%s : rules should be a list" % module)
+        continue
+
+      for index, message in validation.validate_many(module, rules):
+        errors.append("%s rule %d : %s" % (module, index, message))
+
+    if errors:
+      return -2, "Desired state rejected, %d error(s)\n%s" % (len(errors), "\n".join(errors))
+
+    def build_changes(version_data_dict):
+      plans = {}
+      updated_modules = {}
+      for module, rules in desired_state.items():
+        phase = module_rule_utils.module_phases[module]
+        existing_rules = self.get_module_rules(version_data_dict, phase, module)
+        plan = module_rule_utils.diff_rules(module, existing_rules, rules)
+        plans[(phase, module)] = plan
+        if not module_rule_utils.is_empty_plan(plan):
+          updated_modules[(phase, module)] = rules
+      print S3Persistence.format_plan(plans)
+      if dry_run:
+        return {}, len(updated_modules)
+      return updated_modules, len(updated_modules)
+
     retVal = 0
+    response = None
     try:
-      self.lock_cluster_for_update()
-      unlock_cluster = True
+      num_updated, changed_modules = self.commit_module_changes(build_changes)
+      if not num_updated:
+        (retVal, response) = (-1, "Cluster is already in desired state, nothing to apply")
+      elif dry_run:
+        response = "Dry run, %d module(s) would be updated" % num_updated
+      else:
+        response = "Desired state applied, modules updated [%s]" % S3Persistence.format_versions(changed_modules)
 
-      version_file_path_s3 = utils.get_version_path(self.cluster_id)
-      version_data_dict = S3Persistence.get_version_data(version_file_path_s3)
+    except Exception as e:
+      (retVal, response) = (-1, str(e))
+    return retVal, response
 
-      #read the version of module from version.json
-      module_version = version_data_dict[module_rule_utils.modules][module_rule_utils.access_phase][module]
-      existing_rules = utils.get_existing_rules(self.cluster_id, phase, module, module_version)
-      module_rule = ModuleRuleFactory.buildModule(module, rule_data)
-      new_rule = module_rule.build()
+  @staticmethod
+  def format_removed(removed_rules):
+    """
+    Gives a printable report of the rules removed per module by the optimizer, with the reason of each
+    """
+    lines = []
+    for (phase, module) in sorted(removed_rules):
+      removed = removed_rules[(phase, module)]
+      if not removed:
+        lines.append("%s/%s : already minimal" % (phase, module))
+        continue
+      lines.append("%s/%s : %d remove" % (phase, module, len(removed)))
+      for reason, rule in removed:
+        lines.append("  - %s (%s)" % (json.dumps(rule, sort_keys=True), reason))
+    return "\n".join(lines)
+
+  def optimizeRules(self, modules=None, collapse_params=False, dry_run=False):
+    """
+    Replaces the rules of the modules (all by default) with the minimal equivalent rules given by
+    rule_optimizer.optimize_rules, as a new version of the modules which had redundant rules.
+    The removed rules are printed before anything is pushed, and printed again if the commit is rebased
+    on a concurrent one, use dry_run to only print them.
+    """
+    modules = modules or sorted(module_rule_utils.module_phases)
+    for module in modules:
+      if module not in module_rule_utils.module_phases:
+        return -2, "Un-supported module %s" % module
+
+    def build_changes(version_data_dict):
+      removed_rules = {}
+      updated_modules = {}
+      for module in modules:
+        phase = module_rule_utils.module_phases[module]
+        existing_rules = self.get_module_rules(version_data_dict, phase, module)
+        rules, removed = rule_optimizer.optimize_rules(module, existing_rules, collapse_params)
+        removed_rules[(phase, module)] = removed
+        if removed:
+          updated_modules[(phase, module)] = rules
+      print S3Persistence.format_removed(removed_rules)
+      num_removed = sum(len(removed) for removed in removed_rules.values())
+      if dry_run:
+        return {}, (num_removed, len(updated_modules))
+      return updated_modules, (num_removed, len(updated_modules))
 
-      #TODO (navneet) : Handle this better way
-      err = None
-      if module_rule_utils.access_module == module:
-        retVal, err = utils.validate(new_rule, access.schema)
-      elif module_rule_utils.ratelimiter_module == module:
-        retVal, err = utils.validate(new_rule, ratelimiter.schema)
+    retVal = 0
+    response = None
+    try:
+      (num_removed, num_updated), changed_modules = self.commit_module_changes(build_changes)
+      if not num_updated:
+        (retVal, response) = (-1, "Rules are already minimal, nothing to optimize")
+      elif dry_run:
+        response = "Dry run, %d rule(s) of %d module(s) would be removed" % (num_removed, num_updated)
+      else:
+        response = "Rules optimized, %d rule(s) removed, modules updated [%s]" % (num_removed, S3Persistence.format_versions(changed_modules))
 
-      if retVal != 0:
-        raise Exception(err)
+    except Exception as e:
+      (retVal, response) = (-1, str(e))
+    return retVal, response
 
-      present, index = module_rule_utils.rule_present(existing_rules, new_rule)
-      if present == False:
-        existing_rules.append(new_rule)
-      else:
-        existing_rule = existing_rules[index]
-        if module_rule_utils.rule_already_present(existing_rule, new_rule):
-          retVal = -1 #no need to update again since rule is there
-          response = "Rule is already present in datastore"
-        else:
-          del existing_rules[index]
-          existing_rules.append(new_rule)
+  def compactJournal(self):
+    """
+    Folds the journal segments of every journaled module into a new snapshot version, which
+    pull-mode nodes fetch along with its precompiled index instead of replaying the journal.
+    """
+    def build_changes(version_data_dict):
+      updated_modules = {}
+      for phase, phase_journal in version_data_dict.get(utils.JOURNAL, {}).items():
+        for module in phase_journal:
+          updated_modules[(phase, module)] = self.get_module_rules(version_data_dict, phase, module)
+      return updated_modules, None
 
-      if retVal == 0: #update only if new rule or some change to existing rule
-        #update the version in version.json for module
-        version = utils.get_timestamped_version()
-        module_rules_file_new_path_s3 = utils.get_module_s3_path(self.cluster_id, phase, module, version)
-        s3_util.put_obj_to_json(module_rules_file_new_path_s3, existing_rules)
-        version_data_dict[module_rule_utils.modules][module_rule_utils.access_phase][module] = version
-        s3_util.put_obj_to_json(version_file_path_s3, version_data_dict)
+    retVal = 0
+    response = None
+    try:
+      _, changed_modules = self.commit_module_changes(build_changes, compact=True)
+      if not changed_modules:
+        (retVal, response) = (-1, "Nothing to compact, journal is empty")
+      else:
+        response = "Journal compacted, modules updated [%s]" % S3Persistence.format_versions(changed_modules)
 
     except Exception as e:
       (retVal, response) = (-1, str(e))
-
-    if unlock_cluster is True:
-      self.unlock_cluster_for_update()
-    return (retVal, response)
+    return retVal, response
 
   def deleteCluster(self):
     """
-    Delete an entire cluster
+    Delete an entire cluster. version.json is deleted first, so the commits of concurrent writers fail
+    and nodes stop pulling, then everything else is deleted. On partial failure, the response lists
+    every object which failed to delete, and the delete can be retried.
     """
-    response = "cluster (%s) is deleted successfully" %(self.cluster_id)
+    response = None
     retVal = 0
-    unlock_cluster = False
     try:
-      self.lock_cluster_for_update()
-      unlock_cluster = True
+      self.regions.delete_item(utils.get_version_path(self.cluster_id))
+      self.unregister_cluster()
       cluster_s3_path = self.base_path + "/" + self.cluster_id + "/"
-      s3_util.delete_dir(cluster_s3_path)
-      unlock_cluster = False
+      deleted, failures = self.regions.delete_dir(cluster_s3_path)
+      if failures:
+        details = "\n".join("%s : %s %s" % (failure["key"], failure["code"], failure["message"]) for failure in failures)
+        (retVal, response) = (-2, "cluster (%s) is partially deleted, %d object(s) deleted and %d failed\n%s" % (self.cluster_id, deleted, len(failures), details))
+      else:
+        response = "cluster (%s) is deleted successfully, %d object(s) deleted" % (self.cluster_id, deleted + 1)
     except Exception as e:
       (retVal, response) = (-1, str(e))
-    if unlock_cluster is True:
-      self.unlock_cluster_for_update()
     return retVal, response
 
-  def bootstrapCluster(self, nginx_conf_template):
+  def verifyRegions(self):
     """
-    Create a new cluster with given nginx conf template
+    Verifies all the regions agree on the version map (version.json) of the cluster
     """
+    try:
+      region_versions, drifted = self.get_drifted_regions()
+      if not drifted:
+        return 0, "%d region(s) agree on version.json of cluster (%s)" % (len(region_versions), self.cluster_id)
+      lines = ["%d of %d region(s) disagree with the primary on version.json of cluster (%s)" % (len(drifted), len(region_versions), self.cluster_id)]
+      for path, version_data_dict in region_versions:
+        lines.append("%s : %s" % (path, json.dumps(version_data_dict, sort_keys=True)))
+      return -2, "\n".join(lines)
+    except Exception as e:
+      return -1, str(e)
 
+  @staticmethod
+  def format_registry_entry(cluster_id, entry):
+    """
+    Gives a one line summary of a registry entry, the number of rules per module and their total
+    """
+    counts = []
+    total = 0
+    for phase in sorted(entry[module_rule_utils.modules]):
+      for module in sorted(entry[module_rule_utils.modules][phase]):
+        rules = entry[module_rule_utils.modules][phase][module]["rules"]
+        counts.append("%s=%s" % (module, rules if rules is not None else "?"))
+        total = total + rules if rules is not None and total is not None else None
+    return "%s : service_port=%s ping_port=%s nodes=%d nginx_conf=%s rules=%s (%s) updated=%s" % (
+      cluster_id, entry["service_port"], entry["ping_port"], len(entry["nodes"] or []), entry["nginx_conf"],
+      total if total is not None else "?", ", ".join(counts), entry["updated"])
+
+  def listClusters(self):
+    """
+    Lists all the clusters with their ports, nodes and rule counts, answered from the registry with a single GET
+    """
+    try:
+      registry, etag = self.get_registry()
+      if etag is None:
+        return -1, "registry %s does not exist, create it with rebuild command" % self.registry_path
+      clusters = registry["clusters"]
+      lines = [S3Persistence.format_registry_entry(cluster_id, clusters[cluster_id]) for cluster_id in sorted(clusters)]
+      lines.append("%d cluster(s)" % len(clusters))
+      return 0, "\n".join(lines)
+    except Exception as e:
+      return -1, str(e)
+
+  def describeCluster(self):
+    """
+    Describes the cluster : its current versions, ports, nodes and number of rules per module,
+    answered from the registry with a single GET
+    """
+    try:
+      registry, _ = self.get_registry()
+      entry = registry["clusters"].get(self.cluster_id)
+      if entry is None:
+        return -1, "cluster (%s) is not in registry %s" % (self.cluster_id, self.registry_path)
+      return 0, json.dumps(entry, indent=2, sort_keys=True)
+    except Exception as e:
+      return -1, str(e)
+
+  def rebuildRegistry(self):
+    """
+    Regenerates the registry from the tree of clusters, the clusters are read and their rules counted in parallel.
+    A cluster without version.json (partially created or deleted) is left out. The entries recorded by the
+    commits which ran meanwhile are kept, as they are newer than the ones read by the rebuild.
+    """
+    def read_cluster(cluster_id):
+      version_contents = utils.get_decoded_contents(utils.get_version_path(cluster_id))
+      if version_contents is None:
+        return None
+      cluster_version = utils.get_cluster_version_info(cluster_id)["cluster_version"]
+      cluster_data = utils.get_cluster_info(cluster_id)
+      return self.build_registry_entry(cluster_id, json.loads(version_contents), cluster_data, cluster_version, {}, count_rules=True)
+
+    try:
+      started = utils.get_registry_time()
+      cluster_ids = list(storage.list_prefixes(self.base_path + "/"))
+      entries = storage.run_parallel([lambda cluster_id=cluster_id: read_cluster(cluster_id) for cluster_id in cluster_ids])
+      rebuilt = dict((cluster_id, entry) for cluster_id, entry in zip(cluster_ids, entries) if entry is not None)
+
+      def change(registry):
+        clusters = dict(rebuilt)
+        for cluster_id, entry in registry.get("clusters", {}).items():
+          if entry.get("updated", "") > started:
+            clusters[cluster_id] = entry
+        registry["clusters"] = clusters
+        return True
+      self.commit_registry(change)
+      return 0, "registry %s is rebuilt with %d cluster(s), %d skipped without version.json" % (self.registry_path, len(rebuilt), len(cluster_ids) - len(rebuilt))
+    except Exception as e:
+      return -1, str(e)
+
+  @staticmethod
+  def get_artifact_version(relative_key):
+    """
+    Gives (artifact, version) of a key relative to the cluster path, (None, None) for the keys which are not versioned.
+    artifact is modules/<phase>/<module>, conf (nginx.conf), cluster (cluster.json) or bundle
+    """
+    parts = relative_key.split("/")
+    if parts[0] == module_rule_utils.modules and len(parts) >= 5:
+      return "%s/%s/%s" % (module_rule_utils.modules, parts[1], parts[2]), parts[3]
+    if parts[0] == "conf" and len(parts) >= 3:
+      return "conf", parts[1]
+    if len(parts) == 2 and parts[1] == "cluster.json":
+      return "cluster", parts[0]
+    if len(parts) == 2 and parts[0] == utils.BUNDLE and parts[1] != "%s.tar.gz" % utils.LATEST_BUNDLE:
+      return utils.BUNDLE, parts[1].split(".")[0]
+    return None, None
+
+  def get_referenced_versions(self):
+    """
+    Gives the set of (artifact, version) referenced by version.json and cluster_version.json
+    """
+    version_data_dict, _ = S3Persistence.get_version_data_with_etag(utils.get_version_path(self.cluster_id))
+    referenced = set()
+    for phase, phase_modules in version_data_dict[module_rule_utils.modules].items():
+      for module, version in phase_modules.items():
+        referenced.add(("%s/%s/%s" % (module_rule_utils.modules, phase, module), version))
+    referenced.add(("conf", version_data_dict["nginx_conf"]))
+    referenced.add((utils.BUNDLE, version_data_dict.get(utils.BUNDLE)))
+    referenced.add(("cluster", utils.get_cluster_version_info(self.cluster_id)["cluster_version"]))
+    return referenced
+
+  def collectGarbage(self, keep=10, max_age=None, dry_run=False):
+    """
+    Deletes the old versions of module rules, nginx.conf and cluster.json. The versions referenced by
+    version.json and cluster_version.json are never deleted, and of each artifact the newest keep versions
+    and the versions younger than max_age seconds, and never younger than gc_min_age, are retained.
+    Keys are listed with pagination and deleted in parallel multi-object batches. The references are
+    read again right before deleting, so a version committed while listing is kept.
+    """
+    retVal = 0
+    response = None
+    try:
+      cluster_s3_path = "%s/%s/" % (self.base_path, self.cluster_id)
+      _, cluster_prefix = storage.parse_path(cluster_s3_path)
+
+      # artifact to version to its keys, bytes and last modified time
+      artifacts = {}
+      for key in storage.list_keys(cluster_s3_path):
+        relative_key = key.name[len(cluster_prefix):]
+        artifact, version = S3Persistence.get_artifact_version(relative_key)
+        if artifact is None:
+          continue
+        entry = artifacts.setdefault(artifact, {}).setdefault(version, { "keys" : [], "bytes" : 0, "modified" : 0 })
+        entry["keys"].append(relative_key)
+        entry["bytes"] += int(key.size)
+        entry["modified"] = max(entry["modified"], storage.get_last_modified(key))
+
+      now = time.time()
+      min_age = max(max_age or 0, S3Persistence.gc_min_age)
+      referenced = self.get_referenced_versions()
+      collected = {}
+      for artifact, versions in artifacts.items():
+        newest_first = sorted(versions, key=lambda version: versions[version]["modified"], reverse=True)
+        for index, version in enumerate(newest_first):
+          if index < keep or (artifact, version) in referenced:
+            continue
+          if now - versions[version]["modified"] < min_age:
+            continue
+          collected.setdefault(artifact, []).append(version)
+
+      if collected and not dry_run:
+        referenced = self.get_referenced_versions()
+        for artifact in collected.keys():
+          collected[artifact] = [version for version in collected[artifact] if (artifact, version) not in referenced]
+
+      lines = []
+      total_objects = 0
+      total_bytes = 0
+      for artifact in sorted(artifacts):
+        versions = collected.get(artifact, [])
+        num_objects = sum(len(artifacts[artifact][version]["keys"]) for version in versions)
+        num_bytes = sum(artifacts[artifact][version]["bytes"] for version in versions)
+        total_objects += num_objects
+        total_bytes += num_bytes
+        lines.append("%s : %d version(s) kept, %d collected (%d objects, %d bytes)" % (
+          artifact, len(artifacts[artifact]) - len(versions), len(versions), num_objects, num_bytes))
+
+      if dry_run:
+        lines.append("Dry run, gc of cluster (%s) would reclaim %d object(s), %d bytes" % (self.cluster_id, total_objects, total_bytes))
+        return retVal, "\n".join(lines)
+
+      k_names = (k_name for artifact, versions in collected.items() for version in versions for k_name in artifacts[artifact][version]["keys"])
+      deleted, failures = self.regions.delete_key_names(cluster_s3_path, k_names)
+      if failures:
+        retVal = -2
+        lines.append("gc of cluster (%s) is partial, %d object(s) deleted and %d failed" % (self.cluster_id, deleted, len(failures)))
+        lines.extend("%s : %s %s" % (failure["key"], failure["code"], failure["message"]) for failure in failures)
+      else:
+        lines.append("gc of cluster (%s) reclaimed %d object(s), %d bytes" % (self.cluster_id, deleted, total_bytes))
+      response = "\n".join(lines)
+
+    except Exception as e:
+      (retVal, response) = (-1, str(e))
+    return retVal, response
+
+  def bootstrapCluster(self, nginx_conf_template):
+    """
+    Create a new cluster with given nginx conf template.
+    All the artifacts are pushed in parallel, and version.json is pushed
+    strictly last as commit point once all of them are pushed successfully.
+    """
     version_file_path_s3 = utils.get_version_path(self.cluster_id)
-    version_file = s3_util.get_item(version_file_path_s3)
+    version_file = storage.get_item(version_file_path_s3)
 
     if version_file != None:
-      print "Bootstrap already completed, please try other commands for updating"
-      return
+      msg = "Bootstrap already completed, please try other commands for updating"
+      print msg
+      return -1, msg
 
-    #build version data
+    #build version data, modules start with empty rules
     version = utils.get_timestamped_version()
+    empty_rules_version = utils.spool_rules([]).get_version()
     version_data_dict = {}
     version_data_dict["nginx_conf"] = version
     version_data_dict["modules"] = {}
     version_data_dict["modules"]["access"] = {}
     version_data_dict["modules"]["error"] = {}
-    version_data_dict["modules"]["access"]["ratelimiter"] = version
-    version_data_dict["modules"]["access"]["access"] = version
-    version_data_dict["modules"]["access"]["router"] = version
-    version_data_dict["modules"]["error"]["fallback"] = version
-
-    with open('/tmp/version.json', 'w') as outfile:
-      json.dump(version_data_dict, outfile)
+    version_data_dict["modules"]["access"]["ratelimiter"] = empty_rules_version
+    version_data_dict["modules"]["access"]["access"] = empty_rules_version
+    version_data_dict["modules"]["access"]["router"] = empty_rules_version
+    version_data_dict["modules"]["error"]["fallback"] = empty_rules_version
 
     #build cluster data
     cluster_data = {}
@@ -382,39 +1152,143 @@ class S3Persistence(Persistence):
     cluster_data["ping_port"] = self.ping_port
     cluster_data["nodes"] = self.nodes
 
-    #push cluster info file
+    artifacts = []
+
+    #cluster info file
     cluster_info_file_path_s3 = "%s/%s/%s/cluster.json"%(self.base_path, self.cluster_id, version)
-    s3_util.put_obj_to_json(cluster_info_file_path_s3, cluster_data)
+    artifacts.append((cluster_info_file_path_s3, json.dumps(cluster_data)))
 
-    #push cluster version file
+    #cluster version file
     cluster_version_file_path_s3 = "%s/%s/cluster_version.json"%(self.base_path, self.cluster_id)
     cluster_version_dict = {}
     cluster_version_dict["cluster_version"] = version
-    s3_util.put_obj_to_json(cluster_version_file_path_s3, cluster_version_dict)
+    artifacts.append((cluster_version_file_path_s3, json.dumps(cluster_version_dict)))
 
-    #build and push nginx config
+    #build nginx config
     template_dict = self.get_nginx_template_dict()
-    output_file = "/tmp/nginx.conf"
-    template.build_nginx_conf(nginx_conf_template, output_file, template_dict)
+    nginx_conf = template.render_nginx_conf(nginx_conf_template, template_dict)
     nginx_conf_file_path_s3 = "%s/%s/conf/%s/nginx.conf"%(self.base_path, self.cluster_id, version)
 
-    with open('/tmp/nginx.conf', 'r') as infile:
-      s3_util.put_item_from_file_pointer(nginx_conf_file_path_s3, infile)
+    #empty rules files for bootstrap, with their indexes
+    rule_artifacts = []
+    rule_indexes = []
+    for phase, phase_modules in version_data_dict["modules"].items():
+      for module in phase_modules:
+        spool = utils.spool_rules([])
+        index_contents = rule_index.build_index(phase, module, empty_rules_version, [])
+        rule_artifacts.append((utils.get_module_s3_path(self.cluster_id, phase, module, empty_rules_version), spool))
+        rule_indexes.append((utils.get_module_index_s3_path(self.cluster_id, phase, module, empty_rules_version), index_contents))
+        self.pack_module_members(phase, module, empty_rules_version, spool, index_contents)
+
+    try:
+      storage.run_parallel([
+        lambda: self.regions.put_items_from_strings(artifacts),
+        lambda: self.push_nginx_conf(nginx_conf_file_path_s3, nginx_conf, version),
+        lambda: self.push_rule_blobs(rule_artifacts),
+        lambda: self.push_rule_indexes(rule_indexes)])
+    except Exception as e:
+      return -1, "Bootstrap failed, version.json is not pushed : %s" % str(e)
 
-    #push empty rules files for bootstrap
-    empty_json_string = '[]'
-    ratelimiter_file_path_s3 = "%s/%s/modules/access/ratelimiter/%s/ratelimiter.rules"%(self.base_path, self.cluster_id, version)
-    accesscontrol_file_path_s3 = "%s/%s/modules/access/access/%s/access.rules"%(self.base_path, self.cluster_id, version)
-    router_file_path_s3 = "%s/%s/modules/access/router/%s/router.rules"%(self.base_path, self.cluster_id, version)
-    fallback_file_path_s3 = "%s/%s/modules/error/fallback/%s/fallback.rules"%(self.base_path, self.cluster_id, version)
+    try:
+      bundle_s3_path = self.push_bundle(version_data_dict)
+    except Exception as e:
+      return -1, "Bootstrap failed, version.json is not pushed : %s" % str(e)
+
+    #commit, only if no other bootstrap of the cluster committed meanwhile
+    if not self.regions.put_item_if_match(version_file_path_s3, json.dumps(version_data_dict), None):
+      msg = "Bootstrap already completed, please try other commands for updating"
+      print msg
+      return -1, msg
+    self.publish_latest_bundle(bundle_s3_path)
+    for phase, phase_modules in version_data_dict["modules"].items():
+      for module in phase_modules:
+        self.rule_counts[(phase, module, empty_rules_version, ())] = 0
+    self.register_cluster(cluster_data, version)
+    try:
+      self.check_regions()
+    except Exception as e:
+      return -2, str(e)
+    return 0, "cluster (%s) is created successfully with version %s" % (self.cluster_id, version)
 
-    s3_util.put_item_from_string(ratelimiter_file_path_s3, empty_json_string)
-    s3_util.put_item_from_string(accesscontrol_file_path_s3, empty_json_string)
-    s3_util.put_item_from_string(router_file_path_s3, empty_json_string)
-    s3_util.put_item_from_string(fallback_file_path_s3, empty_json_string)
+  def cloneCluster(self, source_cluster_id, nginx_conf_template=None):
+    """
+    Creates this cluster as a copy of the current version of source cluster. The rules and nginx.conf are
+    copied with server side copies in parallel, and version.json pointing at the copies is pushed last.
+    ports and nodes of this instance override the ones of source when given. nginx.conf is rendered again
+    from nginx_conf_template when ports or upstream server are overridden, as they are part of nginx.conf;
+    the upstream server is not recorded in cluster.json, so it is needed for rendering.
+    """
+    try:
+      version_file_path_s3 = utils.get_version_path(self.cluster_id)
+      if storage.get_item(version_file_path_s3) is not None:
+        return -1, "cluster (%s) already exists, clone needs a new cluster" % self.cluster_id
+
+      source_version_data_dict, _ = S3Persistence.get_version_data_with_etag(utils.get_version_path(source_cluster_id))
+      source_cluster_data = utils.get_cluster_info(source_cluster_id)
+
+      overridden = [name for name in ("service_port", "ping_port") if getattr(self, name) not in (None, source_cluster_data[name])]
+      if self.upstream_server is not None:
+        overridden.append("upstream_server")
+      if overridden and (not nginx_conf_template or self.upstream_server is None):
+        return -1, "nginx_conf_template and upstream_server are needed to render nginx.conf with new %s" % ", ".join(overridden)
+
+      cluster_data = dict(source_cluster_data)
+      cluster_data["cluster_id"] = self.cluster_id
+      for name in ("service_port", "ping_port", "nodes"):
+        if getattr(self, name) is not None:
+          cluster_data[name] = getattr(self, name)
+      self.service_port = cluster_data["service_port"]
+      self.ping_port = cluster_data["ping_port"]
+      self.nodes = cluster_data["nodes"]
 
-    with open('/tmp/version.json', 'r') as infile:
-      s3_util.put_item_from_file_pointer(version_file_path_s3, infile)
+      version = utils.get_timestamped_version()
+      version_data_dict = json.loads(json.dumps(source_version_data_dict))
+      version_data_dict["nginx_conf"] = version
+      version_data_dict.pop(utils.BUNDLE, None)
+
+      # rules of the modules along with their journal segments, the paths only differ by cluster id
+      copies = []
+      index_copies = []
+      for phase, phase_modules in version_data_dict[module_rule_utils.modules].items():
+        for module, module_version in phase_modules.items():
+          copies.append((utils.get_module_s3_path(source_cluster_id, phase, module, module_version),
+                         utils.get_module_s3_path(self.cluster_id, phase, module, module_version)))
+          index_copies.append((utils.get_module_index_s3_path(source_cluster_id, phase, module, module_version),
+                               utils.get_module_index_s3_path(self.cluster_id, phase, module, module_version)))
+          for segment in utils.get_journal_segments(version_data_dict, phase, module):
+            copies.append((utils.get_journal_segment_s3_path(source_cluster_id, phase, module, module_version, segment),
+                           utils.get_journal_segment_s3_path(self.cluster_id, phase, module, module_version, segment)))
+
+      nginx_conf_file_path_s3 = "%s/%s/conf/%s/nginx.conf"%(self.base_path, self.cluster_id, version)
+      # the indexes are copied where the source has them, versions pushed before the indexes have none
+      def copy_index(src, dest):
+        if storage.get_item(src) is not None:
+          self.regions.copy_item(src, dest)
+      tasks = [lambda: self.regions.copy_items(copies)] + [lambda src=src, dest=dest: copy_index(src, dest) for src, dest in index_copies]
+      if overridden:
+        nginx_conf = template.render_nginx_conf(nginx_conf_template, self.get_nginx_template_dict())
+        tasks.append(lambda: self.push_nginx_conf(nginx_conf_file_path_s3, nginx_conf, version))
+      else:
+        source_nginx_conf_file_path_s3 = "%s/%s/conf/%s/nginx.conf"%(self.base_path, source_cluster_id, source_version_data_dict["nginx_conf"])
+        tasks.append(lambda: self.regions.copy_item(source_nginx_conf_file_path_s3, nginx_conf_file_path_s3))
+
+      artifacts = [
+        ("%s/%s/%s/cluster.json"%(self.base_path, self.cluster_id, version), json.dumps(cluster_data)),
+        (utils.get_cluster_version_path(self.cluster_id), json.dumps({ "cluster_version" : version }))]
+      tasks.append(lambda: self.regions.put_items_from_strings(artifacts))
+      storage.run_parallel(tasks)
+      bundle_s3_path = self.push_bundle(version_data_dict)
+
+      #commit, only if the cluster is not created meanwhile
+      if not self.regions.put_item_if_match(version_file_path_s3, json.dumps(version_data_dict), None):
+        return -1, "cluster (%s) already exists, clone needs a new cluster" % self.cluster_id
+      self.publish_latest_bundle(bundle_s3_path)
+      self.register_cluster(cluster_data, version, source_cluster_id)
+      self.check_regions()
+      return 0, "cluster (%s) is cloned from (%s) with %d object(s) copied, version %s" % (self.cluster_id, source_cluster_id, len(copies) + (0 if overridden else 1), version)
+
+    except Exception as e:
+      return -1, "Clone failed, version.json is not pushed : %s" % str(e)
 
   def updateNginxConfig(self, nginx_conf_template):
     """
@@ -422,33 +1296,20 @@ class S3Persistence(Persistence):
     """
     response = "Nginx Config updated successfully."
     retVal = 0
-    unlock_cluster = False
     try:
-      self.lock_cluster_for_update()
-      unlock_cluster = True
-
-      # get the current version file
-      version_file_path_s3 = utils.get_version_path(self.cluster_id)
-      version_data_dict = S3Persistence.get_version_data(version_file_path_s3)
-
-      # build and push nginx config
+      # build nginx config
       template_dict = self.get_nginx_template_dict()
-      output_file = "/tmp/nginx.conf"
-      template.build_nginx_conf(nginx_conf_template, output_file, template_dict)
+      nginx_conf = template.render_nginx_conf(nginx_conf_template, template_dict)
 
-      version = utils.get_timestamped_version()
-      nginx_conf_file_path_s3 = "%s/%s/conf/%s/nginx.conf"%(self.base_path, self.cluster_id, version)
-
-      with open('/tmp/nginx.conf', 'r') as infile:
-        s3_util.put_item_from_file_pointer(nginx_conf_file_path_s3, infile)
-
-      # update the version information
-      version_data_dict["nginx_conf"] = version
-      s3_util.put_obj_to_json(version_file_path_s3, version_data_dict)
+      def update(version_data_dict):
+        # the version is after the current one, even if the clock of this host lags behind
+        version = utils.get_timestamped_version(version_data_dict.get("nginx_conf"))
+        nginx_conf_file_path_s3 = "%s/%s/conf/%s/nginx.conf"%(self.base_path, self.cluster_id, version)
+        self.push_nginx_conf(nginx_conf_file_path_s3, nginx_conf, version)
+        version_data_dict["nginx_conf"] = version
+        return True, version
+      self.commit_version(update)
 
     except Exception as e:
       (retVal, response) = (-3, str(e))
-
-    if unlock_cluster is True:
-      self.unlock_cluster_for_update()
-    return retVal, response
\ No newline at end of file
+    return retVal, response
@@ -39,6 +39,10 @@
 #  "access" : "deny"
 # }
 
+import re
+
+ipv4_pattern = "^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$"
+
 # schema definition
 schema = {
   "definitions" : {
@@ -49,7 +53,7 @@ schema = {
           "properties": {
             "type" : {"type" : "string", "enum" : ["header", "param"]},
             "key" : {"type" : "string", "enum" : ["remote_addr"]},
-            "value" : {"type": "string", "pattern" : "^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$"},
+            "value" : {"type": "string", "pattern" : ipv4_pattern},
           },
           "required": ["key", "value"],
         },
@@ -79,6 +83,23 @@ schema = {
   ],
 }
 
+ipv4_regex = re.compile(ipv4_pattern)
+rule_keys = frozenset(["type", "api", "key", "value", "access"])
+
+def precheck(rule):
+  """
+  Fast check of the common rule shape, True only when the rule is valid.
+  Other rules are left to the schema.
+  """
+  if not isinstance(rule, dict) or len(rule) != len(rule_keys) or not rule_keys.issuperset(rule):
+    return False
+  for field in rule_keys:
+    if not isinstance(rule[field], basestring):
+      return False
+  if rule["type"] not in ("header", "param") or rule["access"] not in ("deny", "allow"):
+    return False
+  return rule["key"] != "remote_addr" or ipv4_regex.search(rule["value"]) is not None
+
 # Note:
 # You need to set the python path running from command prompt.
 # PYTHONPATH=$PYTHONPATH:<bloomgateway repo> python access.py
@@ -91,12 +112,12 @@ if __name__ == "__main__":
   assert(ret == 0)
   # invalid IP rule
   ret, err = utils.validate({"key" : "remote_addr", "value" : "10.10.11", "type" : "header", "api" : "/api/v1/core/", "access":"deny"}, schema)
-  assert (ret == -1)
+  assert (ret == -2)
   # valid non-IP rule
   ret, err = utils.validate({"key" : "account_id", "value" : "1234", "type" : "header", "api" : "/api/v1/core/", "access":"deny"}, schema)
   assert (ret == 0)
   # invalid non-IP rule
   ret, err = utils.validate({"key" : "account_id", "value" : "1234", "type" : "header", "api" : "/api/v1/core/", "access":"deny1"}, schema)
-  assert (ret == -1)
+  assert (ret == -2)
   # exit message
   print "successfully verified all the access rules."
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# This python file defines JSON Schema for Fallback Module of BloomGateay
+# The rule for Fallback are defined as JSON object of api, the http status codes (errors)
+# to fall back on, key (api and errors joined by _) and the ordered list of fallback
+# endpoints, each a single entry object of its position to name (host:port), params and headers.
+
+# Rule example
+# {
+#  "api" : "/api/v1/core/",
+#  "errors" : ["500", "502"],
+#  "key" : "/api/v1/core/_500_502",
+#  "endpoints" : [
+#    { "1" : { "name" : "localhost:80", "params" : { "is_fallback" : "true" }, "headers" : {} } },
+#    { "2" : { "name" : "service.fallback:80", "params" : {}, "headers" : {} } }
+#  ]
+# }
+from router import endpoint_pattern
+
+# schema definition
+schema = {
+  "definitions" : {
+    "endpoint" : {
+      "type" : "object",
+      "properties" : {
+        "name" : { "type" : "string", "pattern" : endpoint_pattern },
+        "params" : { "type" : "object" },
+        "headers" : { "type" : "object" },
+      },
+      "required" : ["name", "params", "headers"],
+    },
+  },
+
+  "type" : "object",
+  "properties" : {
+    "api": { "type": "string", "format": "uri"},
+    "errors" : {
+      "type" : "array",
+      "items" : { "type" : "string", "pattern" : "^[0-9]{3}$" },
+      "minItems" : 1,
+    },
+    "key": { "type": "string" },
+    "endpoints" : {
+      "type" : "array",
+      "items" : {
+        "type" : "object",
+        "additionalProperties" : { "$ref": "#/definitions/endpoint" },
+        "minProperties" : 1,
+        "maxProperties" : 1,
+      },
+      "minItems" : 1,
+    },
+  },
+  "required" : ["api", "errors", "key", "endpoints"],
+}
+
+# Note:
+# You need to set the python path running from command prompt.
+# PYTHONPATH=$PYTHONPATH:<bloomgateway repo> python fallback.py
+if __name__ == "__main__":
+  from scripts.utils import utils as utils
+  endpoint = { "name" : "localhost:80", "params" : {}, "headers" : {} }
+  # valid rule
+  ret, err = utils.validate({"api" : "/api/v1/core/", "errors" : ["500", "502"], "key" : "/api/v1/core/_500_502", "endpoints" : [{ "1" : endpoint }]}, schema)
+  assert (ret == 0)
+  # no errors
+  ret, err = utils.validate({"api" : "/api/v1/core/", "errors" : [], "key" : "/api/v1/core/_", "endpoints" : [{ "1" : endpoint }]}, schema)
+  assert (ret == -2)
+  # error is not a status code
+  ret, err = utils.validate({"api" : "/api/v1/core/", "errors" : ["50"], "key" : "/api/v1/core/_50", "endpoints" : [{ "1" : endpoint }]}, schema)
+  assert (ret == -2)
+  # no endpoints
+  ret, err = utils.validate({"api" : "/api/v1/core/", "errors" : ["500"], "key" : "/api/v1/core/_500", "endpoints" : []}, schema)
+  assert (ret == -2)
+  # endpoint without port
+  ret, err = utils.validate({"api" : "/api/v1/core/", "errors" : ["500"], "key" : "/api/v1/core/_500", "endpoints" : [{ "1" : dict(endpoint, name="localhost") }]}, schema)
+  assert (ret == -2)
+  # exit message
+  print "successfully verified all the Fallback rules."
@@ -42,6 +42,10 @@
 #   "threshold":"7"
 # },
 
+import re
+
+from access import ipv4_pattern
+
 # schema definition
 schema = {
   "definitions" : {
@@ -68,7 +72,7 @@ schema = {
           "type" : "object",
           "properties": {
                 "key" : {"type" : "string", "enum" : ["remote_addr"]},
-                "value" : {"type": "string", "pattern" : "^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$"},
+                "value" : {"type": "string", "pattern" : ipv4_pattern},
           },
           "required": ["key", "value"],
         },
@@ -116,6 +120,32 @@ schema = {
   ],
 }
 
+ipv4_regex = re.compile(ipv4_pattern)
+threshold_regex = re.compile("^[0-9]+$")
+rule_keys = {
+  "node" : frozenset(["type", "threshold"]),
+  "api" : frozenset(["type", "api", "threshold"]),
+  "param" : frozenset(["type", "api", "key", "value", "threshold"]),
+  "header" : frozenset(["type", "api", "key", "value", "threshold"]),
+}
+
+def precheck(rule):
+  """
+  Fast check of the common node, api and param/header rule shapes, True only when the rule is valid.
+  Other rules are left to the schema.
+  """
+  if not isinstance(rule, dict) or not isinstance(rule.get("type"), basestring):
+    return False
+  keys = rule_keys.get(rule["type"])
+  if keys is None or len(rule) != len(keys) or not keys.issuperset(rule):
+    return False
+  for field in keys:
+    if not isinstance(rule[field], basestring):
+      return False
+  if threshold_regex.search(rule["threshold"]) is None:
+    return False
+  return "key" not in keys or rule["key"] != "remote_addr" or ipv4_regex.search(rule["value"]) is not None
+
 # Note:
 # You need to set the python path running from command prompt.
 # PYTHONPATH=$PYTHONPATH:<bloomgateway repo> python ratelimiter.py
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# This python file defines JSON Schema for Router Module of BloomGateay
+# The rule for Router are defined as JSON object which consists of type, api, key,
+# endpoint and either value (exact match) or value_matches (regex match).
+
+# Rule example (exact match)
+# {
+#  "type" : "param",
+#  "api" : "/api/v1/core/",
+#  "key" : "account_id",
+#  "value" : "1234",
+#  "endpoint" : "localhost:8080"
+# }
+
+# Rule example (regex match)
+# {
+#  "type" : "header",
+#  "api" : "/api/v1/core/",
+#  "key" : "X-Account",
+#  "value_matches" : "^12[0-9]+$",
+#  "endpoint" : "localhost:8080"
+# }
+import re
+
+# host:port
+endpoint_pattern = "^[^:]+:[0-9]+$"
+
+# schema definition
+schema = {
+  "definitions" : {
+    "base" : {
+      "properties" : {
+        "type": { "enum": [ "header", "param" ] },
+        "api": { "type": "string", "format": "uri"},
+        "key": { "type": "string" },
+        "endpoint": { "type": "string", "pattern": endpoint_pattern },
+      },
+      "required" : ["type", "api", "key", "endpoint"],
+    },
+    "match" : {
+      "oneOf" : [
+        {
+          "properties": { "value" : {"type": "string"} },
+          "required": ["value"],
+          "not": { "required": ["value_matches"] },
+        },
+        {
+          "properties": { "value_matches" : {"type": "string"} },
+          "required": ["value_matches"],
+          "not": { "required": ["value"] },
+        },
+      ]
+    },
+  },
+
+  "allOf": [
+      { "$ref": "#/definitions/base" },
+      { "$ref": "#/definitions/match" },
+  ],
+}
+
+endpoint_regex = re.compile(endpoint_pattern)
+rule_keys = frozenset(["type", "api", "key", "value", "endpoint"])
+
+def precheck(rule):
+  """
+  Fast check of the common (exact match) rule shape, True only when the rule is valid.
+  Other rules are left to the schema.
+  """
+  if not isinstance(rule, dict) or len(rule) != len(rule_keys) or not rule_keys.issuperset(rule):
+    return False
+  for field in rule_keys:
+    if not isinstance(rule[field], basestring):
+      return False
+  return rule["type"] in ("header", "param") and endpoint_regex.search(rule["endpoint"]) is not None
+
+# Note:
+# You need to set the python path running from command prompt.
+# PYTHONPATH=$PYTHONPATH:<bloomgateway repo> python router.py
+if __name__ == "__main__":
+  from scripts.utils import utils as utils
+  # valid exact match rule
+  ret, err = utils.validate({"type" : "param", "api" : "/api/v1/core/", "key" : "account_id", "value" : "1234", "endpoint" : "localhost:8080"}, schema)
+  assert (ret == 0)
+  # valid regex match rule
+  ret, err = utils.validate({"type" : "header", "api" : "/api/v1/core/", "key" : "X-Account", "value_matches" : "^12", "endpoint" : "localhost:8080"}, schema)
+  assert (ret == 0)
+  # both value and value_matches
+  ret, err = utils.validate({"type" : "param", "api" : "/", "key" : "account_id", "value" : "1", "value_matches" : "^1", "endpoint" : "localhost:8080"}, schema)
+  assert (ret == -2)
+  # neither value nor value_matches
+  ret, err = utils.validate({"type" : "param", "api" : "/", "key" : "account_id", "endpoint" : "localhost:8080"}, schema)
+  assert (ret == -2)
+  # endpoint without port
+  ret, err = utils.validate({"type" : "param", "api" : "/", "key" : "account_id", "value" : "1", "endpoint" : "localhost"}, schema)
+  assert (ret == -2)
+  # exit message
+  print "successfully verified all the Router rules."
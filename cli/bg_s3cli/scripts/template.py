@@ -19,6 +19,17 @@
 #This module will generate nginx.conf file from a template
 from string import Template
 
+def render_nginx_conf(infile, dict):
+  """
+  Takes the replacement dict of key-value pair which can be substituted
+  to python string template, and returns the rendered content.
+  @infile : template file of python string template format
+  @dict : substitution key-value pairs
+  """
+  with open(infile, "r") as file:
+    content = Template( file.read() )
+    return content.substitute(dict)
+
 def build_nginx_conf(infile, outfile, dict):
   """
   Takes the replacement dict of key-value pair which can be substituted
@@ -27,10 +38,7 @@ def build_nginx_conf(infile, outfile, dict):
   @outfile : output file
   @dict : substitution key-value pairs
   """
-  outdata = None
-  with open(infile, "r") as file:
-    content = Template( file.read() )
-    outdata  = content.substitute(dict)
+  outdata = render_nginx_conf(infile, dict)
 
   with open(outfile, "w") as file:
     file.write(outdata)
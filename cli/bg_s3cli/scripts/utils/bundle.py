@@ -0,0 +1,108 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Node bootstrap bundle : a tar.gz of nginx.conf, rules of all the modules, version.json and a manifest.
+# Every tar member is compressed as its own gzip segment, and a concatenation of gzip segments is
+# a valid gzip stream (tar -xzf reads it as one), so the segments of unchanged members are reused
+# from the previous bundle as is, and only the changed members are packed.
+import tarfile
+import zlib
+
+import codec
+import stream
+
+MANIFEST = "manifest.json"
+
+# end of tar archive, two zero blocks
+END_SEGMENT = codec.encode("\0" * tarfile.BLOCKSIZE * 2, codec.GZIP)
+
+def pack_member(name, contents):
+  """
+  Gives the gzip segment of a tar member (header, contents and padding)
+  """
+  return pack_member_chunks(name, len(contents), [contents])
+
+def pack_member_chunks(name, size, chunks):
+  """
+  Gives the gzip segment of a tar member of size bytes, compressed from the chunks of its contents
+  as they come, so the plain contents are never built as a single string
+  """
+  info = tarfile.TarInfo(name)
+  info.size = size
+  info.mode = 0644
+  encoder = codec.get_encoder(codec.GZIP)
+  parts = [encoder.compress(info.tobuf(format=tarfile.USTAR_FORMAT))]
+  written = 0
+  for chunk in chunks:
+    written += len(chunk)
+    parts.append(encoder.compress(chunk))
+  if written != size:
+    raise ValueError("tar member %s has %d bytes, expected %d" % (name, written, size))
+  padding = (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+  parts.append(encoder.compress("\0" * padding))
+  parts.append(encoder.flush())
+  return "".join(parts)
+
+def pack_spool(name, spool):
+  """
+  Gives the gzip segment of a tar member of the plain contents of a finished spool (see stream.Spool),
+  decoded chunk by chunk
+  """
+  reader = spool.open_reader()
+  return pack_member_chunks(name, spool.size, stream.iter_decoded(iter(lambda: reader.read(stream.CHUNK_SIZE), "")))
+
+def read_member(segment):
+  """
+  Gives (name, contents) of the tar member of a gzip segment
+  """
+  data = codec.decode(segment)
+  info = tarfile.TarInfo.frombuf(data[:tarfile.BLOCKSIZE])
+  return info.name, data[tarfile.BLOCKSIZE:tarfile.BLOCKSIZE + info.size]
+
+def unpack_segments(bundle):
+  """
+  Splits a bundle into its gzip segments, gives dict of member name to its segment
+  """
+  segments = {}
+  offset = 0
+  while offset < len(bundle):
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    header = decoder.decompress(bundle[offset:offset + 64 * 1024], tarfile.BLOCKSIZE)
+    # decode the rest of the segment only to find where it ends
+    pending = decoder.unconsumed_tail
+    end = offset + 64 * 1024
+    while not decoder.unused_data and (pending or end < len(bundle)):
+      if not pending:
+        pending = bundle[end:end + 64 * 1024]
+        end += 64 * 1024
+      decoder.decompress(pending, 64 * 1024)
+      pending = decoder.unconsumed_tail
+    segment_end = min(end, len(bundle)) - len(decoder.unused_data)
+    if header.strip("\0"):
+      segments[tarfile.TarInfo.frombuf(header).name] = bundle[offset:segment_end]
+    offset = segment_end
+  return segments
+
+def spool(members):
+  """
+  Spools the bundle of (name, segment) pairs in order, spooled to a temporary file once it is large,
+  returns the finished spool to be streamed
+  """
+  bundle_spool = stream.Spool()
+  for _, segment in members:
+    bundle_spool.write(segment)
+  bundle_spool.write(END_SEGMENT)
+  return bundle_spool.close()
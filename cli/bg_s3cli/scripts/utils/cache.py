@@ -0,0 +1,113 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# On-disk cache of s3 objects keyed by s3 path.
+# Each object is stored as a file named by sha1 of its s3 path, and index.json keeps
+# etag, size and last access time of every cached object for revalidation and LRU eviction.
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+class ObjectCache(object):
+  """
+  Size bounded on-disk cache of s3 objects with LRU eviction
+  """
+  index_file = "index.json"
+
+  def __init__(self, directory, max_bytes):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.stats = { "hits" : 0, "misses" : 0, "revalidated" : 0, "evictions" : 0 }
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.index = self.load_index()
+
+  def load_index(self):
+    try:
+      with open(os.path.join(self.directory, ObjectCache.index_file), "r") as infile:
+        return json.load(infile)
+    except (IOError, ValueError):
+      return {}
+
+  def save_index(self):
+    """
+    Writes the index with write-then-rename so a concurrent reader never sees a partial index
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+    with os.fdopen(fd, "w") as outfile:
+      json.dump(self.index, outfile)
+    os.rename(tmp_path, os.path.join(self.directory, ObjectCache.index_file))
+
+  def get_file(self, s3path):
+    return os.path.join(self.directory, hashlib.sha1(s3path).hexdigest())
+
+  def lookup(self, s3path):
+    """
+    Gives (contents, etag) of the cached object, (None, None) if it is not cached
+    """
+    with self.lock:
+      entry = self.index.get(s3path)
+      if entry is None:
+        return None, None
+      try:
+        with open(self.get_file(s3path), "rb") as infile:
+          contents = infile.read()
+      except IOError:
+        del self.index[s3path]
+        return None, None
+      entry["atime"] = time.time()
+      self.save_index()
+      return contents, entry.get("etag")
+
+  def store(self, s3path, contents, etag):
+    """
+    Caches the contents of s3path, and evicts the least recently used objects beyond max_bytes
+    """
+    if len(contents) > self.max_bytes:
+      return
+    with self.lock:
+      fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+      with os.fdopen(fd, "wb") as outfile:
+        outfile.write(contents)
+      os.rename(tmp_path, self.get_file(s3path))
+      self.index[s3path] = { "etag" : etag, "size" : len(contents), "atime" : time.time() }
+      self.evict()
+      self.save_index()
+
+  def evict(self):
+    total = sum(entry["size"] for entry in self.index.values())
+    for s3path, entry in sorted(self.index.items(), key=lambda item: item[1]["atime"]):
+      if total <= self.max_bytes:
+        break
+      total -= entry["size"]
+      del self.index[s3path]
+      self.stats["evictions"] += 1
+      try:
+        os.remove(self.get_file(s3path))
+      except OSError:
+        pass
+
+  def record(self, stat):
+    with self.lock:
+      self.stats[stat] += 1
+
+  def get_stats(self):
+    with self.lock:
+      return dict(self.stats)
@@ -0,0 +1,87 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Encoding (compression) of rules and nginx.conf artifacts.
+# The encoding is recorded in object metadata, and decoding detects it from the magic bytes,
+# so encoded and plain artifacts can be read the same way (json and nginx.conf never start with them).
+import zlib
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+ENCODINGS = [GZIP, ZSTD]
+
+GZIP_MAGIC = "\x1f\x8b"
+ZSTD_MAGIC = "\x28\xb5\x2f\xfd"
+
+# smaller contents are kept plain, encoding them saves nothing
+MIN_BYTES = 1024
+
+def get_encoder(encoding, level=None):
+  """
+  Incremental encoder (compress/flush) of given encoding (gzip/zstd)
+  """
+  if encoding == GZIP:
+    return zlib.compressobj(level if level is not None else 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  elif encoding == ZSTD:
+    if zstandard is None:
+      raise ValueError("zstd encoding needs zstandard python package")
+    return zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+  raise ValueError("Un-supported encoding %s, supported encodings are (%s)" % (encoding, "/".join(ENCODINGS)))
+
+def get_decoder(encoding):
+  """
+  Incremental decoder (decompress) of given encoding, None for plain contents
+  """
+  if encoding == GZIP:
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  if encoding == ZSTD:
+    if zstandard is None:
+      raise ValueError("zstd encoded contents needs zstandard python package")
+    return zstandard.ZstdDecompressor().decompressobj()
+  return None
+
+def encode(contents, encoding, level=None):
+  """
+  Encodes the contents with given encoding (gzip/zstd)
+  """
+  encoder = get_encoder(encoding, level)
+  return encoder.compress(contents) + encoder.flush()
+
+def get_encoding(contents):
+  """
+  Detects the encoding of contents from its magic bytes, None for plain contents
+  """
+  if contents.startswith(GZIP_MAGIC):
+    return GZIP
+  if contents.startswith(ZSTD_MAGIC):
+    return ZSTD
+  return None
+
+def decode(contents):
+  """
+  Decodes gzip/zstd encoded contents, plain contents are returned as is
+  """
+  if contents is None:
+    return None
+  decoder = get_decoder(get_encoding(contents))
+  if decoder is None:
+    return contents
+  return decoder.decompress(contents)
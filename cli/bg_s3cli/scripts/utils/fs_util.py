@@ -0,0 +1,389 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# helper functions for the local filesystem, with the same interface as s3_util.
+# A file:///a/b path is key a/b of the "bucket" /, i.e. the root directory. Every write goes to
+# a temporary file which is renamed over the target, so readers never see a partial file.
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from transfer import record, run_parallel, MAX_WORKERS, DELETE_BATCH_SIZE, READ_CHUNK_SIZE
+
+SCHEME = "file://"
+ROOT = "/"
+
+# mode of the written files, mkstemp creates them readable by the owner only while the nodes
+# (nginx) and the other users of the directory read them
+FILE_MODE = 0644
+
+fileregex = re.compile("file://(/.*)")
+def parse_path(path):
+  m = fileregex.match(path)
+  if m:
+    return (ROOT, m.group(1)[1:])
+  else:
+    raise RuntimeError("Invalid file path: %s" % path)
+
+def get_local_path(path):
+  b_name, k_name = parse_path(path)
+  return os.path.join(b_name, k_name)
+
+class FileKey(object):
+  """
+  A listed file, with the attributes of boto key used by the callers
+  """
+  def __init__(self, name, size, mtime):
+    self.name = name
+    self.size = size
+    self.mtime = mtime
+
+def get_etag(contents):
+  """
+  md5 of the contents, same as etag of s3 objects uploaded with a single PUT
+  """
+  return '"%s"' % hashlib.md5(contents).hexdigest()
+
+def read_file(local_path):
+  """
+  Contents of the file, None if it does not exist
+  """
+  try:
+    with open(local_path, "rb") as infile:
+      return infile.read()
+  except IOError, e:
+    if e.errno == errno.ENOENT:
+      return None
+    raise
+
+def write_file(local_path, write):
+  """
+  Writes the file with write(fp) into a temporary file, renamed over the target once it is complete
+  """
+  directory, name = os.path.split(local_path)
+  if not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+  fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".%s." % name, suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wb") as outfile:
+      os.fchmod(outfile.fileno(), FILE_MODE)
+      write(outfile)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+    os.rename(tmp_path, local_path)
+  except Exception:
+    os.remove(tmp_path)
+    raise
+
+############################################
+# get method to get content from file path #
+############################################
+
+def get_item(path):
+  """
+  Get file as a key with name, size and mtime; None if file does not exist
+  """
+  b_name, k_name = parse_path(path)
+  record("HEAD")
+  try:
+    stat = os.stat(os.path.join(b_name, k_name))
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return None
+    raise
+  return FileKey(k_name, stat.st_size, stat.st_mtime)
+
+def get_item_to_string(path):
+  """
+  Get file as a string; None if file does not exist.
+  """
+  return get_item_with_etag(path)[0]
+
+def get_item_with_etag(path):
+  """
+  Get file as (contents, etag); (None, None) if file does not exist.
+  """
+  contents = read_file(get_local_path(path))
+  if contents is None:
+    record("GET")
+    return None, None
+  record("GET", len(contents))
+  return contents, get_etag(contents)
+
+def iter_item_chunks(path, chunk_size=READ_CHUNK_SIZE):
+  """
+  Generates the contents of file chunk by chunk
+  """
+  num_bytes = 0
+  try:
+    with open(get_local_path(path), "rb") as infile:
+      while True:
+        chunk = infile.read(chunk_size)
+        if not chunk:
+          break
+        num_bytes += len(chunk)
+        yield chunk
+  finally:
+    record("GET", num_bytes)
+
+def get_item_if_modified(path, etag=None):
+  """
+  Get file if its etag is not the given etag.
+  returns (True, contents, etag) when modified, (False, None, etag) when it still matches given etag,
+  and (True, None, None) if file does not exist
+  """
+  contents, new_etag = get_item_with_etag(path)
+  if contents is not None and etag is not None and new_etag == etag:
+    return False, None, etag
+  return True, contents, new_etag
+
+def get_json_to_obj(path):
+  """
+  Get json file as python object; None if file does not exist.
+  """
+  obj = get_item_to_string(path)
+  if obj is None:
+    return None
+  try:
+    return json.loads(obj)
+  except ValueError, e:
+    raise ValueError("Error while converting to json for %s : %s" % (path, e))
+
+def delete_item(path):
+  """
+  delete the file, deleting a missing file is not an error
+  """
+  record("DELETE")
+  try:
+    os.remove(get_local_path(path))
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+
+def list_keys(path):
+  """
+  Generates the keys of all the files under path prefix, in the order of their names.
+  Temporary and lock files (dot files) are skipped.
+  """
+  b_name, prefix = parse_path(path)
+  record("LIST")
+  local_prefix = os.path.join(b_name, prefix)
+  directory = local_prefix if local_prefix.endswith("/") else os.path.dirname(local_prefix)
+  names = []
+  for dirpath, dirnames, filenames in os.walk(directory):
+    for filename in filenames:
+      local_path = os.path.join(dirpath, filename)
+      if filename.startswith(".") or not local_path.startswith(local_prefix):
+        continue
+      names.append(local_path)
+  for local_path in sorted(names):
+    try:
+      stat = os.stat(local_path)
+    except OSError:
+      continue
+    yield FileKey(local_path[len(b_name):], stat.st_size, stat.st_mtime)
+
+def list_prefixes(path):
+  """
+  Generates the names of the sub directories of path directory, in the order of their names
+  """
+  local_path = get_local_path(path)
+  record("LIST")
+  try:
+    names = sorted(os.listdir(local_path))
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return
+    raise
+  for name in names:
+    if not name.startswith(".") and os.path.isdir(os.path.join(local_path, name)):
+      yield name
+
+def get_last_modified(key):
+  """
+  Gives the last modified time of a listed key as seconds since epoch
+  """
+  return key.mtime
+
+def delete_dir(path, max_workers=MAX_WORKERS, batch_size=DELETE_BATCH_SIZE):
+  """
+  Delete all the files under path, and then their lock files and the emptied directories.
+  returns (number of deleted files, list of failures), each failure is a dict of key, code and message
+  """
+  b_name, prefix = parse_path(path)
+  result = delete_key_names(b_name, (key.name for key in list_keys(path)), max_workers, batch_size)
+  local_prefix = os.path.join(b_name, prefix)
+  if local_prefix.endswith("/") and os.path.isdir(local_prefix):
+    for dirpath, dirnames, filenames in os.walk(local_prefix, topdown=False):
+      for filename in filenames:
+        if filename.startswith(".") and filename.endswith(".lock"):
+          os.remove(os.path.join(dirpath, filename))
+      if not os.listdir(dirpath):
+        os.rmdir(dirpath)
+  return result
+
+def delete_key_names(b_name, k_names, max_workers=MAX_WORKERS, batch_size=DELETE_BATCH_SIZE):
+  """
+  Deletes the files of given names relative to b_name directory, along with their directory once it is empty.
+  returns (number of deleted files, list of failures), each failure is a dict of key, code and message
+  """
+  deleted = 0
+  failures = []
+  for k_name in k_names:
+    local_path = os.path.join(b_name, k_name)
+    try:
+      os.remove(local_path)
+      deleted += 1
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        failures.append({"key" : k_name, "code" : errno.errorcode.get(e.errno, str(e.errno)), "message" : e.strerror})
+        continue
+      deleted += 1
+    try:
+      os.rmdir(os.path.dirname(local_path))
+    except OSError:
+      pass # not empty
+  record("DELETE")
+  return deleted, failures
+
+##########################################
+# Helper method to put contents to file #
+##########################################
+
+def put_obj_to_json(path, contents):
+  """
+  put json content to file
+  """
+  try:
+    obj = json.dumps(contents)
+  except Exception, e:
+    print "Error : invalid json data, failed in conversion"
+    return False
+  return put_item_from_string(path, obj)
+
+def put_item_from_string(path, contents, encoding=None):
+  """
+  put the string content into given file.
+  encoding is detected from the contents when they are read, it is not recorded
+  """
+  write_file(get_local_path(path), lambda outfile: outfile.write(contents))
+  record("PUT", len(contents))
+  print >> sys.stderr, "fs_util.py: put (string) %s" % path
+  return True
+
+def put_item_if_match(path, contents, etag):
+  """
+  Conditional put (compare-and-swap) of string content to file, it is written only if the
+  file still has given etag, or does not exist yet when etag is None. Writers of a file are
+  serialized with a lock file next to it, and the file is replaced by an atomic rename.
+  returns False when the condition failed, i.e. the file is changed by another writer.
+  """
+  local_path = get_local_path(path)
+  directory, name = os.path.split(local_path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  with open(os.path.join(directory, ".%s.lock" % name), "a") as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+      current = read_file(local_path)
+      current_etag = get_etag(current) if current is not None else None
+      if current_etag != etag:
+        record("PUT")
+        return False
+      write_file(local_path, lambda outfile: outfile.write(contents))
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+  record("PUT", len(contents))
+  print >> sys.stderr, "fs_util.py: put (if-match) %s" % path
+  return True
+
+def put_item_from_file_pointer(path, fp):
+  """
+  put the content of file pointed by file pointer to path
+  """
+  start = fp.tell()
+  write_file(get_local_path(path), lambda outfile: shutil.copyfileobj(fp, outfile))
+  record("PUT", fp.tell() - start)
+  print >> sys.stderr, "fs_util.py: put %s %s" % (fp.name, path)
+  return True
+
+def put_item_from_stream(path, fp, size, encoding=None, part_size=None):
+  """
+  put size bytes of file pointer to path, copied chunk by chunk
+  """
+  def copy(outfile):
+    remaining = size
+    while remaining > 0:
+      chunk = fp.read(min(READ_CHUNK_SIZE, remaining))
+      if not chunk:
+        raise IOError("Stream ended %d bytes short of %d" % (remaining, size))
+      outfile.write(chunk)
+      remaining -= len(chunk)
+  write_file(get_local_path(path), copy)
+  record("PUT", size)
+  print >> sys.stderr, "fs_util.py: put (stream) %s" % path
+  return True
+
+def copy_item(src_path, dest_path):
+  """
+  Copy of a file
+  """
+  src_local_path = get_local_path(src_path)
+  def copy(outfile):
+    with open(src_local_path, "rb") as infile:
+      shutil.copyfileobj(infile, outfile)
+  write_file(get_local_path(dest_path), copy)
+  record("COPY")
+  print >> sys.stderr, "fs_util.py: cp %s %s" % (src_path, dest_path)
+  return True
+
+def touch_item(path):
+  """
+  Refreshes the last modified time of the file, returns False if the file does not exist
+  """
+  record("COPY")
+  try:
+    os.utime(get_local_path(path), None)
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return False
+    raise
+  print >> sys.stderr, "fs_util.py: touch %s" % path
+  return True
+
+def copy_items(items, max_workers=MAX_WORKERS):
+  """
+  Copy of the (source path, destination path) pairs in parallel.
+  Raises exception if any of the copy fails, once all of them are finished.
+  """
+  run_parallel([lambda src=src, dest=dest: copy_item(src, dest) for src, dest in items], max_workers)
+
+def put_items_from_strings(items, max_workers=MAX_WORKERS):
+  """
+  put the (path, string content) pairs in parallel.
+  Raises exception if any of the put fails, once all of them are finished.
+  """
+  run_parallel([lambda path=path, contents=contents: put_item_from_string(path, contents) for path, contents in items], max_workers)
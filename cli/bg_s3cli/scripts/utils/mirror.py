@@ -0,0 +1,142 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Local SQLite mirror of the current rules of all the clusters, for queries across clusters.
+# modules table keeps the version (and journal segments) of every mirrored module, so a sync
+# only fetches the modules whose version changed since the last sync.
+import json
+import os
+import sqlite3
+
+import storage
+import utils
+from bg_s3cli.conf import s3
+
+SCHEMA = [
+  "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)",
+  "CREATE TABLE IF NOT EXISTS modules (cluster TEXT, phase TEXT, module TEXT, version TEXT, journal TEXT, PRIMARY KEY (cluster, phase, module))",
+  "CREATE TABLE IF NOT EXISTS rules (cluster TEXT, phase TEXT, module TEXT, type TEXT, api TEXT, key TEXT, value TEXT, threshold INTEGER, rule TEXT)",
+  "CREATE INDEX IF NOT EXISTS rules_module_api ON rules (module, api)",
+  "CREATE INDEX IF NOT EXISTS rules_key_value ON rules (key, value)",
+  "CREATE INDEX IF NOT EXISTS rules_cluster_module ON rules (cluster, module)",
+]
+
+# filters of query, matched exactly or as a glob pattern when they have * or ?
+FILTERS = ["cluster", "module", "api", "key", "value"]
+
+def to_threshold(rule):
+  """
+  Gives the threshold of a ratelimiter rule as a number, None for the other rules
+  """
+  try:
+    return int(rule.get("threshold"))
+  except (TypeError, ValueError):
+    return None
+
+class RuleMirror(object):
+  """
+  Mirror of the current rules of all the clusters in a local indexed SQLite database
+  """
+
+  def __init__(self, db_path):
+    directory = os.path.dirname(os.path.abspath(db_path))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.db = sqlite3.connect(db_path)
+    for statement in SCHEMA:
+      self.db.execute(statement)
+    self.db.commit()
+
+  def reset_if_moved(self, base_path):
+    """
+    Drops the mirrored rules when they were mirrored from another base path
+    """
+    row = self.db.execute("SELECT value FROM meta WHERE name = 'base_path'").fetchone()
+    if row is not None and row[0] == base_path:
+      return
+    self.db.execute("DELETE FROM modules")
+    self.db.execute("DELETE FROM rules")
+    self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('base_path', ?)", (base_path,))
+
+  def sync(self):
+    """
+    Mirrors the current rules of all the clusters. version.json of the clusters are read in parallel,
+    and only the modules whose version or journal segments changed are fetched, the rules of the
+    clusters which do not exist anymore are dropped. All the changes are applied in one transaction.
+    returns dict of the number of clusters, fetched, unchanged and removed modules, and mirrored rules
+    """
+    base_path = s3.get_cluster_info_base_path()
+    cluster_ids = list(storage.list_prefixes(base_path + "/"))
+    contents = storage.run_parallel([lambda cluster_id=cluster_id: utils.get_decoded_contents(utils.get_version_path(cluster_id)) for cluster_id in cluster_ids])
+
+    current = {}
+    for cluster_id, version_contents in zip(cluster_ids, contents):
+      if version_contents is None:
+        # partially created or deleted cluster
+        continue
+      version_data_dict = json.loads(version_contents)
+      for phase, phase_modules in version_data_dict["modules"].items():
+        for module, module_version in phase_modules.items():
+          current[(cluster_id, phase, module)] = (module_version, utils.get_journal_segments(version_data_dict, phase, module))
+
+    self.reset_if_moved(base_path)
+    mirrored = dict(((cluster_id, phase, module), (version, json.loads(journal)))
+                    for cluster_id, phase, module, version, journal in self.db.execute("SELECT cluster, phase, module, version, journal FROM modules"))
+    changed = [name for name, version in current.items() if mirrored.get(name) != version]
+    removed = [name for name in mirrored if name not in current]
+    fetched = storage.run_parallel([lambda name=name: utils.get_existing_rules(name[0], name[1], name[2], current[name][0], current[name][1]) for name in changed])
+
+    stats = { "clusters" : len(set(name[0] for name in current)), "fetched" : len(changed), "unchanged" : len(current) - len(changed), "removed" : len(removed), "rules" : 0 }
+    with self.db:
+      for cluster_id, phase, module in removed + changed:
+        self.db.execute("DELETE FROM rules WHERE cluster = ? AND module = ? AND phase = ?", (cluster_id, module, phase))
+        self.db.execute("DELETE FROM modules WHERE cluster = ? AND module = ? AND phase = ?", (cluster_id, module, phase))
+      for (cluster_id, phase, module), rules in zip(changed, fetched):
+        version, segments = current[(cluster_id, phase, module)]
+        self.db.execute("INSERT INTO modules (cluster, phase, module, version, journal) VALUES (?, ?, ?, ?, ?)", (cluster_id, phase, module, version, json.dumps(segments)))
+        self.db.executemany("INSERT INTO rules (cluster, phase, module, type, api, key, value, threshold, rule) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+          [(cluster_id, phase, module, rule.get("type"), rule.get("api"), rule.get("key"), rule.get("value"), to_threshold(rule), json.dumps(rule, sort_keys=True)) for rule in rules])
+      stats["rules"] = self.db.execute("SELECT COUNT(*) FROM rules").fetchone()[0]
+    return stats
+
+  def query(self, filters, threshold_above=None, threshold_below=None):
+    """
+    Gives [(cluster, module, rule)] of the mirrored rules matching all the given filters,
+    a dict of cluster, module, api, key and value, and the bounds (exclusive) of threshold
+    """
+    conditions = []
+    params = []
+    for name in FILTERS:
+      pattern = filters.get(name)
+      if pattern is None:
+        continue
+      conditions.append("%s %s ?" % (name, "GLOB" if "*" in pattern or "?" in pattern else "="))
+      params.append(pattern)
+    if threshold_above is not None:
+      conditions.append("threshold > ?")
+      params.append(threshold_above)
+    if threshold_below is not None:
+      conditions.append("threshold < ?")
+      params.append(threshold_below)
+
+    sql = "SELECT cluster, module, rule FROM rules"
+    if conditions:
+      sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY cluster, module, rowid"
+    return [(cluster_id, module, json.loads(rule)) for cluster_id, module, rule in self.db.execute(sql, params)]
+
+  def close(self):
+    self.db.close()
@@ -23,6 +23,10 @@ rule_uri = "rule_uri"
 rule_threshold = "rule_threshold"
 rule_access = "rule_access"
 rule_endpoint = "rule_endpoint"
+rule_errors = "rule_errors"
+rule_fallbacks = "rule_fallbacks"
+rule_params = "rule_params"
+rule_headers = "rule_headers"
 
 access_phase = "access"
 error_phase = "error"
@@ -33,25 +37,202 @@ access_module = "access"
 router_module = "router"
 fallback_module = "fallback"
 
-def rule_present(existing_rules, rule):
-  """Checks if rule is present in existing_rules
-  return True, index is present
-  return False,-1 if absent
-  """
-  index = 0
-  response = False, -1
-  for existing_rule in existing_rules:
-    if (existing_rule[ModuleRule.type] == rule[ModuleRule.type] and existing_rule[ModuleRule.key] == rule[ModuleRule.key]
-        and existing_rule[ModuleRule.value] == rule[ModuleRule.value] and existing_rule[ModuleRule.api] == rule[ModuleRule.api]):
-      response = True, index
-      break
-    index = index+1
+# phase in which each module is registered
+module_phases = {
+  ratelimiter_module : access_phase,
+  access_module : access_phase,
+  router_module : access_phase,
+  fallback_module : error_phase,
+}
+
+def rule_identity(module, rule):
+  """
+  Gives the identity of a rule within a module. Two rules with same identity
+  can not co-exist, the later one overrides the former one in the plugin.
+  """
+  if module == fallback_module:
+    return (rule.get("api"), tuple(sorted(rule.get("errors", []))))
+  return (rule.get(ModuleRule.type), rule.get(ModuleRule.key), rule.get(ModuleRule.value), rule.get(ModuleRule.api), rule.get("value_matches"))
+
+class RuleSet(object):
+  """
+  Rules of a module indexed by their identity (type, key, value, api, see rule_identity) for O(1)
+  lookup, upsert and delete, keeping the order of insertion for serialization. An upsert moves the
+  rule to the end, same as the plugin reading the rules in order. Deleted rules leave a hole in
+  the ordered list, which is compacted once half of it are holes.
+  """
+
+  module = None
+
+  def __init__(self, rules=()):
+    self.rules = []
+    self.index = {}
+    self.holes = 0
+    for rule in rules:
+      self.upsert(rule)
+
+  @classmethod
+  def identity(cls, rule):
+    return rule_identity(cls.module, rule)
+
+  def __len__(self):
+    return len(self.index)
+
+  def __iter__(self):
+    return (rule for rule in self.rules if rule is not None)
+
+  def __contains__(self, rule):
+    return self.identity(rule) in self.index
+
+  def get(self, rule):
+    """
+    Gives the rule with same identity as rule, None if there is none
+    """
+    position = self.index.get(self.identity(rule))
+    return self.rules[position] if position is not None else None
+
+  def upsert(self, rule):
+    """
+    Adds the rule, replacing the rule with same identity. returns the replaced rule, None if it is new
+    """
+    identity = self.identity(rule)
+    previous = self.pop(identity)
+    self.index[identity] = len(self.rules)
+    self.rules.append(rule)
+    return previous
+
+  def delete(self, rule):
+    """
+    Deletes the rule with same identity as rule. returns the deleted rule, None if there is none
+    """
+    return self.pop(self.identity(rule))
+
+  def pop(self, identity):
+    position = self.index.pop(identity, None)
+    if position is None:
+      return None
+    rule = self.rules[position]
+    self.rules[position] = None
+    self.holes += 1
+    if self.holes > len(self.rules) / 2:
+      self.compact()
+    return rule
+
+  def compact(self):
+    self.rules = list(self)
+    self.index = dict((self.identity(rule), position) for position, rule in enumerate(self.rules))
+    self.holes = 0
+
+  def to_list(self):
+    return list(self)
+
+class FallbackRuleSet(RuleSet):
+  """
+  Fallback rules indexed by api and then by their exact set of error codes, along with the rule of
+  every (api, error code), so both the exact match and the overlap of error codes are O(1) lookups.
+  The error codes of the rules of an api never overlap, a rule which overlaps another is rejected.
+  """
+
+  module = fallback_module
+
+  def __init__(self, rules=()):
+    self.errors = {}
+    super(FallbackRuleSet, self).__init__(rules)
+
+  def find(self, rule):
+    """
+    Gives (rule with same api and errors, None) on exact match, (None, a rule with same api and some of
+    the errors) on overlap, and (None, None) when no rule of the api has any of the errors
+    """
+    exact = self.get(rule)
+    if exact is not None:
+      return exact, None
+    for error in rule["errors"]:
+      identity = self.errors.get((rule["api"], error))
+      if identity is not None:
+        return None, self.rules[self.index[identity]]
+    return None, None
+
+  def upsert(self, rule):
+    previous = super(FallbackRuleSet, self).upsert(rule)
+    identity = self.identity(rule)
+    for error in identity[1]:
+      self.errors[(identity[0], error)] = identity
+    return previous
+
+  def pop(self, identity):
+    rule = super(FallbackRuleSet, self).pop(identity)
+    if rule is not None:
+      for error in identity[1]:
+        if self.errors.get((identity[0], error)) == identity:
+          del self.errors[(identity[0], error)]
+    return rule
 
-  return response
+def build_rule_set(module, rules):
+  """
+  Gives the indexed rules of a module to apply add/remove of rules on
+  """
+  if module == fallback_module:
+    return FallbackRuleSet(rules)
+  return RuleSet(rules)
+
+def diff_rules(module, existing_rules, desired_rules):
+  """
+  Computes the changes needed to turn existing_rules into desired_rules, in the order of the rules.
+  returns a dict with "add" and "remove" list of rules, and "update" list of (old rule, new rule)
+  """
+  existing = build_rule_set(module, existing_rules)
+  desired = build_rule_set(module, desired_rules)
 
-def rule_already_present(rule1, rule2):
-  for key in rule1.keys():
-    if rule1[key] != rule2[key]:
-      return False
+  plan = { "add" : [], "remove" : [], "update" : [] }
+  for rule in desired:
+    existing_rule = existing.get(rule)
+    if existing_rule is None:
+      plan["add"].append(rule)
+    elif existing_rule != rule:
+      plan["update"].append((existing_rule, rule))
 
-  return True
\ No newline at end of file
+  plan["remove"] = [rule for rule in existing if rule not in desired]
+  return plan
+
+def is_empty_plan(plan):
+  return not (plan["add"] or plan["remove"] or plan["update"])
+
+def get_delta(module, existing_rules, rules):
+  """
+  Gives the delta which turns existing_rules into rules, as a list of [method, rule] to be replayed
+  in order by apply_delta. The rules removed come first, in their existing order. The longest prefix of
+  rules which are unchanged and already in the same relative order stays in place, every later rule is
+  added in order, an add moving the rule to the end (see RuleSet), so the replay gives rules in the
+  same order, which the router evaluates its patterns in.
+  """
+  existing = build_rule_set(module, existing_rules)
+  desired = build_rule_set(module, rules)
+  delta = [["remove", rule] for rule in existing if rule not in desired]
+
+  positions = dict((existing.identity(rule), position) for position, rule in enumerate(existing))
+  desired_rules = desired.to_list()
+  kept = 0
+  last_position = -1
+  for rule in desired_rules:
+    position = positions.get(existing.identity(rule))
+    if position is None or position < last_position or existing.get(rule) != rule:
+      break
+    last_position = position
+    kept += 1
+
+  delta.extend(["add", rule] for rule in desired_rules[kept:])
+  return delta
+
+def apply_delta(module, rules, delta):
+  """
+  Replays a delta on rules with the semantics of RuleSet : add replaces the rule with same identity
+  and moves it to the end, remove drops the rule with same identity.
+  """
+  rule_set = build_rule_set(module, rules)
+  for method, rule in delta:
+    if method == "add":
+      rule_set.upsert(rule)
+    else:
+      rule_set.delete(rule)
+  return rule_set.to_list()
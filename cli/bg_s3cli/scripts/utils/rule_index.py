@@ -0,0 +1,158 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Precompiled lookup index of the rules of a module, for the nginx plugins (src/bb-node/lualib/bb/plugins).
+# Every plugin builds its lookup tables from the rules in init, on every worker at every reload. The index
+# holds these tables exactly as the plugin builds them, and is pushed next to the rules of a version
+# (<module>.index), so a plugin loads them with a single json decode. The compilers follow the plugins
+# rule by rule, a later rule overrides an earlier one the same way.
+import json
+
+FORMAT = 1
+SUFFIX = ".index"
+
+def to_number(value):
+  """
+  Threshold the way lua tonumber reads it, None when it is not a number
+  """
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    pass
+  try:
+    number = float(value)
+  except (TypeError, ValueError):
+    return None
+  if number != number or number in (float("inf"), float("-inf")):
+    return None
+  return number
+
+def set_threshold(table, key, threshold):
+  # a lua table drops the key set to nil
+  number = to_number(threshold)
+  if number is None:
+    table.pop(key, None)
+  else:
+    table[key] = number
+
+def build_threshold_key(api, field_type, field_name, field_value):
+  return "%s%s%s%s" % (api, field_type, field_name, field_value)
+
+def compile_access(rules):
+  """
+  rules[api].param|header[key][value] = value of access.lua
+  """
+  tables = {}
+  for rule in rules:
+    if rule.get("type") not in ("param", "header"):
+      continue
+    api_rules = tables.setdefault(rule["api"], { "param" : {}, "header" : {} })
+    api_rules[rule["type"]].setdefault(rule["key"], {})[rule["value"]] = rule["value"]
+  return { "rules" : tables }
+
+def compile_ratelimiter(rules):
+  """
+  Thresholds of node, api and flattened api..type..key..value keys, and per api key/value sets of
+  params and headers, of ratelimiter.lua. A * value is the base rule of its key.
+  """
+  tables = dict((name, {}) for name in ("node", "api", "param", "params_key_values", "header", "headers_key_values"))
+  for rule in rules:
+    rule_type = rule.get("type")
+    if rule_type == "node":
+      set_threshold(tables["node"], "node", rule.get("threshold"))
+    elif rule_type == "api":
+      set_threshold(tables["api"], rule["api"], rule.get("threshold"))
+    elif rule_type in ("param", "header"):
+      set_threshold(tables[rule_type], build_threshold_key(rule["api"], rule_type, rule["key"], rule["value"]), rule.get("threshold"))
+      key_values = tables["params_key_values" if rule_type == "param" else "headers_key_values"]
+      key_values.setdefault(rule["api"], {}).setdefault(rule["key"], {})[rule["value"]] = True
+  return tables
+
+def compile_router(rules):
+  """
+  [api][key].exact_values|regex_values[value] = endpoint of params and headers, of router.lua
+  """
+  tables = { "param" : {}, "header" : {} }
+  for rule in rules:
+    if rule.get("type") not in ("param", "header"):
+      continue
+    key_rules = tables[rule["type"]].setdefault(rule["api"], {}).setdefault(rule["key"], {})
+    if rule.get("value") is not None:
+      key_rules.setdefault("exact_values", {})[rule["value"]] = rule.get("endpoint")
+    else:
+      key_rules.setdefault("regex_values", {})[rule.get("value_matches")] = rule.get("endpoint")
+  return tables
+
+def escape(error):
+  if "," in error or '"' in error:
+    return '"%s"' % error.replace('"', '""')
+  return error
+
+def generate_key(api, errors):
+  return "%s_%s" % (api, "_".join(escape(error) for error in errors))
+
+def compile_fallback(rules):
+  """
+  [api][key] = ordered endpoints and [api][error] = key, of fallback.lua
+  """
+  endpoints = {}
+  for rule in rules:
+    api_endpoints = endpoints.setdefault(rule["api"], {})
+    key = generate_key(rule["api"], rule["errors"])
+    for error in rule["errors"]:
+      api_endpoints[error] = key
+    # a json array, lua reads it as a sequence which keeps the fallback order
+    api_endpoints[key] = list(rule["endpoints"])
+  return { "endpoints" : endpoints }
+
+COMPILERS = {
+  "access" : compile_access,
+  "ratelimiter" : compile_ratelimiter,
+  "router" : compile_router,
+  "fallback" : compile_fallback,
+}
+
+def compile_tables(module, rules):
+  """
+  Gives the lookup tables of the plugin of module built from its rules
+  """
+  compiler = COMPILERS.get(module)
+  if compiler is None:
+    raise ValueError("Un-supported module %s, supported modules are (%s)" % (module, "/".join(sorted(COMPILERS))))
+  return compiler(rules)
+
+def build_index(phase, module, version, rules):
+  """
+  Gives the serialized index of the rules of a module version. A plugin uses it only when the node is
+  at the same version of the module, so a stale index is never loaded.
+  """
+  index = { "format" : FORMAT, "phase" : phase, "module" : module, "version" : version, "tables" : compile_tables(module, rules) }
+  return json.dumps(index, separators=(',', ':'))
+
+def load_index(contents, phase, module, version):
+  """
+  Reference loader of an index, same as the plugins : gives the lookup tables, None when the
+  index is of another format, module or version and the plugin builds the tables from the rules.
+  """
+  try:
+    index = json.loads(contents)
+  except ValueError:
+    return None
+  if not isinstance(index, dict) or index.get("format") != FORMAT or not isinstance(index.get("tables"), dict):
+    return None
+  if (index.get("phase"), index.get("module"), index.get("version")) != (phase, module, version):
+    return None
+  return index["tables"]
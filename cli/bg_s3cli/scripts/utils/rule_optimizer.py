@@ -0,0 +1,156 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Optimizer of the rules of a module, removes the rules which make no difference to the nginx plugins
+# (src/bb-node/lualib/bb/plugins), so the node builds the same lookup tables and takes the same decisions
+# from fewer rules. A rule is removed only when the plugin provably behaves the same without it :
+#   - duplicate : a later rule has the same identity (module_rule_utils.rule_identity) and overrides it
+#   - wildcard : a ratelimiter header rule whose threshold is the same as the * base rule of its key,
+#     the plugin falls back to the base rule and counts the request under the same key
+#   - shadowed : a fallback rule all of whose errors are mapped to the endpoints of later rules
+import module_rule_utils
+import rule_index
+
+DUPLICATE = "duplicate"
+WILDCARD = "wildcard"
+SHADOWED = "shadowed"
+
+WILDCARD_VALUE = "*"
+
+# the plugin checks the threshold of the client ip with an exact lookup, without the base rule
+REMOTE_ADDR = "remote_addr"
+
+def remove_duplicates(module, rules):
+  """
+  Keeps the last rule of every identity at its own position. The ratelimiter flattens api..type..key..value
+  into one threshold key, so rules of different identities can share it and the last one set wins,
+  which keeping the earlier position of a rule would change.
+  returns (kept rules, list of (reason, rule) removed)
+  """
+  last = {}
+  for position, rule in enumerate(rules):
+    last[module_rule_utils.rule_identity(module, rule)] = position
+  kept = []
+  removed = []
+  for position, rule in enumerate(rules):
+    if last[module_rule_utils.rule_identity(module, rule)] == position:
+      kept.append(rule)
+    else:
+      removed.append((DUPLICATE, rule))
+  return kept, removed
+
+def get_wildcard_shadows(rules, rule_types):
+  """
+  Gives the positions of ratelimiter param/header rules of rule_types which the * base rule of their key
+  makes redundant : the base rule exists with the same threshold, and the flattened threshold key of
+  the rule is not shared with any other lookup the plugin makes (another rule, another configured key
+  of the api whose name is a prefix of key..value, or the client ip check of remote_addr).
+  """
+  writers = {}
+  thresholds = {}
+  keys = {}
+  wildcards = set()
+  for rule in rules:
+    if rule.get("type") not in ("param", "header"):
+      continue
+    threshold_key = rule_index.build_threshold_key(rule["api"], rule["type"], rule["key"], rule["value"])
+    writers[threshold_key] = writers.get(threshold_key, 0) + 1
+    thresholds[threshold_key] = rule_index.to_number(rule.get("threshold"))
+    keys.setdefault((rule["api"], rule["type"]), set()).add(rule["key"])
+    if rule["value"] == WILDCARD_VALUE:
+      wildcards.add((rule["api"], rule["type"], rule["key"]))
+
+  positions = set()
+  for position, rule in enumerate(rules):
+    rule_type = rule.get("type")
+    if rule_type not in rule_types or rule["value"] == WILDCARD_VALUE:
+      continue
+    threshold_key = rule_index.build_threshold_key(rule["api"], rule_type, rule["key"], rule["value"])
+    threshold = thresholds[threshold_key]
+    if threshold is None or writers[threshold_key] != 1:
+      continue
+    base_key = rule_index.build_threshold_key(rule["api"], rule_type, rule["key"], WILDCARD_VALUE)
+    if (rule["api"], rule_type, rule["key"]) not in wildcards or thresholds[base_key] != threshold:
+      continue
+    flattened = rule["key"] + rule["value"]
+    if rule_type == "header" and flattened.startswith(REMOTE_ADDR):
+      continue
+    if any(key != rule["key"] and flattened.startswith(key) for key in keys[(rule["api"], rule_type)]):
+      continue
+    positions.add(position)
+  return positions
+
+def remove_wildcard_shadows(rules, collapse_params=False):
+  """
+  Removes the ratelimiter rules covered by the * base rule of their key with the same threshold.
+  Header rules only, unless collapse_params : for a param repeated in the query string, the plugin
+  counts each configured value it finds and ignores the base rule, so collapsing param rules stops
+  limiting such requests on the removed values.
+  returns (kept rules, list of (reason, rule) removed)
+  """
+  rule_types = ("param", "header") if collapse_params else ("header",)
+  positions = get_wildcard_shadows(rules, rule_types)
+  kept = [rule for position, rule in enumerate(rules) if position not in positions]
+  removed = [(WILDCARD, rule) for position, rule in enumerate(rules) if position in positions]
+  return kept, removed
+
+def remove_shadowed_fallbacks(rules):
+  """
+  Removes the fallback rules whose errors are all mapped to later rules, the plugin never reaches
+  their endpoints. A rule is kept when an earlier rule has the same key (rule_index.generate_key) and
+  no later rule resets it, as it replaces the endpoints of the earlier rule.
+  returns (kept rules, list of (reason, rule) removed)
+  """
+  keys = [rule_index.generate_key(rule["api"], rule["errors"]) for rule in rules]
+  first = {}
+  for position, key in enumerate(keys):
+    first.setdefault(key, position)
+  claimed = {}
+  later_keys = set()
+  shadowed = set()
+  for position in xrange(len(rules) - 1, -1, -1):
+    rule = rules[position]
+    api_claimed = claimed.setdefault(rule["api"], set())
+    if all(error in api_claimed for error in rule["errors"]):
+      if keys[position] in later_keys or first[keys[position]] == position:
+        shadowed.add(position)
+    api_claimed.update(rule["errors"])
+    later_keys.add(keys[position])
+
+  kept = [rule for position, rule in enumerate(rules) if position not in shadowed]
+  removed = [(SHADOWED, rule) for position, rule in enumerate(rules) if position in shadowed]
+  return kept, removed
+
+def optimize_rules(module, rules, collapse_params=False):
+  """
+  Gives the minimal rules of a module equivalent to rules for its plugin, in the same order.
+  collapse_params also removes ratelimiter param rules covered by their * base rule, see remove_wildcard_shadows.
+  returns (optimized rules, list of (reason, rule) removed)
+  """
+  if module not in module_rule_utils.module_phases:
+    raise ValueError("Un-supported module %s, supported modules are (%s)" % (module, "/".join(sorted(module_rule_utils.module_phases))))
+
+  if module == module_rule_utils.fallback_module:
+    # the errors of a rule are all mapped to a later rule of same identity, report it as a duplicate
+    kept, removed = remove_shadowed_fallbacks(rules)
+    identities = set(module_rule_utils.rule_identity(module, rule) for rule in kept)
+    return kept, [(DUPLICATE if module_rule_utils.rule_identity(module, rule) in identities else reason, rule) for reason, rule in removed]
+
+  kept, removed = remove_duplicates(module, rules)
+  if module == module_rule_utils.ratelimiter_module:
+    kept, collapsed = remove_wildcard_shadows(kept, collapse_params)
+    removed.extend(collapsed)
+  return kept, removed
@@ -0,0 +1,396 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Columnar table of the rules of a module, for modules of millions of rules.
+# A rule dict costs a few hundred bytes, most of it the dict itself and its repeated strings. Here the
+# strings of every field are interned in a pool per field and referenced by int codes, the thresholds
+# are also kept as an int column for filtering, and the few fields which do not fit the columns
+# (lists of fallback rules, non string values) are kept per row as extras.
+# The columns are numpy arrays when numpy is installed, and array module arrays otherwise.
+import array
+import itertools
+import operator
+
+import stream
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# fields held as codes of their pool, "value" has mostly unique strings
+POOLED = ("type", "api", "key", "value", "value_matches", "access", "endpoint", "threshold")
+THRESHOLD = "threshold"
+STRING_TYPES = frozenset([str, unicode])
+# default of a field missing from a rule, as None is a valid (extra) value
+ABSENT = object()
+POOLED_TYPES = STRING_TYPES | frozenset([type(ABSENT)])
+# code of a missing field, and threshold of a rule without a numeric threshold
+MISSING = -1
+# code of a string not in the pool, matches no rule
+UNKNOWN = -2
+# rows materialized as dicts at a time
+BATCH_SIZE = 10000
+
+def to_column(values, typecode="i"):
+  """
+  Gives the column of values as numpy array, or array module array without numpy
+  """
+  column = values if isinstance(values, array.array) else array.array(typecode, values)
+  if numpy is None:
+    return column
+  return numpy.frombuffer(column, dtype=numpy.int32 if column.typecode == "i" else numpy.int64).copy()
+
+def take_column(column, rows):
+  if numpy is None:
+    return array.array(column.typecode, (column[row] for row in rows))
+  return column[rows]
+
+class StringPool(object):
+  """
+  Interned strings of a field, a string is referenced by its code (index in the pool)
+  """
+
+  def __init__(self, codes):
+    # dict of string to its code, dropped for the pools of mostly unique strings
+    self.codes = codes
+    self.strings = [None] * len(codes)
+    for string, code in codes.iteritems():
+      self.strings[code] = string
+
+  def lookup(self, string):
+    """
+    Gives the code of string, UNKNOWN when the pool does not have it
+    """
+    if self.codes is not None:
+      return self.codes.get(string, UNKNOWN)
+    try:
+      return self.strings.index(string)
+    except ValueError:
+      return UNKNOWN
+
+  def get_ranks(self):
+    """
+    Gives the rank of every code in the sorted order of the strings, indexed by code + 1 (for MISSING)
+    """
+    ranks = [MISSING] * (len(self.strings) + 1)
+    for rank, code in enumerate(sorted(xrange(len(self.strings)), key=self.strings.__getitem__)):
+      ranks[code + 1] = rank
+    return ranks
+
+  def get_numbers(self):
+    """
+    Gives the number of every code (MISSING for the strings which are not numbers), indexed by code + 1
+    """
+    numbers = [MISSING]
+    for string in self.strings:
+      try:
+        numbers.append(int(string) if string.isdigit() else MISSING)
+      except ValueError:
+        numbers.append(MISSING)
+    return numbers
+
+class RuleRow(object):
+  """
+  Read only view of a rule of the table, with the dict interface used by the callers of rules
+  """
+  __slots__ = ("table", "row")
+
+  def __init__(self, table, row):
+    self.table = table
+    self.row = row
+
+  def __getitem__(self, field):
+    return self.table.get_field(self.row, field)
+
+  def __contains__(self, field):
+    return field in self.table.get_shape(self.row)
+
+  def get(self, field, default=None):
+    return self.table.get_field(self.row, field) if field in self else default
+
+  def keys(self):
+    return list(self.table.get_shape(self.row))
+
+  def to_dict(self):
+    return self.table.get_rule(self.row)
+
+  def __eq__(self, other):
+    return self.to_dict() == (other.to_dict() if isinstance(other, RuleRow) else other)
+
+  def __ne__(self, other):
+    return not self == other
+
+class RuleTableBuilder(object):
+  """
+  Builds the columns of a RuleTable batch by batch of rules, interning a field of a whole batch at once
+  """
+
+  def __init__(self):
+    self.codes = dict((field, {}) for field in POOLED)
+    self.columns = dict((field, array.array("i")) for field in POOLED)
+    self.shape_codes = array.array("i")
+    self.shapes = []
+    self.layouts = {}
+    self.extras = {}
+
+  def get_shape_code(self, fields, non_strings=()):
+    """
+    Gives the code of the shape of a rule with given fields, the ones with non string values are extras
+    """
+    key = (fields, non_strings)
+    code = self.layouts.get(key)
+    if code is None:
+      pooled = tuple(sorted(field for field in fields if field in self.codes and field not in non_strings))
+      shape = (pooled, tuple(sorted(field for field in fields if field not in pooled)))
+      if shape not in self.shapes:
+        self.shapes.append(shape)
+      code = self.layouts[key] = self.shapes.index(shape)
+    return code
+
+  def add_batch(self, rules):
+    shape_codes = []
+    for rule in rules:
+      fields = tuple(rule)
+      code = self.layouts.get((fields, ()))
+      if code is None:
+        code = self.get_shape_code(fields)
+      shape_codes.append(code)
+    batch_shapes = [self.shapes[code] for code in set(shape_codes)]
+
+    values = []
+    for field in POOLED:
+      present = [field in pooled for pooled, _ in batch_shapes]
+      if not any(present):
+        values.append((field, None))
+        continue
+      field_values = map(operator.itemgetter(field), rules) if all(present) else [rule.get(field, ABSENT) for rule in rules]
+      if not set(map(type, field_values)) <= POOLED_TYPES:
+        for rule in rules:
+          self.add_rule(rule)
+        return
+      values.append((field, field_values))
+
+    start = len(self.shape_codes)
+    self.shape_codes.extend(shape_codes)
+    if any(extra for _, extra in batch_shapes):
+      for offset, code in enumerate(shape_codes):
+        extra = self.shapes[code][1]
+        if extra:
+          self.extras[start + offset] = dict((field, rules[offset][field]) for field in extra)
+
+    for field, field_values in values:
+      if field_values is None:
+        self.columns[field].extend(array.array("i", [MISSING]) * len(rules))
+        continue
+      codes = self.codes[field]
+      field_codes = map(codes.get, field_values)
+      if None in field_codes:
+        for index, code in enumerate(field_codes):
+          if code is None:
+            value = field_values[index]
+            # len(codes) is evaluated before setdefault, it is the code of a new string
+            field_codes[index] = MISSING if value is ABSENT else codes.setdefault(value, len(codes))
+      self.columns[field].extend(field_codes)
+
+  def add_rule(self, rule):
+    """
+    Adds a rule with a non string value of a pooled field, such fields are kept as extras
+    """
+    non_strings = []
+    for field in POOLED:
+      value = rule.get(field, ABSENT)
+      if value is ABSENT or type(value) not in STRING_TYPES:
+        self.columns[field].append(MISSING)
+        if value is not ABSENT:
+          non_strings.append(field)
+        continue
+      codes = self.codes[field]
+      self.columns[field].append(codes.setdefault(value, len(codes)))
+    code = self.get_shape_code(tuple(rule), tuple(non_strings))
+    extra = self.shapes[code][1]
+    if extra:
+      self.extras[len(self.shape_codes)] = dict((field, rule[field]) for field in extra)
+    self.shape_codes.append(code)
+
+  def build(self):
+    pools = dict((field, StringPool(codes)) for field, codes in self.codes.items())
+    numbers = pools[THRESHOLD].get_numbers()
+    thresholds = array.array("l", (numbers[code + 1] for code in self.columns[THRESHOLD]))
+    # the values are mostly unique, the lookup dict of their pool costs more than the strings
+    pools["value"].codes = None
+    self.codes = None
+    return RuleTable(pools, self.shapes, dict((field, to_column(column)) for field, column in self.columns.items()),
+                     to_column(thresholds), to_column(self.shape_codes), self.extras)
+
+class RuleTable(object):
+  """
+  Immutable columnar table of rules. filter, dedup, sort and take give a new table sharing the pools.
+  """
+
+  def __init__(self, pools, shapes, columns, thresholds, shape_codes, extras):
+    self.pools = pools
+    # shape of a rule is the tuple of its pooled fields, and the tuple of its extra fields
+    self.shapes = shapes
+    self.columns = columns
+    self.thresholds = thresholds
+    self.shape_codes = shape_codes
+    # dict of row to dict of the extra fields of the rule
+    self.extras = extras
+
+  @staticmethod
+  def from_rules(rules):
+    """
+    Builds the table from an iterable of rule dicts, e.g. stream.iter_array of a rules file
+    """
+    builder = RuleTableBuilder()
+    rules = iter(rules)
+    while True:
+      batch = list(itertools.islice(rules, BATCH_SIZE))
+      if not batch:
+        return builder.build()
+      builder.add_batch(batch)
+
+  @staticmethod
+  def from_json(contents):
+    """
+    Builds the table from the contents of a rules file, parsed incrementally
+    """
+    return RuleTable.from_rules(stream.iter_array(stream.iter_decoded([contents])))
+
+  def __len__(self):
+    return len(self.shape_codes)
+
+  def __getitem__(self, row):
+    return RuleRow(self, row)
+
+  def __iter__(self):
+    return (RuleRow(self, row) for row in xrange(len(self)))
+
+  def get_shape(self, row):
+    pooled, extra = self.shapes[self.shape_codes[row]]
+    return pooled + extra
+
+  def get_field(self, row, field):
+    pooled, extra = self.shapes[self.shape_codes[row]]
+    if field in pooled:
+      return self.pools[field].strings[self.columns[field][row]]
+    if field in extra:
+      return self.extras[row][field]
+    raise KeyError(field)
+
+  def get_rule(self, row):
+    """
+    Gives the rule at row as a dict, same as the rule the table is built from
+    """
+    return dict((field, self.get_field(row, field)) for field in self.get_shape(row))
+
+  def to_rules(self):
+    """
+    Generates the rules as dicts in the order of the table, materialized batch by batch
+    """
+    for start in xrange(0, len(self), BATCH_SIZE):
+      end = start + BATCH_SIZE
+      shape_codes = self.shape_codes[start:end].tolist()
+      pooled, extra = self.shapes[shape_codes[0]]
+      if not extra and shape_codes.count(shape_codes[0]) == len(shape_codes):
+        # a batch of rules of same fields, the usual case, is materialized column by column
+        columns = [map(self.pools[field].strings.__getitem__, self.columns[field][start:end].tolist()) for field in pooled]
+        for values in itertools.izip(*columns):
+          yield dict(itertools.izip(pooled, values))
+        continue
+
+      codes = dict((field, column[start:end].tolist()) for field, column in self.columns.items())
+      layouts = [[(field, self.pools[field].strings, codes[field]) for field in pooled] for pooled, _ in self.shapes]
+      for offset, shape_code in enumerate(shape_codes):
+        rule = { field : strings[column[offset]] for field, strings, column in layouts[shape_code] }
+        if self.extras and start + offset in self.extras:
+          rule.update(self.extras[start + offset])
+        yield rule
+
+  def to_json(self):
+    """
+    Serializes the rules, the bytes are same as utils.serialize_rules of the rules
+    """
+    return "".join(stream.iter_encoded_array(self.to_rules()))
+
+  def mask(self, filters=None, threshold_above=None, threshold_below=None):
+    """
+    Gives the rows (a boolean mask with numpy) matching all the filters, a dict of field to string,
+    and the bounds (exclusive) of threshold
+    """
+    conditions = []
+    for field, string in (filters or {}).items():
+      code = self.pools[field].lookup(string)
+      conditions.append((self.columns[field], lambda column, code=code: column == code))
+    if threshold_above is not None:
+      conditions.append((self.thresholds, lambda column: column > threshold_above))
+    if threshold_below is not None:
+      conditions.append((self.thresholds, lambda column: (column < threshold_below) & (column != MISSING)))
+
+    if numpy is not None:
+      mask = numpy.ones(len(self), dtype=bool)
+      for column, condition in conditions:
+        mask &= condition(column)
+      return mask
+    return [row for row in xrange(len(self)) if all(condition(column[row]) for column, condition in conditions)]
+
+  def take(self, rows):
+    """
+    Gives the table of the given rows (or boolean mask with numpy), in their order
+    """
+    if numpy is not None:
+      rows = numpy.asarray(rows)
+      rows = numpy.flatnonzero(rows) if rows.dtype == bool else rows.astype(numpy.int64)
+    extras = {}
+    if self.extras:
+      for position, row in enumerate(rows):
+        if int(row) in self.extras:
+          extras[position] = self.extras[int(row)]
+    return RuleTable(self.pools, self.shapes, dict((field, take_column(column, rows)) for field, column in self.columns.items()),
+                     take_column(self.thresholds, rows), take_column(self.shape_codes, rows), extras)
+
+  def filter(self, filters=None, threshold_above=None, threshold_below=None):
+    """
+    Gives the table of the rules matching all the filters, see mask
+    """
+    return self.take(self.mask(filters, threshold_above, threshold_below))
+
+  def sort(self, fields=("api", "type", "key", "value")):
+    """
+    Gives the table sorted by the strings of given fields, stable for the rules with same fields
+    """
+    ranks = [(field, self.pools[field].get_ranks()) for field in fields]
+    if numpy is not None:
+      # lexsort sorts by the last key first
+      keys = [numpy.asarray(field_ranks)[self.columns[field] + 1] for field, field_ranks in reversed(ranks)]
+      return self.take(numpy.lexsort(keys))
+    return self.take(sorted(xrange(len(self)), key=lambda row: tuple(field_ranks[self.columns[field][row] + 1] for field, field_ranks in ranks)))
+
+  def dedup(self):
+    """
+    Gives the table without the rules overridden by a later rule of same identity (type, key, value, api,
+    see module_rule_utils.rule_identity), in the order of their last occurrence, same as the plugin
+    """
+    fields = ("type", "key", "value", "api", "value_matches")
+    if numpy is not None and len(self):
+      identities = numpy.stack([self.columns[field][::-1] for field in fields], axis=1)
+      _, first = numpy.unique(identities, axis=0, return_index=True)
+      return self.take(numpy.sort(len(self) - 1 - first))
+    last = {}
+    for row in xrange(len(self)):
+      last[tuple(self.columns[field][row] for field in fields)] = row
+    return self.take(sorted(last.values()))
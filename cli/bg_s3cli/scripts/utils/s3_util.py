@@ -16,15 +16,31 @@
 #
 # helper function for s3 using boto library
 # This work was part of BloomReach other project. This work was taken with slight modification.
+import calendar
+import collections
 import ConfigParser
-import commands
+import httplib
+import itertools
 import json
+import math
+import random
 import re
+import socket
 import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import boto
+import boto.utils
+from boto.exception import S3ResponseError
+from boto.s3.connection import OrdinaryCallingFormat
 from boto.s3.connection import S3Connection
 
+from bg_s3cli.conf import s3
+from transfer import record, record_read, get_stats, get_read_stats, reset_stats, format_stats, run_parallel
+from transfer import MAX_WORKERS, DELETE_BATCH_SIZE, READ_CHUNK_SIZE
+
 ####################
 # global settings #
 ###################
@@ -33,6 +49,9 @@ try:
 except ConfigParser.DuplicateSectionError:
   pass
 boto.config.set("Boto", "metadata_service_num_attempts", "5")
+# a stalled socket must not outlive the read deadline
+if not boto.config.has_option("Boto", "http_socket_timeout"):
+  boto.config.set("Boto", "http_socket_timeout", str(int(math.ceil(s3.get_read_deadline()))))
 
 s3regex = re.compile("s3://([^/]+)/(.*)")
 def parse_s3_path(s3path):
@@ -42,6 +61,210 @@ def parse_s3_path(s3path):
   else:
     raise RuntimeError("Invalid S3 path: %s" % s3path)
 
+##################################################
+# session : cached connections and bucket handles #
+##################################################
+
+# boto connections are not thread safe, so every thread keeps its own
+# connection and bucket handles for the life of the process.
+_session = threading.local()
+
+# streamed uploads of this size and beyond are multipart uploads, of MULTIPART_CHUNK_SIZE parts (s3 minimum is 5MB)
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+# jittered exponential backoff between the attempts of a read, in seconds
+READ_BACKOFF = 0.1
+READ_MAX_BACKOFF = 2.0
+
+# a read slower than this percentile of the latencies of the reads so far is hedged,
+# once there are enough samples, with a duplicate request on HEDGE_WORKERS threads
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = 2 * MAX_WORKERS
+LATENCY_SAMPLES = 1000
+
+# latencies of the reads so far, shared by all the threads
+_latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+_latencies_lock = threading.Lock()
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+def get_connection():
+  """
+  Returns the S3 connection of the current thread, created on first use
+  """
+  connection = getattr(_session, "connection", None)
+  if connection is None:
+    endpoint = s3.get_endpoint()
+    if endpoint:
+      host, _, port = endpoint.partition(":")
+      connection = S3Connection(host=host, port=int(port) if port else None, is_secure=False, calling_format=OrdinaryCallingFormat())
+    else:
+      connection = S3Connection()
+    _session.connection = connection
+    _session.buckets = {}
+  return connection
+
+def get_bucket(b_name):
+  """
+  Returns the cached bucket handle for b_name. The bucket is not validated
+  with an extra round trip, a missing bucket fails on the first request.
+  """
+  connection = get_connection()
+  bucket = _session.buckets.get(b_name)
+  if bucket is None:
+    bucket = connection.get_bucket(b_name, validate=False)
+    _session.buckets[b_name] = bucket
+  return bucket
+
+#####################################################
+# reads : deadline, retries with backoff and hedging #
+#####################################################
+
+class TransientError(Exception):
+  """
+  Failure of a read which is worth retrying, e.g. a broken connection or an incomplete body
+  """
+  pass
+
+def is_transient(e):
+  """
+  Whether a failed request is worth retrying: 5xx, throttling and connection errors
+  """
+  if isinstance(e, TransientError):
+    return True
+  if isinstance(e, boto.exception.BotoServerError):
+    return e.status >= 500 or e.status in (408, 429) or e.error_code in ("SlowDown", "RequestTimeout")
+  return isinstance(e, (socket.error, httplib.HTTPException))
+
+def get_hedge_delay():
+  """
+  Gives the HEDGE_PERCENTILE latency of the reads so far, None until there are enough samples
+  """
+  with _latencies_lock:
+    if len(_latencies) < HEDGE_MIN_SAMPLES:
+      return None
+    latencies = sorted(_latencies)
+  return latencies[min(len(latencies) - 1, len(latencies) * HEDGE_PERCENTILE // 100)]
+
+def get_hedge_pool():
+  """
+  Returns the threads running hedged reads, they keep their connections across the reads
+  """
+  global _hedge_pool
+  with _hedge_pool_lock:
+    if _hedge_pool is None:
+      _hedge_pool = ThreadPool(HEDGE_WORKERS)
+    return _hedge_pool
+
+def timed_read(request):
+  start = time.time()
+  result = request()
+  with _latencies_lock:
+    _latencies.append(time.time() - start)
+  return result
+
+def hedged_read(request, deadline, hedge_delay):
+  """
+  Runs the request on the hedge pool, and a duplicate of it once it is slower than hedge_delay.
+  The first answer wins, failures are raised only when all the requests have failed.
+  """
+  answers = Queue.Queue()
+  def submit(hedge):
+    def task():
+      try:
+        answers.put((True, hedge, timed_read(request)))
+      except Exception as e:
+        answers.put((False, hedge, e))
+    get_hedge_pool().apply_async(task)
+
+  submit(False)
+  pending = 1
+  hedged = False
+  failure = None
+  while pending:
+    if not hedged:
+      timeout = min(hedge_delay, deadline - time.time())
+    else:
+      timeout = deadline - time.time()
+    try:
+      ok, hedge, result = answers.get(timeout=max(timeout, 0))
+    except Queue.Empty:
+      if hedged or time.time() >= deadline:
+        return None, False
+      record_read("hedges")
+      submit(True)
+      pending += 1
+      hedged = True
+      continue
+    pending -= 1
+    if ok:
+      if hedge:
+        record_read("hedge_wins")
+      return result, True
+    failure = result
+    if not hedged and is_transient(failure) and time.time() < deadline:
+      # the failed request is hedged right away instead of waiting for a retry
+      record_read("hedges")
+      submit(True)
+      pending += 1
+      hedged = True
+  raise failure
+
+def read_with_retries(s3path, request, hedge=True):
+  """
+  Runs a read request within the read deadline, retrying transient failures with jittered
+  exponential backoff. With hedged reads on, a duplicate request is sent once an attempt is
+  slower than the p95 latency of the reads so far, and the first answer wins.
+  """
+  deadline = time.time() + s3.get_read_deadline()
+  attempts = s3.get_read_attempts()
+  for attempt in range(1, attempts + 1):
+    try:
+      hedge_delay = get_hedge_delay() if hedge and s3.get_hedge_reads() else None
+      if hedge_delay is None:
+        return timed_read(request)
+      result, answered = hedged_read(request, deadline, hedge_delay)
+      if answered:
+        return result
+    except Exception as e:
+      if not is_transient(e) or attempt == attempts:
+        raise
+    # full jitter, so that the retries of many clients do not line up
+    backoff = random.uniform(0, min(READ_MAX_BACKOFF, READ_BACKOFF * 2 ** attempt))
+    if time.time() + backoff >= deadline:
+      record_read("deadline_exceeded")
+      raise RuntimeError("Read of %s exceeded its deadline of %.1fs" % (s3path, s3.get_read_deadline()))
+    record_read("retries")
+    time.sleep(backoff)
+
+def send_request(connection, method, path, data, headers):
+  """
+  boto sender of the reads, it fails right away on 5xx and connection errors instead of
+  boto's own retries and sleeps, the reads are retried by read_with_retries within their deadline.
+  """
+  try:
+    connection.request(method, path, data, headers)
+    response = connection.getresponse()
+  except (socket.error, httplib.HTTPException), e:
+    connection.close()
+    raise TransientError("%s %s failed : %s" % (method, path, e))
+  if response.status >= 500:
+    raise S3ResponseError(response.status, response.reason, response.read())
+  return response
+
+def open_item(s3path, headers=None):
+  """
+  Sends GET of s3 file and returns the http response to read its contents from.
+  Any status other than 2xx is raised as S3ResponseError, e.g. 304 of a conditional GET and 404 of a missing file.
+  """
+  b_name, k_name = parse_s3_path(s3path)
+  response = get_connection().make_request("GET", b_name, k_name, headers=headers, sender=send_request, override_num_retries=0)
+  if response.status >= 300:
+    raise S3ResponseError(response.status, response.reason, response.read())
+  return response
+
 ###############################################
 # get method to get content from s3 file path #
 ###############################################
@@ -51,63 +274,221 @@ def get_item(s3path):
   Get file from s3 as a boto key; None if key does not exist
   """
   b_name, k_name = parse_s3_path(s3path)
-  try:
-    bucket = S3Connection().get_bucket(b_name)
-  except RuntimeError,e:
-    return None
-  return bucket.get_key(k_name) #None if key DNE
+  def head():
+    key = get_bucket(b_name).get_key(k_name) #None if key DNE
+    record("HEAD")
+    return key
+  return read_with_retries(s3path, head)
 
 def get_item_to_string(s3path):
   """
-  Get file from s3 as a string
+  Get file from s3 as a string; None if key does not exist.
+  It is a single GET, no separate existence check is done.
   """
-  obj = get_item(s3path)
-  if not obj:
-    return None
-  return obj.get_contents_as_string()
+  return get_item_with_etag(s3path)[0]
+
+def get_item_with_etag(s3path):
+  """
+  Get file from s3 as (contents, etag) with a single GET; (None, None) if key does not exist.
+  """
+  def get():
+    try:
+      response = open_item(s3path)
+      contents = read_response(response)
+    except S3ResponseError, e:
+      record("GET")
+      if e.status == 404:
+        return None, None
+      raise
+    record("GET", len(contents))
+    return contents, response.getheader("etag")
+  return read_with_retries(s3path, get)
+
+def read_response(response):
+  """
+  Reads the whole body of http response, a body cut short of its Content-Length is a transient failure
+  """
+  contents = response.read()
+  length = response.getheader("content-length")
+  if length is not None and len(contents) < int(length):
+    raise TransientError("Incomplete read, got %d of %s bytes" % (len(contents), length))
+  return contents
+
+def iter_item_chunks(s3path, chunk_size=READ_CHUNK_SIZE):
+  """
+  Generates the contents of s3 file chunk by chunk from a streamed GET.
+  A stream broken by a transient failure is resumed with a ranged GET from where it broke.
+  """
+  state = {"response" : None, "etag" : None, "expected" : None}
+  num_bytes = 0
+  resumes = 0
+
+  def resume():
+    # the rest of the same object, resumed streams are not hedged
+    if state["response"] is not None:
+      state["response"].close()
+      record("GET")
+    headers = {"Range" : "bytes=%d-" % num_bytes, "If-Match" : state["etag"]} if num_bytes else None
+    response = open_item(s3path, headers)
+    length = response.getheader("content-length")
+    state["response"] = response
+    state["etag"] = response.getheader("etag")
+    state["expected"] = num_bytes + int(length) if length is not None else None
+
+  try:
+    read_with_retries(s3path, resume, hedge=False)
+    while True:
+      try:
+        chunk = state["response"].read(chunk_size)
+        if not chunk and state["expected"] is not None and num_bytes < state["expected"]:
+          raise TransientError("Incomplete read, got %d of %d bytes" % (num_bytes, state["expected"]))
+      except Exception as e:
+        resumes += 1
+        if not is_transient(e) or resumes >= s3.get_read_attempts():
+          raise
+        record_read("retries")
+        read_with_retries(s3path, resume, hedge=False)
+        continue
+      if not chunk:
+        break
+      num_bytes += len(chunk)
+      yield chunk
+  finally:
+    if state["response"] is not None:
+      state["response"].close()
+    record("GET", num_bytes)
+
+def get_item_if_modified(s3path, etag=None):
+  """
+  Conditional GET (If-None-Match) of s3 file.
+  returns (True, contents, etag) when modified, (False, None, etag) when it still matches given etag,
+  and (True, None, None) if key does not exist
+  """
+  headers = {"If-None-Match" : etag} if etag else None
+  def get():
+    try:
+      response = open_item(s3path, headers)
+      contents = read_response(response)
+    except S3ResponseError, e:
+      record("GET")
+      if e.status == 304:
+        return False, None, etag
+      if e.status == 404:
+        return True, None, None
+      raise
+    record("GET", len(contents))
+    return True, contents, response.getheader("etag")
+  return read_with_retries(s3path, get)
 
 def get_json_to_obj(s3path):
   """
-  Get json file from s3 as python object
+  Get json file from s3 as python object; None if key does not exist.
+  Read failures and invalid json are raised, they are not taken as a missing file.
   """
+  obj = get_item_to_string(s3path)
+  if obj is None:
+    return None
   try:
-    obj = get_item_to_string(s3path)
-    json_obj = json.loads(obj)
-    return json_obj
+    return json.loads(obj)
   except ValueError, e:
-    print "Error while converting to json for " + s3path
-    return None
-  except Exception, e:
-    print "Unexpected error :" + str(e)
-    return None
+    raise ValueError("Error while converting to json for %s : %s" % (s3path, e))
 
 def delete_item(s3path):
   """
-  delete the s3file
+  delete the s3file, deleting a missing key is not an error
   """
-  obj = get_item(s3path)
-  obj.delete()
+  b_name, k_name = parse_s3_path(s3path)
+  get_bucket(b_name).delete_key(k_name)
+  record("DELETE")
 
-def delete_dir(s3path):
+def list_keys(s3path):
   """
-  Delete all the files given by s3path
+  Generates all the boto keys under s3path prefix, listing page by page
   """
-  return commands.getoutput("s3cmd del %s -r -f" % s3path)
+  b_name, prefix = parse_s3_path(s3path)
+  record("LIST")
+  for count, key in enumerate(get_bucket(b_name).list(prefix=prefix), 1):
+    if count % DELETE_BATCH_SIZE == 0:
+      record("LIST")
+    yield key
+
+def list_prefixes(s3path):
+  """
+  Generates the names of the immediate "sub directories" (common prefixes up to the next /) under s3path prefix
+  """
+  b_name, prefix = parse_s3_path(s3path)
+  record("LIST")
+  for count, entry in enumerate(get_bucket(b_name).list(prefix=prefix, delimiter="/"), 1):
+    if count % DELETE_BATCH_SIZE == 0:
+      record("LIST")
+    if entry.name.endswith("/"):
+      yield entry.name[len(prefix):-1]
+
+def get_last_modified(key):
+  """
+  Gives the last modified time of a listed boto key as seconds since epoch
+  """
+  return calendar.timegm(boto.utils.parse_ts(key.last_modified).timetuple())
+
+def delete_keys(b_name, k_names):
+  """
+  Deletes the keys of a bucket with a single multi-object delete request.
+  returns list of failures, each is a dict of key, code and message
+  """
+  result = get_bucket(b_name).delete_keys(k_names, quiet=True)
+  record("DELETE")
+  return [{"key" : error.key, "code" : error.code, "message" : error.message} for error in result.errors]
+
+def delete_dir(s3path, max_workers=MAX_WORKERS, batch_size=DELETE_BATCH_SIZE):
+  """
+  Delete all the files given by s3path. Keys are listed with pagination and
+  deleted in multi-object batches across parallel workers while listing.
+  returns (number of deleted keys, list of failures), each failure is a dict of key, code and message
+  """
+  b_name, _ = parse_s3_path(s3path)
+  return delete_key_names(b_name, (key.name for key in list_keys(s3path)), max_workers, batch_size)
+
+def delete_key_names(b_name, k_names, max_workers=MAX_WORKERS, batch_size=DELETE_BATCH_SIZE):
+  """
+  Deletes the keys of a bucket in multi-object batches across parallel workers.
+  k_names can be a generator, the batches are deleted while it is consumed.
+  returns (number of deleted keys, list of failures), each failure is a dict of key, code and message
+  """
+  def batches():
+    names = iter(k_names)
+    while True:
+      batch = list(itertools.islice(names, batch_size))
+      if not batch:
+        return
+      yield batch
+
+  def delete_batch(batch):
+    try:
+      return len(batch), delete_keys(b_name, batch)
+    except Exception as e:
+      return len(batch), [{"key" : k_name, "code" : type(e).__name__, "message" : str(e)} for k_name in batch]
+
+  deleted = 0
+  failures = []
+  pool = ThreadPool(max_workers)
+  try:
+    for count, batch_failures in pool.imap_unordered(delete_batch, batches()):
+      deleted += count - len(batch_failures)
+      failures.extend(batch_failures)
+  finally:
+    pool.close()
+    pool.join()
+  return deleted, failures
 
 ############################################
 # Helper method to put contents to s3 file #
 ############################################
 def new_item(s3path):
   """
-  Helper method to create a new key at the s3path. Returns None if the bucket doesn't exist
+  Helper method to create a new key at the s3path, no request is made to s3.
   """
   b_name, k_name = parse_s3_path(s3path)
-  try:
-    bucket = S3Connection().get_bucket(b_name)
-  except RuntimeError, e:
-    print "Error: Bucket s3://%s/ does not exist; ensure this is the correct name (or create the bucket before running this method" % b_name
-    return None
-  return bucket.new_key(k_name)
+  return get_bucket(b_name).new_key(k_name)
 
 def put_obj_to_json(s3path, contents):
   """
@@ -120,17 +501,43 @@ def put_obj_to_json(s3path, contents):
     return False
   return put_item_from_string(s3path, obj)
 
-def put_item_from_string(s3path, contents):
+def put_item_from_string(s3path, contents, encoding=None):
   """
-  put the string content into given s3 file
+  put the string content into given s3 file.
+  encoding of already encoded contents is recorded in object metadata and Content-Encoding
   """
   key = new_item(s3path)
   if not key:
     return False
-  key.set_contents_from_string(contents)
+  headers = None
+  if encoding:
+    key.set_metadata("bg-encoding", encoding)
+    headers = {"Content-Encoding" : encoding}
+  key.set_contents_from_string(contents, headers=headers)
+  record("PUT", len(contents))
   print >> sys.stderr, "s3_util.py: s3cmd put (string) %s" % s3path
   return True
 
+def put_item_if_match(s3path, contents, etag):
+  """
+  Conditional put (compare-and-swap) of string content to s3 file, it is written only if the
+  file still has given etag, or does not exist yet when etag is None.
+  returns False when the condition failed, i.e. the file is changed by another writer.
+  """
+  key = new_item(s3path)
+  headers = {"If-Match" : etag} if etag else {"If-None-Match" : "*"}
+  try:
+    key.set_contents_from_string(contents, headers=headers)
+  except S3ResponseError, e:
+    record("PUT")
+    # 409 is returned when a concurrent conditional write is in progress
+    if e.status in (409, 412):
+      return False
+    raise
+  record("PUT", len(contents))
+  print >> sys.stderr, "s3_util.py: s3cmd put (if-match) %s" % s3path
+  return True
+
 def put_item_from_file_pointer(s3path, fp):
   """
   put the content of file pointed by file pointer to s3 path
@@ -138,6 +545,92 @@ def put_item_from_file_pointer(s3path, fp):
   key = new_item(s3path)
   if not key:
     return False
+  start = fp.tell()
   key.set_contents_from_file(fp)
+  record("PUT", fp.tell() - start)
   print >> sys.stderr, "s3_util.py: s3cmd put %s %s" % (fp.name, s3path)
   return True
+
+def put_item_from_stream(s3path, fp, size, encoding=None, part_size=MULTIPART_CHUNK_SIZE):
+  """
+  put size bytes of file pointer to s3 path without reading them in memory at once.
+  Files beyond MULTIPART_THRESHOLD are uploaded as multipart upload of part_size parts.
+  encoding of already encoded contents is recorded in object metadata and Content-Encoding
+  """
+  b_name, k_name = parse_s3_path(s3path)
+  metadata = {"bg-encoding" : encoding} if encoding else {}
+  headers = {"Content-Encoding" : encoding} if encoding else None
+  if size < MULTIPART_THRESHOLD:
+    key = new_item(s3path)
+    for name, value in metadata.items():
+      key.set_metadata(name, value)
+    key.set_contents_from_file(fp, headers=headers)
+    record("PUT", size)
+  else:
+    upload = get_bucket(b_name).initiate_multipart_upload(k_name, headers=headers, metadata=metadata)
+    try:
+      for part_num, offset in enumerate(range(0, size, part_size), 1):
+        part_bytes = min(part_size, size - offset)
+        upload.upload_part_from_file(fp, part_num, size=part_bytes)
+        record("PUT", part_bytes)
+      upload.complete_upload()
+    except Exception:
+      upload.cancel_upload()
+      raise
+  print >> sys.stderr, "s3_util.py: s3cmd put (stream) %s" % s3path
+  return True
+
+def copy_item(src_s3path, dest_s3path):
+  """
+  Server side copy of s3 file along with its metadata, contents never pass through the client
+  """
+  src_b_name, src_k_name = parse_s3_path(src_s3path)
+  dest_b_name, dest_k_name = parse_s3_path(dest_s3path)
+  get_bucket(dest_b_name).copy_key(dest_k_name, src_b_name, src_k_name)
+  record("COPY")
+  print >> sys.stderr, "s3_util.py: s3cmd cp %s %s" % (src_s3path, dest_s3path)
+  return True
+
+def touch_item(s3path):
+  """
+  Refreshes the last modified time of s3 file with a server side copy onto itself. s3 refuses a copy
+  onto itself which keeps the metadata, so the metadata and Content-Encoding are given again along
+  with the time of the touch. returns False if the file does not exist
+  """
+  b_name, k_name = parse_s3_path(s3path)
+  bucket = get_bucket(b_name)
+  key = bucket.get_key(k_name)
+  record("HEAD")
+  if key is None:
+    return False
+  metadata = dict(key.metadata or {})
+  metadata["bg-touched"] = str(int(time.time()))
+  headers = {}
+  if key.content_encoding:
+    headers["Content-Encoding"] = key.content_encoding
+  if key.content_type:
+    headers["Content-Type"] = key.content_type
+  bucket.copy_key(k_name, b_name, k_name, metadata=metadata, headers=headers)
+  record("COPY")
+  print >> sys.stderr, "s3_util.py: s3cmd touch %s" % s3path
+  return True
+
+def copy_items(items, max_workers=MAX_WORKERS):
+  """
+  Server side copy of the (source s3path, destination s3path) pairs in parallel.
+  Raises exception if any of the copy fails, once all of them are finished.
+  """
+  run_parallel([lambda src=src, dest=dest: copy_item(src, dest) for src, dest in items], max_workers)
+
+def put_items_from_strings(items, max_workers=MAX_WORKERS):
+  """
+  put the (s3path, string content) pairs in parallel.
+  Raises exception if any of the put fails, once all of them are finished.
+  """
+  def put_task(s3path, contents):
+    def task():
+      if not put_item_from_string(s3path, contents):
+        raise Exception("Failed to put %s" % s3path)
+    return task
+
+  run_parallel([put_task(s3path, contents) for s3path, contents in items], max_workers)
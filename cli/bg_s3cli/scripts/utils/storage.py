@@ -0,0 +1,243 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Storage of the cluster artifacts, dispatched on the scheme of the path :
+# s3://bucket/key to s3_util, and file:///dir/file to fs_util (local disk).
+import fs_util
+
+try:
+  import s3_util
+except ImportError:
+  # boto is only needed for the s3:// paths
+  s3_util = None
+
+from transfer import run_parallel, record, get_stats, reset_stats, format_stats, MAX_WORKERS, DELETE_BATCH_SIZE, READ_CHUNK_SIZE
+
+def is_local(path):
+  """
+  Whether the path is on local disk (file://) rather than s3
+  """
+  return path.startswith(fs_util.SCHEME)
+
+def get_s3_util():
+  if s3_util is None:
+    raise ValueError("s3 paths need boto python package")
+  return s3_util
+
+def get_util(path):
+  return fs_util if is_local(path) else get_s3_util()
+
+def get_bucket_util(b_name):
+  # the "bucket" of a local file is the root directory, s3 bucket names never have a /
+  return fs_util if b_name.startswith(fs_util.ROOT) else get_s3_util()
+
+def parse_path(path):
+  """
+  Gives (bucket, key) of the path, the bucket of a local file is the root directory
+  """
+  if is_local(path):
+    return fs_util.parse_path(path)
+  return get_s3_util().parse_s3_path(path)
+
+def get_item(path):
+  return get_util(path).get_item(path)
+
+def get_item_to_string(path):
+  return get_util(path).get_item_to_string(path)
+
+def get_item_with_etag(path):
+  return get_util(path).get_item_with_etag(path)
+
+def iter_item_chunks(path, chunk_size=READ_CHUNK_SIZE):
+  return get_util(path).iter_item_chunks(path, chunk_size)
+
+def get_item_if_modified(path, etag=None):
+  return get_util(path).get_item_if_modified(path, etag)
+
+def get_json_to_obj(path):
+  return get_util(path).get_json_to_obj(path)
+
+def delete_item(path):
+  return get_util(path).delete_item(path)
+
+def list_keys(path):
+  return get_util(path).list_keys(path)
+
+def list_prefixes(path):
+  """
+  Generates the names of the immediate sub directories under path, which ends with /
+  """
+  return get_util(path).list_prefixes(path)
+
+def get_last_modified(key):
+  """
+  Gives the last modified time of a listed key as seconds since epoch
+  """
+  if isinstance(key, fs_util.FileKey):
+    return fs_util.get_last_modified(key)
+  return get_s3_util().get_last_modified(key)
+
+def delete_dir(path, max_workers=MAX_WORKERS, batch_size=DELETE_BATCH_SIZE):
+  return get_util(path).delete_dir(path, max_workers, batch_size)
+
+def delete_key_names(b_name, k_names, max_workers=MAX_WORKERS, batch_size=DELETE_BATCH_SIZE):
+  return get_bucket_util(b_name).delete_key_names(b_name, k_names, max_workers, batch_size)
+
+def put_obj_to_json(path, contents):
+  return get_util(path).put_obj_to_json(path, contents)
+
+def put_item_from_string(path, contents, encoding=None):
+  return get_util(path).put_item_from_string(path, contents, encoding)
+
+def put_item_if_match(path, contents, etag):
+  return get_util(path).put_item_if_match(path, contents, etag)
+
+def put_item_from_file_pointer(path, fp):
+  return get_util(path).put_item_from_file_pointer(path, fp)
+
+def put_item_from_stream(path, fp, size, encoding=None):
+  return get_util(path).put_item_from_stream(path, fp, size, encoding)
+
+def copy_item(src_path, dest_path):
+  """
+  Copy of a file within a storage, copies across s3 and local disk are not supported
+  """
+  if is_local(src_path) != is_local(dest_path):
+    raise ValueError("Copy from %s to %s across storages is not supported" % (src_path, dest_path))
+  return get_util(dest_path).copy_item(src_path, dest_path)
+
+def touch_item(path):
+  """
+  Refreshes the last modified time of the file, returns False if it does not exist
+  """
+  return get_util(path).touch_item(path)
+
+def copy_items(items, max_workers=MAX_WORKERS):
+  """
+  Copy of the (source path, destination path) pairs in parallel.
+  Raises exception if any of the copy fails, once all of them are finished.
+  """
+  run_parallel([lambda src=src, dest=dest: copy_item(src, dest) for src, dest in items], max_workers)
+
+def put_items_from_strings(items, max_workers=MAX_WORKERS):
+  """
+  put the (path, string content) pairs in parallel.
+  Raises exception if any of the put fails, once all of them are finished.
+  """
+  def put_task(path, contents):
+    def task():
+      if not put_item_from_string(path, contents):
+        raise Exception("Failed to put %s" % path)
+    return task
+
+  run_parallel([put_task(path, contents) for path, contents in items], max_workers)
+
+class Regions(object):
+  """
+  Writes of the paths under the primary (first) base path, fanned out concurrently to the same
+  paths under the base path of every region. Reads are served by the primary.
+  """
+
+  def __init__(self, base_paths):
+    self.base_paths = list(base_paths)
+    self.primary = self.base_paths[0]
+
+  def get_paths(self, path):
+    """
+    Gives the path in every region of a path under the primary base path, the primary first
+    """
+    if not path.startswith(self.primary):
+      raise ValueError("%s is not under the primary base path %s" % (path, self.primary))
+    return [base_path + path[len(self.primary):] for base_path in self.base_paths]
+
+  def put_item_from_string(self, path, contents, encoding=None):
+    run_parallel([lambda path=path: put_item_from_string(path, contents, encoding) for path in self.get_paths(path)])
+    return True
+
+  def put_item_from_spool(self, path, spool):
+    """
+    Streams a finished spool of a content addressed file to every region where it is not stored yet.
+    Where it is stored, it is touched instead : the version may be unreferenced and old, and its
+    refreshed last modified time keeps gc from collecting it before the version is committed.
+    """
+    def put(path):
+      if not touch_item(path):
+        put_item_from_stream(path, spool.open_reader(), spool.encoded_size, spool.encoding)
+    run_parallel([lambda path=path: put(path) for path in self.get_paths(path)])
+    return True
+
+  def put_items_from_strings(self, items, max_workers=MAX_WORKERS):
+    put_items_from_strings([(region_path, contents) for path, contents in items for region_path in self.get_paths(path)], max_workers)
+
+  def copy_item(self, src_path, dest_path):
+    """
+    Copy within every region
+    """
+    run_parallel([lambda src=src, dest=dest: copy_item(src, dest) for src, dest in zip(self.get_paths(src_path), self.get_paths(dest_path))])
+    return True
+
+  def copy_items(self, items, max_workers=MAX_WORKERS):
+    copy_items([pair for src, dest in items for pair in zip(self.get_paths(src), self.get_paths(dest))], max_workers)
+
+  def delete_item(self, path):
+    run_parallel([lambda path=path: delete_item(path) for path in self.get_paths(path)])
+
+  def delete_dir(self, path):
+    """
+    Deletes all the files under path in every region.
+    returns (number of files deleted in the primary, list of failures of all the regions)
+    """
+    results = run_parallel([lambda path=path: delete_dir(path) for path in self.get_paths(path)])
+    return results[0][0], [failure for _, failures in results for failure in failures]
+
+  def delete_key_names(self, path, relative_names):
+    """
+    Deletes the files of given names relative to path in every region.
+    returns (number of files deleted in the primary, list of failures of all the regions)
+    """
+    relative_names = list(relative_names)
+    def delete(path):
+      b_name, prefix = parse_path(path)
+      return delete_key_names(b_name, (prefix + name for name in relative_names))
+    results = run_parallel([lambda path=path: delete(path) for path in self.get_paths(path)])
+    return results[0][0], [failure for _, failures in results for failure in failures]
+
+  def put_item_if_match(self, path, contents, etag):
+    """
+    Compare-and-swap of the primary, the commit point, which is then replicated to the other regions.
+    A replica is written if it is still at the previous version (etag), it is repaired when it has drifted
+    and the primary still has these contents, and left alone when a newer commit already reached it.
+    returns False when the primary is changed by another writer
+    """
+    paths = self.get_paths(path)
+    if not put_item_if_match(paths[0], contents, etag):
+      return False
+
+    def replicate(replica_path):
+      if put_item_if_match(replica_path, contents, etag):
+        return
+      current, current_etag = get_item_with_etag(replica_path)
+      if current != contents and get_item_to_string(paths[0]) == contents:
+        put_item_if_match(replica_path, contents, current_etag)
+    run_parallel([lambda replica_path=replica_path: replicate(replica_path) for replica_path in paths[1:]])
+    return True
+
+  def get_items(self, path):
+    """
+    Gives [(region path, contents)] of the path in every region, contents are None where it does not exist
+    """
+    paths = self.get_paths(path)
+    return zip(paths, run_parallel([lambda path=path: get_item_to_string(path) for path in paths]))
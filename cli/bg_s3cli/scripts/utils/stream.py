@@ -0,0 +1,239 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Streaming (de)serialization of rules files.
+# Rules are parsed incrementally from the chunks of s3 response body, and serialized chunk by chunk
+# into a spool, so the whole file is never built as an intermediate string.
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import threading
+
+import codec
+
+# size of chunks read from s3 response body
+CHUNK_SIZE = 1024 * 1024
+
+# spooled contents beyond it are moved from memory to a temporary file
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+# number of items serialized by a single encode call
+ENCODE_BATCH_SIZE = 1000
+
+# serialized items are written to the spool in batches of this size
+WRITE_BUFFER_SIZE = 64 * 1024
+
+WHITESPACE = " \t\n\r"
+
+_decoder = json.JSONDecoder()
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+def iter_decoded(chunks):
+  """
+  Decodes gzip/zstd encoded chunks on the fly, the encoding is detected from the magic bytes
+  """
+  chunks = iter(chunks)
+  head = ""
+  for chunk in chunks:
+    head += chunk
+    if len(head) >= len(codec.ZSTD_MAGIC):
+      break
+
+  decoder = codec.get_decoder(codec.get_encoding(head))
+  for chunk in itertools.chain([head], chunks):
+    if decoder is None:
+      if chunk:
+        yield chunk
+    elif hasattr(decoder, "unconsumed_tail"):
+      # bound the decoded size of highly compressed chunks
+      while chunk:
+        data = decoder.decompress(chunk, CHUNK_SIZE)
+        chunk = decoder.unconsumed_tail
+        if data:
+          yield data
+    else:
+      data = decoder.decompress(chunk)
+      if data:
+        yield data
+  if decoder and hasattr(decoder, "flush"):
+    data = decoder.flush()
+    if data:
+      yield data
+
+def iter_array(chunks):
+  """
+  Incremental parser of a json array of objects, yields the objects as they are parsed from the chunks.
+  Only the unparsed tail of the last chunk is buffered.
+  """
+  chunks = iter(chunks)
+  buf = ""
+  pos = 0
+  # None before '[', "first" right after it, True after ',' and False after an item
+  expect_item = None
+  while True:
+    while pos < len(buf) and buf[pos] in WHITESPACE:
+      pos += 1
+    if pos == len(buf):
+      chunk = next(chunks, None)
+      if chunk is None:
+        raise ValueError("Unterminated json array")
+      buf, pos = chunk, 0
+      continue
+
+    char = buf[pos]
+    if expect_item is None:
+      if char != "[":
+        raise ValueError("Expecting json array at %d" % pos)
+      expect_item = "first"
+      pos += 1
+    elif char == "]" and expect_item is not True:
+      return
+    elif expect_item is False:
+      if char != ",":
+        raise ValueError("Expecting , delimiter at %d" % pos)
+      expect_item = True
+      pos += 1
+    else:
+      try:
+        item, pos = _decoder.raw_decode(buf, pos)
+      except ValueError:
+        # the object is split across chunks, parse it again with next chunk
+        chunk = next(chunks, None)
+        if chunk is None:
+          raise
+        buf, pos = buf[pos:] + chunk, 0
+        continue
+      expect_item = False
+      yield item
+
+def iter_encoded_array(items):
+  """
+  Serializes items as a json array chunk by chunk, the bytes are same as utils.serialize_rules
+  """
+  items = iter(items)
+  yield "["
+  separator = ""
+  while True:
+    # items are encoded in batches, a single encode call per item is much slower
+    batch = list(itertools.islice(items, ENCODE_BATCH_SIZE))
+    if not batch:
+      break
+    yield separator + _encoder.encode(batch)[1:-1]
+    separator = ","
+  yield "]"
+
+class Spool(object):
+  """
+  Spooled serialized contents, with sha256 and size of the plain contents computed in the same pass.
+  With an encoding, contents are encoded on the fly once they reach codec.MIN_BYTES.
+  """
+  def __init__(self, encoding=None):
+    self.fp = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    self.digest = hashlib.sha256()
+    self.size = 0
+    self.encoded_size = 0
+    self.encoding = encoding
+    self.encoder = None
+    self.head = []
+    self.lock = threading.Lock()
+
+  def write(self, data):
+    self.digest.update(data)
+    self.size += len(data)
+    if self.encoding and self.encoder is None:
+      self.head.append(data)
+      if self.size < codec.MIN_BYTES:
+        return
+      self.encoder = codec.get_encoder(self.encoding)
+      data = "".join(self.head)
+      self.head = None
+    self.fp.write(self.encoder.compress(data) if self.encoder else data)
+
+  def close(self):
+    """
+    Finishes the contents and rewinds the spool for reading
+    """
+    if self.encoder:
+      self.fp.write(self.encoder.flush())
+    elif self.head:
+      # too small to be encoded
+      self.fp.write("".join(self.head))
+      self.encoding = None
+    else:
+      self.encoding = None
+    self.head = None
+    self.encoded_size = self.fp.tell()
+    self.fp.seek(0)
+    return self
+
+  def get_version(self):
+    return self.digest.hexdigest()
+
+  def read(self):
+    self.fp.seek(0)
+    return self.fp.read()
+
+  def open_reader(self):
+    """
+    Gives a file like reader of the finished spool with its own position, so the spool can be
+    uploaded to several places concurrently
+    """
+    return SpoolReader(self)
+
+class SpoolReader(object):
+  """
+  Reader of a spool, the reads of all the readers are serialized on the lock of the spool
+  """
+  def __init__(self, spool):
+    self.spool = spool
+    self.pos = 0
+    self.name = getattr(spool.fp, "name", "<spool>")
+
+  def read(self, size=-1):
+    with self.spool.lock:
+      self.spool.fp.seek(self.pos)
+      data = self.spool.fp.read(size) if size is not None and size >= 0 else self.spool.fp.read()
+    self.pos += len(data)
+    return data
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self.pos
+    elif whence == os.SEEK_END:
+      offset += self.spool.encoded_size
+    self.pos = offset
+
+  def tell(self):
+    return self.pos
+
+def spool_array(items, encoding=None):
+  """
+  Serializes items as a json array into a spool
+  """
+  spool = Spool(encoding)
+  buf = []
+  buffered = 0
+  for chunk in iter_encoded_array(items):
+    buf.append(chunk)
+    buffered += len(chunk)
+    if buffered >= WRITE_BUFFER_SIZE:
+      spool.write("".join(buf))
+      buf = []
+      buffered = 0
+  spool.write("".join(buf))
+  return spool.close()
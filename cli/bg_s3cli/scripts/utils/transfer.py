@@ -0,0 +1,193 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Accounting and parallelism of the storage requests, shared by s3_util and fs_util. It has no
+# dependency on boto, so the local filesystem backend works without it.
+import atexit
+import Queue
+import threading
+
+# upper bound of parallel storage requests made by a single call
+MAX_WORKERS = 8
+
+# threads of the process wide pool running the tasks of run_parallel, calls are nested
+# (e.g. the pushes of the modules, each fanned out to all the regions) so it has room for them
+POOL_WORKERS = 4 * MAX_WORKERS
+
+# maximum keys s3 accepts in a single multi-object delete request
+DELETE_BATCH_SIZE = 1000
+
+# streamed reads are done in chunks of this size
+READ_CHUNK_SIZE = 1024 * 1024
+
+# request counters per command, and retry/hedge counters of the reads, shared by all the threads
+_stats = {}
+_read_stats = {}
+_stats_lock = threading.Lock()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def record(command, num_bytes=0):
+  """
+  Accounts one round trip of given storage command (GET, PUT, HEAD, DELETE, ...)
+  """
+  with _stats_lock:
+    entry = _stats.setdefault(command, {"requests" : 0, "bytes" : 0})
+    entry["requests"] += 1
+    entry["bytes"] += num_bytes
+
+def record_read(stat):
+  """
+  Accounts one retry, hedge, hedge win or exceeded deadline of the reads
+  """
+  with _stats_lock:
+    _read_stats[stat] = _read_stats.get(stat, 0) + 1
+
+def get_stats():
+  """
+  Returns a copy of the request counters as {command : {requests, bytes}}
+  """
+  with _stats_lock:
+    return dict((command, dict(entry)) for command, entry in _stats.items())
+
+def get_read_stats():
+  """
+  Returns a copy of the read counters as {retries, hedges, hedge_wins, deadline_exceeded}
+  """
+  with _stats_lock:
+    stats = dict.fromkeys(["retries", "hedges", "hedge_wins", "deadline_exceeded"], 0)
+    stats.update(_read_stats)
+    return stats
+
+def reset_stats():
+  """
+  Resets all the request counters
+  """
+  with _stats_lock:
+    _stats.clear()
+    _read_stats.clear()
+
+def format_stats():
+  """
+  Gives a printable summary of the request counters
+  """
+  stats = get_stats()
+  read_stats = get_read_stats()
+  lines = []
+  total_requests = 0
+  total_bytes = 0
+  for command in sorted(stats.keys()):
+    entry = stats[command]
+    total_requests += entry["requests"]
+    total_bytes += entry["bytes"]
+    lines.append("%-8s requests=%d bytes=%d" % (command, entry["requests"], entry["bytes"]))
+  lines.append("%-8s requests=%d bytes=%d" % ("TOTAL", total_requests, total_bytes))
+  lines.append("%-8s retries=%d hedges=%d hedge_wins=%d deadline_exceeded=%d" % (
+    "READS", read_stats["retries"], read_stats["hedges"], read_stats["hedge_wins"], read_stats["deadline_exceeded"]))
+  return "\n".join(lines)
+
+class WorkerPool(object):
+  """
+  Daemon threads running the tasks of run_parallel for the life of the process,
+  so they keep their connections (see get_connection) across the calls
+  """
+  def __init__(self):
+    self.queue = Queue.Queue()
+    self.workers = []
+
+  def grow(self, num_workers):
+    while len(self.workers) < num_workers:
+      worker = threading.Thread(target=self.work)
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def work(self):
+    while True:
+      run = self.queue.get()
+      if run is None:
+        return
+      run()
+
+  def submit(self, run):
+    self.queue.put(run)
+
+  def stop(self):
+    """
+    Stops the workers once they are done with the queue, before the interpreter tears down
+    the modules under the daemon threads
+    """
+    for _ in self.workers:
+      self.queue.put(None)
+    for worker in self.workers:
+      worker.join()
+
+def get_pool(num_workers):
+  """
+  Returns the process wide worker pool, created on first use, with at least num_workers threads
+  """
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      _pool = WorkerPool()
+      atexit.register(_pool.stop)
+    _pool.grow(max(num_workers, POOL_WORKERS))
+    return _pool
+
+def run_parallel(tasks, max_workers=MAX_WORKERS):
+  """
+  Runs the callables on up to max_workers threads of the worker pool and returns their results in order.
+  The caller runs the tasks too, so a call made from a task of another call never waits for a free
+  worker. It waits for all the tasks to finish, and then raises the first failure if any.
+  """
+  if not tasks:
+    return []
+
+  outcomes = [None] * len(tasks)
+  pending = iter(enumerate(tasks))
+  remaining = [len(tasks)]
+  lock = threading.Lock()
+  done = threading.Event()
+
+  def run():
+    while True:
+      with lock:
+        index, task = next(pending, (None, None))
+      if task is None:
+        return
+      try:
+        outcomes[index] = (True, task())
+      except Exception as e:
+        outcomes[index] = (False, e)
+      finally:
+        with lock:
+          remaining[0] -= 1
+          if not remaining[0]:
+            done.set()
+
+  helpers = min(max_workers, len(tasks)) - 1
+  if helpers > 0:
+    pool = get_pool(helpers)
+    for _ in range(helpers):
+      pool.submit(run)
+  run()
+  done.wait()
+
+  for ok, result in outcomes:
+    if not ok:
+      raise result
+  return [result for _, result in outcomes]
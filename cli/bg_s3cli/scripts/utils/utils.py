@@ -17,11 +17,19 @@
 # -------------------------------------------------------------------
 # imports relative to cli directory
 # -------------------------------------------------------------------
+import datetime
+import hashlib
 import json
-import jsonschema
+import threading
 import time
 
-import s3_util
+import codec
+import module_rule_utils
+import rule_index
+import storage
+import stream
+import validation
+from cache import ObjectCache
 from bg_s3cli.conf import s3
 
 ACCESS_PHASE = "access"
@@ -31,6 +39,133 @@ RATELIMITER_MODULE = "ratelimiter"
 ACCESS_MODULE = "access"
 FALLBACK_MODULE = "fallback"
 
+# version.json section of journal segments per phase and module
+JOURNAL = "journal"
+BUNDLE = "bundle"
+LATEST_BUNDLE = "latest"
+
+# version ids of nginx.conf and cluster.json, they sort in time order as strings
+VERSION_FORMAT = "%Y%m%d.%H%M%S.%f"
+_last_version = None
+_version_lock = threading.Lock()
+
+_cache = None
+
+def get_cache():
+  """
+  Gives the local object cache, None when it is not configured
+  """
+  global _cache
+  if _cache is None and s3.get_cache_dir():
+    _cache = ObjectCache(s3.get_cache_dir(), s3.get_cache_max_bytes())
+  return _cache
+
+def get_contents(s3path, immutable=False):
+  """
+  Gives the contents of s3 file, None if it does not exist.
+  With local cache, immutable files (versioned rules and cluster.json) are never re-downloaded,
+  and the others are revalidated with a conditional GET.
+  """
+  return get_contents_with_etag(s3path, immutable)[0]
+
+def get_contents_with_etag(s3path, immutable=False):
+  """
+  Gives (contents, etag) of s3 file, (None, None) if it does not exist
+  """
+  cache = get_cache()
+  if cache is None:
+    return storage.get_item_with_etag(s3path)
+
+  contents, etag = cache.lookup(s3path)
+  if contents is not None and immutable:
+    cache.record("hits")
+    return contents, etag
+
+  modified, new_contents, new_etag = storage.get_item_if_modified(s3path, etag if contents is not None else None)
+  if not modified:
+    cache.record("revalidated")
+    return contents, etag
+
+  cache.record("misses")
+  if new_contents is not None:
+    cache.store(s3path, new_contents, new_etag)
+  return new_contents, new_etag
+
+def get_decoded_contents(s3path, immutable=False):
+  """
+  Gives the contents of s3 file decoded, if it is stored with gzip/zstd encoding
+  """
+  return codec.decode(get_contents(s3path, immutable))
+
+def encode_contents(contents):
+  """
+  Encodes the contents of rules or nginx.conf with configured encoding.
+  returns (encoded contents, encoding), encoding is None for plain contents
+  """
+  encoding = s3.get_encoding()
+  if not encoding or len(contents) < codec.MIN_BYTES:
+    return contents, None
+  return codec.encode(contents, encoding), encoding
+
+def iter_rules(s3path):
+  """
+  Generates the rules of an immutable rules file, parsed incrementally while it is streamed from s3.
+  With local cache, the file is read from the cache and the streamed file is cached if it fits in it.
+  """
+  cache = get_cache()
+  if cache is None:
+    return stream.iter_array(stream.iter_decoded(storage.iter_item_chunks(s3path)))
+
+  contents, _ = cache.lookup(s3path)
+  if contents is not None:
+    cache.record("hits")
+    return stream.iter_array(stream.iter_decoded([contents]))
+  cache.record("misses")
+
+  def cached_chunks():
+    chunks = []
+    num_bytes = 0
+    for chunk in storage.iter_item_chunks(s3path):
+      num_bytes += len(chunk)
+      if chunks is not None:
+        chunks.append(chunk)
+        if num_bytes > cache.max_bytes:
+          chunks = None
+      yield chunk
+    if chunks is not None:
+      cache.store(s3path, "".join(chunks), None)
+  return stream.iter_array(stream.iter_decoded(cached_chunks()))
+
+def spool_rules(rules):
+  """
+  Serializes rules into a spool, encoded with configured encoding.
+  Its version is the sha256 of serialized rules, same as get_content_version(serialize_rules(rules))
+  """
+  return stream.spool_array(rules, s3.get_encoding())
+
+def cache_contents(s3path, contents):
+  """
+  Write through of an immutable file to local cache, once it is pushed to s3
+  """
+  cache = get_cache()
+  if cache is not None:
+    cache.store(s3path, contents, None)
+
+def cache_spool(s3path, spool):
+  """
+  Write through of a spooled immutable file to local cache, once it is pushed to s3
+  """
+  cache = get_cache()
+  if cache is not None and spool.encoded_size <= cache.max_bytes:
+    cache.store(s3path, spool.read(), None)
+
+def format_cache_stats():
+  cache = get_cache()
+  if cache is None:
+    return "cache disabled"
+  stats = cache.get_stats()
+  return "cache hits=%d revalidated=%d misses=%d evictions=%d" % (stats["hits"], stats["revalidated"], stats["misses"], stats["evictions"])
+
 def get_version_path(cluster_id):
   """
   Gives the s3 fullpath of version file of a given cluster_id
@@ -38,13 +173,27 @@ def get_version_path(cluster_id):
   base_path = s3.get_cluster_info_base_path()
   return base_path + "/" + cluster_id + "/version.json"
 
+def get_registry_path(base_path=None):
+  """
+  Gives the s3 fullpath of the registry of all the clusters, s3 base bucket + /bloomgateway/registry.json.
+  base_path is the cluster info base path (s3 base bucket + /bloomgateway/cluster), configured one by default.
+  """
+  base_path = base_path or s3.get_cluster_info_base_path()
+  return "%s/registry.json" % base_path.rsplit("/", 1)[0]
+
+def get_registry_time():
+  """
+  Gives the update time of a registry entry, in the same sortable format as version ids
+  """
+  return datetime.datetime.utcnow().strftime(VERSION_FORMAT)
+
 def get_version_info(cluster_id):
   """
   Gives the version information of a given cluster_id as JSON.
   It is a dictonary with version information for each Modules and nginx.conf
   """
   version_file_path_s3 = get_version_path(cluster_id)
-  version_file_contents = s3_util.get_item_to_string(version_file_path_s3)
+  version_file_contents = get_decoded_contents(version_file_path_s3)
   version_data_dict = json.loads(version_file_contents)
   return version_data_dict
 
@@ -60,7 +209,7 @@ def get_cluster_version_info(cluster_id):
   Gives the cluster_version information as JSON
   """
   cluster_version_file_path_s3 = get_cluster_version_path(cluster_id)
-  cluster_version_file_contents = s3_util.get_item_to_string(cluster_version_file_path_s3)
+  cluster_version_file_contents = get_decoded_contents(cluster_version_file_path_s3)
   cluster_version_data_dict = json.loads(cluster_version_file_contents)
   return cluster_version_data_dict
 
@@ -69,9 +218,7 @@ def get_cluster_info_path(cluster_id):
   Gives s3 path for cluster.json files it contains book keeping information about cluster.
   """
   base_path = s3.get_cluster_info_base_path()
-  cluster_version_path = get_cluster_version_path(cluster_id)
-  cluster_version_file_contents = s3_util.get_item_to_string(cluster_version_path)
-  cluster_version_data_dict = json.loads(cluster_version_file_contents)
+  cluster_version_data_dict = get_cluster_version_info(cluster_id)
   cluster_info_path = "%s/%s/%s/cluster.json"%(base_path, cluster_id, cluster_version_data_dict.get("cluster_version"))
   return cluster_info_path
 
@@ -80,8 +227,7 @@ def get_cluster_info(cluster_id):
   Returns a dict for cluster.json
   """
   cluster_info_file_path_s3 = get_cluster_info_path(cluster_id)
-  cluster_info_file_contents = s3_util.get_item_to_string(cluster_info_file_path_s3)
-  cluster_info = json.loads(cluster_info_file_contents)
+  cluster_info_file_contents = get_decoded_contents(cluster_info_file_path_s3, immutable=True)
   cluster_info_data_dict = json.loads(cluster_info_file_contents)
   return cluster_info_data_dict
 
@@ -92,15 +238,20 @@ def get_module_s3_path(cluster_id, phase, module, module_version):
   base_path = s3.get_cluster_info_base_path()
   return "%s/%s/modules/%s/%s/%s/%s.rules"%(base_path, cluster_id, phase, module, module_version, module)
 
+def get_module_index_s3_path(cluster_id, phase, module, module_version):
+  """
+  Gives s3 path of the precompiled index of a given module's rules for a given version, next to the rules
+  """
+  base_path = s3.get_cluster_info_base_path()
+  return "%s/%s/modules/%s/%s/%s/%s%s"%(base_path, cluster_id, phase, module, module_version, module, rule_index.SUFFIX)
+
 def get_module_info(cluster_id, module, phase):
   """
   Retruns a dict of module's rule of a current version.
   """
   version_info = get_version_info(cluster_id)
   module_version = version_info["modules"][phase][module]
-  s3_module_path = get_module_s3_path(cluster_id, phase, module, module_version)
-  contents = s3_util.get_item_to_string(s3_module_path)
-  return json.loads(contents)
+  return get_existing_rules(cluster_id, phase, module, module_version, get_journal_segments(version_info, phase, module))
 
 def push_cluster_config(cluster_id, cluster_version, cluster_info):
   """
@@ -109,25 +260,128 @@ def push_cluster_config(cluster_id, cluster_version, cluster_info):
   base_path = s3.get_cluster_info_base_path()
   #push cluster info
   s3_cluster_info_file_path_new = "%s/%s/%s/cluster.json"%(base_path, cluster_id, cluster_version)
-  s3_util.put_obj_to_json(s3_cluster_info_file_path_new, cluster_info)
+  storage.put_obj_to_json(s3_cluster_info_file_path_new, cluster_info)
 
   #push cluster version info
   s3_cluster_version_file_path_new = "%s/%s/cluster_version.json"%(base_path, cluster_id)
   cluster_version_info = {}
   cluster_version_info["cluster_version"] = cluster_version
-  s3_util.put_obj_to_json(s3_cluster_version_file_path_new, cluster_version_info)
+  storage.put_obj_to_json(s3_cluster_version_file_path_new, cluster_version_info)
 
-def get_existing_rules(cluster_id, phase, module_name, version):
+def get_journal_segments(version_data_dict, phase, module):
+  """
+  Gives the ids of the journal segments of a module on top of its snapshot version
   """
-  Returns the dict of all the rules of a given module and given version for a cluster
+  return version_data_dict.get(JOURNAL, {}).get(phase, {}).get(module, [])
+
+def get_journal_segment_s3_path(cluster_id, phase, module, module_version, segment):
+  """
+  Gives s3 path of a journal segment (delta) on top of given snapshot version of a module
+  """
+  base_path = s3.get_cluster_info_base_path()
+  return "%s/%s/modules/%s/%s/%s/journal/%s.delta"%(base_path, cluster_id, phase, module, module_version, segment)
+
+def get_bundle_s3_path(cluster_id, bundle_id):
+  """
+  Gives s3 path of the node bootstrap bundle with given id (or latest)
+  """
+  base_path = s3.get_cluster_info_base_path()
+  return "%s/%s/%s/%s.tar.gz"%(base_path, cluster_id, BUNDLE, bundle_id)
+
+def get_bundle_version(version_data_dict):
+  """
+  Gives the version data packed in the bundle of a version, without the journal segments, which pull-mode
+  nodes fetch and replay on their own. A commit which only adds segments keeps the bundle of the version.
+  """
+  bundle_version = dict(version_data_dict)
+  bundle_version.pop(JOURNAL, None)
+  bundle_version.pop(BUNDLE, None)
+  return bundle_version
+
+def get_module_member_name(phase, module):
+  """
+  Gives the name of the bundle member of the rules of a module, the name nodes stage the fetched rules as.
+  The member of its index has rule_index.SUFFIX appended.
+  """
+  return "%s_%s"%(module, phase)
+
+def get_bundle_members(cluster_id, version_data_dict):
+  """
+  Gives (member name, version, s3 path) of nginx.conf and the rules of all the modules of a version, along with
+  their precompiled indexes. Rules are the snapshot versions of the modules, the journal segments are not
+  bundled (see get_bundle_version), and they are named as the nodes stage the fetched files
+  (<module>_<phase>, <module>_<phase>.index).
+  """
+  base_path = s3.get_cluster_info_base_path()
+  members = [("nginx.conf", version_data_dict["nginx_conf"], "%s/%s/conf/%s/nginx.conf"%(base_path, cluster_id, version_data_dict["nginx_conf"]))]
+  for phase in sorted(version_data_dict["modules"]):
+    for module in sorted(version_data_dict["modules"][phase]):
+      module_version = version_data_dict["modules"][phase][module]
+      name = get_module_member_name(phase, module)
+      members.append((name, module_version, get_module_s3_path(cluster_id, phase, module, module_version)))
+      members.append((name + rule_index.SUFFIX, module_version, get_module_index_s3_path(cluster_id, phase, module, module_version)))
+  return members
+
+def is_optional_member(name):
+  """
+  Whether a bundle member may be missing, versions pushed before the rule indexes have none
+  """
+  return name.endswith(rule_index.SUFFIX)
+
+def get_existing_rules(cluster_id, phase, module_name, version, segments=None):
+  """
+  Returns the dict of all the rules of a given module and given version for a cluster.
+  The journal segments if any are replayed on top of the rules of the version.
   """
   module_rules_file_path_s3 = get_module_s3_path(cluster_id, phase, module_name, version)
-  rule_file_contents = s3_util.get_item_to_string(module_rules_file_path_s3)
-  existing_rules = json.loads(rule_file_contents)
+  existing_rules = list(iter_rules(module_rules_file_path_s3))
+  if not segments:
+    return existing_rules
+
+  segment_paths = [get_journal_segment_s3_path(cluster_id, phase, module_name, version, segment) for segment in segments]
+  deltas = storage.run_parallel([lambda path=path: get_decoded_contents(path, immutable=True) for path in segment_paths])
+  for delta in deltas:
+    existing_rules = module_rule_utils.apply_delta(module_name, existing_rules, json.loads(delta))
   return existing_rules
 
-def get_timestamped_version():
-	return time.strftime("%Y%m%d%.%H%M%S", time.gmtime(time.time()))
+def serialize_rules(rules):
+  """
+  Canonical serialized form of rules, same rules always serialize to same bytes
+  """
+  return json.dumps(rules, sort_keys=True, separators=(',', ':'))
+
+def get_content_version(contents):
+  """
+  Version of a content addressed rules file, it is the sha256 of its serialized rules
+  """
+  return hashlib.sha256(contents).hexdigest()
+
+def get_timestamped_version(previous=None):
+  """
+  Gives a monotonic version id (UTC timestamp of microsecond resolution) for nginx.conf and cluster.json.
+  It is always after the previous version id given (the current one of the cluster) and the last
+  id given by this process, so the ids stay in order even if the clocks of writers are skewed.
+  """
+  global _last_version
+  with _version_lock:
+    version_time = datetime.datetime.utcnow()
+    for version in (previous, _last_version):
+      try:
+        version_time = max(version_time, datetime.datetime.strptime(version, VERSION_FORMAT) + datetime.timedelta(microseconds=1))
+      except (TypeError, ValueError):
+        # no version or version id of older format
+        continue
+    _last_version = version_time.strftime(VERSION_FORMAT)
+    return _last_version
+
+def parse_duration(duration):
+  """
+  Gives seconds of a duration like 3600, 30m, 12h or 7d
+  """
+  units = { "s" : 1, "m" : 60, "h" : 3600, "d" : 86400 }
+  if duration[-1:] in units:
+    return int(duration[:-1]) * units[duration[-1]]
+  return int(duration)
 
 #converts a dictionary with unicode key value into byte strings key value recursively
 #source - http://stackoverflow.com/questions/956867/how-to-get-string-objects-instead-of-unicode-ones-from-json-in-python
@@ -168,12 +422,6 @@ def verify_endpoints(endpoints):
 
 def validate(json_obj, schema_def):
   """
-    Validates json object agains given json schema using jsonchema
+    Validates json object agains given json schema using jsonchema, the validator is compiled once per schema
   """
-  try:
-    jsonschema.validate(json_obj, schema_def)
-  except jsonschema.exceptions.ValidationError as e:
-    return (-2, e)
-  except Exception as e:
-    return (-1, e)
-  return (0, None)
+  return validation.validate(json_obj, schema_def)
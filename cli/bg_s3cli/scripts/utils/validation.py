@@ -0,0 +1,114 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Validation of module rules against their json schema.
+# A validator is compiled once per schema, the schema itself is checked only then, and the validator
+# keeps its resolved $refs across rules. Rules of the common shapes pass a hand written pre-check of
+# their schema module, and only the rest are validated against the schema.
+# Large inputs are spread across a process pool.
+import multiprocessing
+
+import jsonschema
+
+from .. schemas import access, fallback, ratelimiter, router
+
+# schema module of every module with rules
+SCHEMAS = {
+  "access" : access,
+  "ratelimiter" : ratelimiter,
+  "router" : router,
+  "fallback" : fallback,
+}
+
+# smaller inputs are validated in process, shipping them to a pool costs more than it saves
+PARALLEL_MIN_RULES = 50000
+CHUNKS_PER_PROCESS = 4
+
+_validators = {}
+
+def get_validator(schema):
+  """
+  Gives the compiled validator of schema, built on first use and cached for the schema object.
+  Raises jsonschema.exceptions.SchemaError for an invalid schema.
+  """
+  entry = _validators.get(id(schema))
+  if entry is None or entry[0] is not schema:
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    # the schema is kept in the entry, so its id is not reused while cached
+    entry = (schema, cls(schema))
+    _validators[id(schema)] = entry
+  return entry[1]
+
+def validate(json_obj, schema, precheck=None):
+  """
+    Validates json object against given json schema, skipped when precheck(json_obj) accepts it.
+    returns (0, None) when valid, (-2, error) for invalid json object and (-1, error) for other failures
+  """
+  try:
+    if precheck is not None and precheck(json_obj):
+      return (0, None)
+    get_validator(schema).validate(json_obj)
+  except jsonschema.exceptions.ValidationError as e:
+    return (-2, e)
+  except Exception as e:
+    return (-1, e)
+  return (0, None)
+
+def validate_rule(module, rule):
+  """
+  Validates a rule of module against the module schema, returns (retVal, error) same as validate
+  """
+  schema_module = SCHEMAS.get(module)
+  if schema_module is None:
+    return (-1, ValueError("Un-supported module %s" % module))
+  return validate(rule, schema_module.schema, getattr(schema_module, "precheck", None))
+
+def get_message(err):
+  return getattr(err, "message", None) or str(err)
+
+def validate_chunk(task):
+  """
+  Validates the rules of a chunk starting at given index, gives [(index, error message)] of invalid rules
+  """
+  module, start, rules = task
+  errors = []
+  for index, rule in enumerate(rules, start):
+    retVal, err = validate_rule(module, rule)
+    if retVal != 0:
+      errors.append((index, get_message(err)))
+  return errors
+
+def validate_many(module, rules, processes=None, min_parallel=PARALLEL_MIN_RULES):
+  """
+  Validates a list of rules of module against the module schema.
+  Inputs of min_parallel rules or more are split in chunks validated by a pool of processes,
+  one per cpu by default. returns [(index, error message)] of the invalid rules in order of index.
+  """
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  if processes <= 1 or len(rules) < min_parallel:
+    return validate_chunk((module, 0, rules))
+
+  chunk_size = -(-len(rules) // (processes * CHUNKS_PER_PROCESS))
+  tasks = [(module, start, rules[start:start + chunk_size]) for start in xrange(0, len(rules), chunk_size)]
+  pool = multiprocessing.Pool(processes)
+  try:
+    results = pool.map(validate_chunk, tasks)
+  finally:
+    pool.terminate()
+    pool.join()
+  return [error for errors in results for error in errors]
@@ -37,7 +37,7 @@ setup(name='bg_s3cli',
       url='https://github.com/bloomreach/bloomgateway',
       packages=find_packages(),
       py_modules=['bg_s3cli', 'bg_s3cli.conf', 'bg_s3cli.scripts', 'bg_s3cli.scripts.schemas', 'bg_s3cli.scripts.utils'],
-      install_requires=['boto==2.5.1', 's3cmd==1.5.2', 'jsonschema==2.5.1'],
+      install_requires=['boto==2.5.1', 'jsonschema==2.5.1'],
       entry_points = {
         'console_scripts': ['bg_s3cli=bg_s3cli.s3cli:main'],
       },
@@ -0,0 +1,62 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Fixtures of the cli tests, run against the local filesystem backend (file://), no s3 is needed.
+# usage : cd cli && python -m pytest -q tests
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg_s3cli"))
+
+from bg_s3cli.conf import s3
+from bg_s3cli.scripts.s3Persistence import S3Persistence
+
+CLUSTER_ID = "test"
+
+NGINX_CONF_TEMPLATE = "upstream $upstream_server; listen $service_port; ping $ping_port;\n"
+
+@pytest.fixture
+def base_path(tmpdir, monkeypatch):
+  """
+  cluster info base path of a fresh file:// store
+  """
+  monkeypatch.setenv("S3_BASE_BUCKET", "file://%s" % tmpdir.join("store"))
+  for name in ("S3_ENDPOINT", "BG_S3CLI_CACHE_DIR", "BG_S3CLI_ENCODING"):
+    monkeypatch.delenv(name, raising=False)
+  return s3.get_cluster_info_base_path()
+
+@pytest.fixture
+def cluster(base_path, tmpdir):
+  """
+  id of a bootstrapped cluster
+  """
+  template = tmpdir.join("nginx.conf.template")
+  template.write(NGINX_CONF_TEMPLATE)
+  retVal, response = S3Persistence(CLUSTER_ID, 8080, 8081, base_path, ["node1"]).bootstrapCluster(str(template))
+  assert retVal == 0, response
+  return CLUSTER_ID
+
+@pytest.fixture
+def persistence(base_path, cluster):
+  """
+  returns a function giving a new writer of the cluster, the way every run of the cli has its own
+  """
+  def new_persistence(**kwargs):
+    return S3Persistence(cluster, None, None, base_path, None, **kwargs)
+  return new_persistence
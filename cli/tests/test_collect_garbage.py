@@ -0,0 +1,118 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# collectGarbage never deletes the versions referenced by version.json and cluster_version.json.
+import os
+
+from bg_s3cli.scripts.s3Persistence import S3Persistence
+from bg_s3cli.scripts.utils import fs_util
+from bg_s3cli.scripts.utils import module_rule_utils
+from bg_s3cli.scripts.utils import utils
+
+def deny(value):
+  return { "type" : "param", "api" : "/api/", "key" : "id", "value" : value, "access" : "deny" }
+
+def assert_referenced_exist(cluster):
+  version_data_dict = utils.get_version_info(cluster)
+  for phase, phase_modules in version_data_dict[module_rule_utils.modules].items():
+    for module, version in phase_modules.items():
+      assert os.path.exists(fs_util.get_local_path(utils.get_module_s3_path(cluster, phase, module, version)))
+      segments = utils.get_journal_segments(version_data_dict, phase, module)
+      assert utils.get_existing_rules(cluster, phase, module, version, segments) is not None
+  assert os.path.exists(fs_util.get_local_path(utils.get_bundle_s3_path(cluster, version_data_dict[utils.BUNDLE])))
+  assert utils.get_cluster_info(cluster)
+
+def list_versions(base_path, cluster, artifact):
+  return sorted(os.listdir(os.path.join(fs_util.get_local_path(base_path), cluster, artifact)))
+
+def test_gc_keeps_referenced_versions(base_path, cluster, persistence, monkeypatch):
+  monkeypatch.setattr(S3Persistence, "gc_min_age", 0)
+  for count in range(1, 5):
+    retVal, response = persistence().applyDesiredState({ "access" : [deny(str(value)) for value in range(count)] })
+    assert retVal == 0, response
+  assert len(list_versions(base_path, cluster, "modules/access/access")) == 5
+
+  retVal, response = persistence().collectGarbage(keep=0)
+  assert retVal == 0, response
+  version = utils.get_version_info(cluster)["modules"]["access"]["access"]
+  assert list_versions(base_path, cluster, "modules/access/access") == [version]
+  assert len(list_versions(base_path, cluster, "bundle")) == 2  # the referenced bundle and latest
+  assert_referenced_exist(cluster)
+  assert [rule["value"] for rule in utils.get_module_info(cluster, "access", "access")] == ["0", "1", "2", "3"]
+
+def test_gc_keeps_newest_and_young_versions(base_path, cluster, persistence, monkeypatch):
+  for count in range(1, 4):
+    assert persistence().applyDesiredState({ "access" : [deny(str(value)) for value in range(count)] })[0] == 0
+  before = list_versions(base_path, cluster, "modules/access/access")
+
+  # all the versions are younger than gc_min_age
+  assert persistence().collectGarbage(keep=0)[0] == 0
+  assert list_versions(base_path, cluster, "modules/access/access") == before
+
+  monkeypatch.setattr(S3Persistence, "gc_min_age", 0)
+  assert persistence().collectGarbage(keep=2)[0] == 0
+  assert len(list_versions(base_path, cluster, "modules/access/access")) == 2
+  assert_referenced_exist(cluster)
+
+def test_gc_dry_run_deletes_nothing(base_path, cluster, persistence, monkeypatch):
+  monkeypatch.setattr(S3Persistence, "gc_min_age", 0)
+  assert persistence().applyDesiredState({ "access" : [deny("1")] })[0] == 0
+  before = list_versions(base_path, cluster, "modules/access/access")
+  retVal, response = persistence().collectGarbage(keep=0, dry_run=True)
+  assert retVal == 0, response
+  assert "Dry run" in response
+  assert list_versions(base_path, cluster, "modules/access/access") == before
+
+def test_gc_keeps_version_committed_while_listing(base_path, cluster, persistence, monkeypatch):
+  monkeypatch.setattr(S3Persistence, "gc_min_age", 0)
+  old_rules = [deny("1")]
+  assert persistence().applyDesiredState({ "access" : old_rules })[0] == 0
+  old_version = utils.get_version_info(cluster)["modules"]["access"]["access"]
+  assert persistence().applyDesiredState({ "access" : [deny("2")] })[0] == 0
+
+  collector = persistence()
+  original = S3Persistence.get_referenced_versions
+  calls = []
+
+  def get_referenced_versions(self):
+    referenced = original(self)
+    if self is collector and not calls:
+      # a writer brings the old rules back once gc has decided what to collect
+      assert persistence().applyDesiredState({ "access" : old_rules })[0] == 0
+    calls.append(referenced)
+    return referenced
+
+  monkeypatch.setattr(S3Persistence, "get_referenced_versions", get_referenced_versions)
+  retVal, response = collector.collectGarbage(keep=0)
+  assert retVal == 0, response
+  assert len(calls) == 2
+  assert utils.get_version_info(cluster)["modules"]["access"]["access"] == old_version
+  assert old_version in list_versions(base_path, cluster, "modules/access/access")
+  assert_referenced_exist(cluster)
+
+def test_gc_keeps_journal_of_referenced_version(base_path, cluster, persistence, monkeypatch):
+  monkeypatch.setattr(S3Persistence, "gc_min_age", 0)
+  assert persistence().applyDesiredState({ "access" : [deny("1"), deny("2")] })[0] == 0
+  for value in "345":
+    rule_data = { "rule_type" : "param", "rule_uri" : "/api/", "rule_key" : "id", "rule_value" : value, "rule_access" : "deny" }
+    assert persistence(journal_threshold=10).updateModuleRule("access", "access", "add", rule_data)[0] == 0
+  version_data_dict = utils.get_version_info(cluster)
+  assert len(utils.get_journal_segments(version_data_dict, "access", "access")) == 3
+
+  retVal, response = persistence().collectGarbage(keep=0)
+  assert retVal == 0, response
+  assert_referenced_exist(cluster)
+  assert [rule["value"] for rule in utils.get_module_info(cluster, "access", "access")] == ["1", "2", "3", "4", "5"]
@@ -0,0 +1,103 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Compare-and-swap commits of version.json by concurrent writers.
+import pytest
+
+from bg_s3cli.scripts.s3Persistence import S3Persistence
+from bg_s3cli.scripts.utils import utils
+
+def deny(value):
+  return { "rule_type" : "param", "rule_uri" : "/api/", "rule_key" : "id", "rule_value" : value, "rule_access" : "deny" }
+
+def limit(value, threshold):
+  return { "rule_type" : "param", "rule_uri" : "/api/", "rule_key" : "id", "rule_value" : value, "rule_threshold" : threshold }
+
+def get_values(cluster, module):
+  return [rule["value"] for rule in utils.get_module_info(cluster, module, "access")]
+
+def test_commit_without_conflict(cluster, persistence):
+  writer = persistence()
+  retVal, response = writer.updateModuleRule("access", "access", "add", deny("1"))
+  assert retVal == 0, response
+  assert writer.commit_retries == 0
+  assert get_values(cluster, "access") == ["1"]
+
+def test_conflict_rebases_on_concurrent_commit(cluster, persistence, monkeypatch):
+  monkeypatch.setattr(S3Persistence, "commit_backoff", 0)
+  writer = persistence()
+  other = persistence()
+  calls = []
+
+  def update(version_data_dict):
+    calls.append(dict(version_data_dict["modules"]["access"]))
+    if len(calls) == 1:
+      # another writer commits between the read of version.json and its compare-and-swap
+      retVal, response = other.updateModuleRule("access", "ratelimiter", "add", limit("2", "10"))
+      assert retVal == 0, response
+    version_data_dict["writer"] = "rebased-%d" % len(calls)
+    return True, len(calls)
+
+  assert writer.commit_version(update) == 2
+  assert writer.commit_retries == 1
+  # the rebase sees the concurrent commit, which is kept
+  assert calls[1]["ratelimiter"] != calls[0]["ratelimiter"]
+  version_data_dict = utils.get_version_info(cluster)
+  assert version_data_dict["writer"] == "rebased-2"
+  assert get_values(cluster, "ratelimiter") == ["2"]
+
+def test_concurrent_module_changes_are_both_kept(cluster, persistence, monkeypatch):
+  monkeypatch.setattr(S3Persistence, "commit_backoff", 0)
+  writer = persistence()
+  other = persistence()
+  original = S3Persistence.push_bundle
+  pushed = []
+
+  def push_bundle(self, version_data_dict):
+    if self is writer and not pushed:
+      pushed.append(True)
+      assert other.updateModuleRule("access", "access", "add", deny("2"))[0] == 0
+    return original(self, version_data_dict)
+
+  monkeypatch.setattr(S3Persistence, "push_bundle", push_bundle)
+  retVal, response = writer.updateModuleRule("access", "access", "add", deny("1"))
+  assert retVal == 0, response
+  assert writer.commit_retries == 1
+  assert get_values(cluster, "access") == ["2", "1"]
+
+def test_commit_gives_up_after_attempts(cluster, persistence, monkeypatch):
+  monkeypatch.setattr(S3Persistence, "commit_backoff", 0)
+  monkeypatch.setattr(S3Persistence, "commit_attempts", 3)
+  writer = persistence()
+  other = persistence()
+
+  def update(version_data_dict):
+    assert other.updateModuleRule("access", "access", "add", deny(str(writer.commit_retries)))[0] == 0
+    version_data_dict["writer"] = "lost"
+    return True, None
+
+  with pytest.raises(Exception) as e:
+    writer.commit_version(update)
+  assert "gave up after 3 attempts" in str(e.value)
+  version_data_dict = utils.get_version_info(cluster)
+  assert "writer" not in version_data_dict
+  assert get_values(cluster, "access") == ["0", "1", "2"]
+
+def test_no_write_leaves_version_untouched(cluster, persistence):
+  version_path = utils.get_version_path(cluster)
+  before = utils.get_contents(version_path)
+  assert persistence().commit_version(lambda version_data_dict: (False, "unchanged")) == "unchanged"
+  assert utils.get_contents(version_path) == before
@@ -0,0 +1,79 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# get_delta/apply_delta of the journal, and the RuleSet semantics they share.
+import random
+
+from bg_s3cli.scripts.utils import module_rule_utils
+
+def rule(value, access="deny", api="/api/"):
+  return { "type" : "param", "api" : api, "key" : "id", "value" : value, "access" : access }
+
+def route(value, endpoint):
+  return { "type" : "param", "api" : "/api/", "key" : "id", "value" : value, "endpoint" : endpoint }
+
+def fallback(errors, endpoint, api="/api/"):
+  return { "api" : api, "errors" : errors, "endpoint" : endpoint }
+
+def round_trip(module, existing_rules, rules):
+  delta = module_rule_utils.get_delta(module, existing_rules, rules)
+  return delta, module_rule_utils.apply_delta(module, existing_rules, delta)
+
+def test_round_trip_add_update_remove():
+  existing_rules = [rule("1"), rule("2"), rule("3")]
+  rules = [rule("1"), rule("3", access="allow"), rule("4")]
+  delta, replayed = round_trip("access", existing_rules, rules)
+  assert replayed == rules
+  assert delta == [["remove", rule("2")], ["add", rule("3", access="allow")], ["add", rule("4")]]
+
+def test_round_trip_keeps_order_of_rules():
+  existing_rules = [route("a", "h:1"), route("b", "h:2"), route("c", "h:3")]
+  rules = [route("c", "h:3"), route("a", "h:1"), route("b", "h:2")]
+  delta, replayed = round_trip("router", existing_rules, rules)
+  assert replayed == rules
+  # c is already before a and b in rules, only the rules after it are moved
+  assert delta == [["add", route("a", "h:1")], ["add", route("b", "h:2")]]
+
+def test_round_trip_unchanged_is_empty():
+  rules = [rule("1"), rule("2")]
+  assert round_trip("access", rules, list(rules)) == ([], rules)
+
+def test_round_trip_fallback_identity_ignores_error_order():
+  existing_rules = [fallback([500, 502], "h:1"), fallback([503], "h:2")]
+  rules = [fallback([503], "h:2"), fallback([502, 500], "h:3")]
+  delta, replayed = round_trip("fallback", existing_rules, rules)
+  assert replayed == rules
+  assert delta == [["add", fallback([502, 500], "h:3")]]
+
+def test_apply_delta_duplicates_match_rule_set():
+  existing_rules = [rule("1"), rule("2"), rule("1", access="allow")]
+  delta = [["add", rule("3")], ["add", rule("2", access="allow")], ["remove", rule("4")], ["add", rule("3")]]
+  rule_set = module_rule_utils.build_rule_set("access", existing_rules)
+  rule_set.upsert(rule("3"))
+  rule_set.upsert(rule("2", access="allow"))
+  rule_set.upsert(rule("3"))
+  assert module_rule_utils.apply_delta("access", existing_rules, delta) == rule_set.to_list()
+  assert module_rule_utils.apply_delta("access", existing_rules, delta) == [rule("1", access="allow"), rule("2", access="allow"), rule("3")]
+
+def test_round_trip_random():
+  generator = random.Random(7)
+  for _ in range(500):
+    pool = [rule(str(value), access=generator.choice(["allow", "deny"])) for value in range(12)]
+    existing_rules = module_rule_utils.build_rule_set("access", generator.sample(pool, generator.randint(0, 10))).to_list()
+    rules = module_rule_utils.build_rule_set("access", generator.sample(pool, generator.randint(0, 10))).to_list()
+    delta, replayed = round_trip("access", existing_rules, rules)
+    assert replayed == rules, (existing_rules, rules, delta)
+    assert len(delta) <= len(existing_rules) + len(rules)
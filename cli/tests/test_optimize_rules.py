@@ -0,0 +1,87 @@
+#
+# Copyright 2016 BloomReach, Inc.
+# Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# optimizeRules replaces the rules of the modules with their minimal equivalent, see rule_optimizer.
+from bg_s3cli.scripts.s3Persistence import S3Persistence
+from bg_s3cli.scripts.utils import rule_optimizer
+from bg_s3cli.scripts.utils import utils
+
+def deny(value, access="deny"):
+  return { "type" : "param", "api" : "/api/", "key" : "id", "value" : value, "access" : access }
+
+def limit(rule_type, value, threshold, key="x-user"):
+  return { "type" : rule_type, "api" : "/api/", "key" : key, "value" : value, "threshold" : threshold }
+
+def fallback(errors, endpoint):
+  return { "api" : "/api/", "errors" : errors, "key" : "/api/_" + "_".join(errors),
+    "endpoints" : [{ "1" : { "name" : endpoint, "params" : {}, "headers" : {} } }] }
+
+def get_rules(cluster, module, phase="access"):
+  return utils.get_module_info(cluster, module, phase)
+
+def get_version(cluster, module, phase="access"):
+  return utils.get_version_info(cluster)["modules"][phase][module]
+
+def test_optimize_removes_redundant_rules(cluster, persistence):
+  access_rules = [deny("1"), deny("2"), deny("1", access="allow")]
+  ratelimiter_rules = [limit("header", "*", "10"), limit("header", "a", "10"), limit("header", "b", "20"),
+    limit("param", "*", "10", key="id"), limit("param", "c", "10", key="id")]
+  retVal, response = persistence().applyDesiredState({ "access" : access_rules, "ratelimiter" : ratelimiter_rules })
+  assert retVal == 0, response
+  router_version = get_version(cluster, "router")
+
+  retVal, response = persistence().optimizeRules()
+  assert retVal == 0, response
+  assert "2 rule(s) removed" in response
+  assert get_rules(cluster, "access") == [deny("2"), deny("1", access="allow")]
+  # param rules are kept without collapse_params
+  assert get_rules(cluster, "ratelimiter") == [limit("header", "*", "10"), limit("header", "b", "20"),
+    limit("param", "*", "10", key="id"), limit("param", "c", "10", key="id")]
+  assert get_version(cluster, "router") == router_version
+
+  retVal, response = persistence().optimizeRules(collapse_params=True)
+  assert retVal == 0, response
+  assert limit("param", "c", "10", key="id") not in get_rules(cluster, "ratelimiter")
+
+  retVal, response = persistence().optimizeRules(collapse_params=True)
+  assert retVal == -1
+  assert "already minimal" in response
+
+def test_optimize_shadowed_fallbacks(cluster, persistence):
+  rules = [fallback(["500"], "h:1"), fallback(["502"], "h:2"), fallback(["500", "502"], "h:3")]
+  retVal, response = persistence().applyDesiredState({ "fallback" : rules })
+  assert retVal == 0, response
+  retVal, response = persistence().optimizeRules(modules=["fallback"])
+  assert retVal == 0, response
+  assert get_rules(cluster, "fallback", "error") == [fallback(["500", "502"], "h:3")]
+
+def test_optimize_dry_run_pushes_nothing(cluster, persistence):
+  assert persistence().applyDesiredState({ "access" : [deny("1"), deny("1", access="allow")] })[0] == 0
+  version_data_dict = utils.get_version_info(cluster)
+  retVal, response = persistence().optimizeRules(dry_run=True)
+  assert retVal == 0, response
+  assert "1 rule(s) of 1 module(s) would be removed" in response
+  assert utils.get_version_info(cluster) == version_data_dict
+
+def test_optimize_unknown_module(cluster, persistence):
+  assert persistence().optimizeRules(modules=["unknown"]) == (-2, "Un-supported module unknown")
+
+def test_optimized_rules_are_stable():
+  rules = [limit("header", "*", "10"), limit("header", "a", "10"), limit("header", "a", "10"), limit("header", "b", "20")]
+  kept, removed = rule_optimizer.optimize_rules("ratelimiter", rules)
+  assert kept == [limit("header", "*", "10"), limit("header", "b", "20")]
+  assert [reason for reason, _ in removed] == [rule_optimizer.DUPLICATE, rule_optimizer.WILDCARD]
+  assert rule_optimizer.optimize_rules("ratelimiter", kept) == (kept, [])
@@ -21,6 +21,7 @@ local os = os
 local shell = require "bb.thirdparty.resty.shell"
 
 local _conf = {}
+local RULE_INDEX_SUFFIX = ".index"
 local access_table = {
   access = "bb.plugins.access.",
   ratelimiter = "bb.plugins.access.",
@@ -84,6 +85,11 @@ local function get_rule_file(name, phase)
   return filename
 end
 
+-- precompiled index of the rules (see bb.core.rule_index), staged next to the rules file
+local function get_rule_index_file(name, phase)
+  return get_rule_file(name, phase) .. RULE_INDEX_SUFFIX
+end
+
 local function get_version_file()
   local filename = ngx.config.prefix() .. "/conf/config.version"
   return filename
@@ -159,6 +165,8 @@ local function update_plugin_config(name, phase)
 
   file:write(cjson.encode(data))
   file:close()
+  -- the index is of the previous rules, plugins load the pushed rules instead
+  os.remove(filename .. RULE_INDEX_SUFFIX)
 
   -- release the lock
   local ok, err = lock:unlock()
@@ -282,6 +290,8 @@ _M.get_version_file = get_version_file
 _M.get_conf = get_conf
 _M.get_nginx_conf_file = get_nginx_conf_file
 _M.get_rule_file = get_rule_file
+_M.get_rule_index_file = get_rule_index_file
+_M.RULE_INDEX_SUFFIX = RULE_INDEX_SUFFIX
 _M.is_pull_mode = is_pull_mode
 
 return _M
\ No newline at end of file
@@ -0,0 +1,94 @@
+--[[
+Copyright 2016 BloomReach, Inc.
+Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+--]]
+
+
+--[[
+Replay of the journal segments of a module, pushed by bg_s3cli in journal mode. A segment is a delta,
+a list of [method, rule] : add replaces the rule with same identity and moves it to the end, remove
+drops the rule with same identity, the same as module_rule_utils.apply_delta, so the replayed rules
+are in the order the snapshot of the same rules would have.
+--]]
+
+local cjson = require "cjson"
+local table = table
+local tostring = tostring
+local type = type
+
+local FALLBACK = "fallback"
+local SEPARATOR = "\n"
+
+local function field(value)
+  if value == nil or value == cjson.null then
+    return "nil"
+  end
+  return type(value) .. ":" .. tostring(value)
+end
+
+-- identity of a rule within a module, see module_rule_utils.rule_identity
+local function identity(name, rule)
+  if name == FALLBACK then
+    local errors = {}
+    for i, error in ipairs(rule.errors or {}) do
+      errors[i] = field(error)
+    end
+    table.sort(errors)
+    return field(rule.api) .. SEPARATOR .. table.concat(errors, ",")
+  end
+  return table.concat({field(rule.type), field(rule.key), field(rule.value), field(rule.api), field(rule.value_matches)}, SEPARATOR)
+end
+
+local _M = {}
+
+-- gives the rules of a module with the deltas (list of segments) replayed on top of them, in order
+function _M.replay(name, rules, deltas)
+  local ordered = {}
+  local positions = {}
+  for _, rule in ipairs(rules) do
+    local id = identity(name, rule)
+    if positions[id] ~= nil then
+      ordered[positions[id]] = false
+    end
+    ordered[#ordered + 1] = rule
+    positions[id] = #ordered
+  end
+
+  for _, delta in ipairs(deltas) do
+    for _, change in ipairs(delta) do
+      local method, rule = change[1], change[2]
+      local id = identity(name, rule)
+      if positions[id] ~= nil then
+        ordered[positions[id]] = false
+        positions[id] = nil
+      end
+      if method == "add" then
+        ordered[#ordered + 1] = rule
+        positions[id] = #ordered
+      end
+    end
+  end
+
+  local replayed = {}
+  for _, rule in ipairs(ordered) do
+    if rule then
+      replayed[#replayed + 1] = rule
+    end
+  end
+  return replayed
+end
+
+_M.identity = identity
+return _M
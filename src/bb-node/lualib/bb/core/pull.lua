@@ -18,18 +18,24 @@ limitations under the License.
 local cjson = require "cjson"
 local shmem = require "bb.core.shmem"
 local gk = require "bb.core.gatekeeper"
+local journal = require "bb.core.journal"
 local shell = require "bb.thirdparty.resty.shell"
 local string = string
 local log = ngx.log
 local ERR = ngx.ERR
+local WARN = ngx.WARN
 local INFO = ngx.INFO
 
 local PULL_ID = "pull_id"
 local DELAY = 5
 local NGINX = "nginx"
-local types = {CONF="nginx_conf", VERSION="version", MODULES="modules"}
+local types = {CONF="nginx_conf", VERSION="version", MODULES="modules", INDEX="index", BUNDLE="bundle", JOURNAL="journal"}
 local VERSION_FILE = "version.json"
 local NGINX_CONF_FILE = "nginx.conf"
+-- bootstrap bundle (tar.gz) of nginx.conf, rules of all the modules and version.json,
+-- its members are named as the fetched files are staged in /tmp
+local BUNDLE_FILE = "bundle.tar"
+local LATEST_BUNDLE = "latest"
 
 local _config_version = {}
 
@@ -53,7 +59,7 @@ local function set_timer(delay, func)
   end
 end
 
-local function get_version(filename)
+local function read_json(filename)
   local file, err = io.open(filename, "r")
   local data = nil
   if file ~= nil then
@@ -63,14 +69,27 @@ local function get_version(filename)
     end
     file:close()
   end
+  return data
+end
 
+local function write_file(localfile, contents)
+  local file, err = io.open(string.format("/tmp/%s", localfile), "w")
+  if file == nil then
+    error (string.format("failed to write /tmp/%s : %s", localfile, err))
+  end
+  file:write(contents)
+  file:close()
+end
+
+local function get_version(filename)
+  local data = read_json(filename)
   if data == nil then
     return nil, "Failed to get version information!"
   end
   return data
 end
 
-local function get_s3_path(type, name, phase, version)
+local function get_s3_path(type, name, phase, version, segment)
   local s3file = nil
   local cluster_id = gk.get_conf("cluster_id")
   local s3basepath = gk.get_conf("s3basepath")
@@ -79,14 +98,34 @@ local function get_s3_path(type, name, phase, version)
     s3file = string.format("%s/%s/conf/%s/%s", s3basepath, cluster_id, version, NGINX_CONF_FILE)
   elseif type == types.MODULES then
     s3file = string.format("%s/%s/modules/%s/%s/%s/%s.rules", s3basepath, cluster_id, phase, name, version, name)
+  elseif type == types.INDEX then
+    s3file = string.format("%s/%s/modules/%s/%s/%s/%s%s", s3basepath, cluster_id, phase, name, version, name, gk.RULE_INDEX_SUFFIX)
   elseif type == types.VERSION then
     s3file = string.format("%s/%s/%s", s3basepath, cluster_id, VERSION_FILE)
+  elseif type == types.BUNDLE then
+    s3file = string.format("%s/%s/bundle/%s.tar.gz", s3basepath, cluster_id, version)
+  elseif type == types.JOURNAL then
+    s3file = string.format("%s/%s/modules/%s/%s/%s/journal/%s.delta", s3basepath, cluster_id, phase, name, version, segment)
   end
 
   log(INFO, "s3file:", s3file)
   return s3file
 end
 
+-- rules and nginx.conf may be pushed gzip/zstd encoded (see bg_s3cli codec),
+-- the encoding is detected from the magic bytes and the file is decoded in place
+local function decode_file(localfile)
+  local cmd = string.format("f=/tmp/%s; case $(head -c 4 $f | od -An -tx1 | tr -d ' \\n') in " ..
+    "1f8b*) gzip -dc $f > $f.decoded && mv $f.decoded $f;; " ..
+    "28b52ffd) zstd -dcq $f > $f.decoded && mv $f.decoded $f;; esac", localfile)
+  local status, output, err = shell.execute(cmd)
+  if status ~= 0 then
+    log(ERR, err)
+    error (string.format("cmd:%s failed with error code:%d", cmd, status))
+  end
+  return
+end
+
 local function fetch_from_s3(s3file, localfile)
   local cmd = string.format("s3cmd get %s /tmp/%s -f", s3file, localfile)
   local status, output, err = shell.execute(cmd)
@@ -95,6 +134,62 @@ local function fetch_from_s3(s3file, localfile)
     error (string.format("cmd:%s failed with error code:%d", cmd, status))
   end
   log(INFO, output)
+  decode_file(localfile)
+  return
+end
+
+local function is_staged(localfile)
+  local file = io.open(string.format("/tmp/%s", localfile), "r")
+  if file == nil then
+    return false
+  end
+  file:close()
+  return true
+end
+
+local function get_staged_index(name, phase)
+  return string.format("%s_%s%s", name, phase, gk.RULE_INDEX_SUFFIX)
+end
+
+-- removes the staged rule indexes of the modules, so an index fetched earlier is never taken for a new version
+local function remove_staged_indexes(modules)
+  for phase, phase_table in pairs(modules) do
+    for name, _ in pairs(phase_table) do
+      os.remove(string.format("/tmp/%s", get_staged_index(name, phase)))
+    end
+  end
+end
+
+-- the precompiled index of the rules is optional, versions pushed before the indexes have none
+local function fetch_index(name, phase, version)
+  local s3file = get_s3_path(types.INDEX, name, phase, version)
+  local localfile = get_staged_index(name, phase)
+  local cmd = string.format("s3cmd get %s /tmp/%s -f", s3file, localfile)
+  local status, output, err = shell.execute(cmd)
+  if status ~= 0 then
+    log(INFO, "no rule index ", s3file, ", plugin builds it from the rules")
+    os.remove(string.format("/tmp/%s", localfile))
+    return
+  end
+  decode_file(localfile)
+end
+
+-- fetches a bundle and stages all of its members in /tmp with one GET,
+-- fetch_from_s3 already decodes it to a plain tar. The version.json of the bundle has no journal
+-- segments, it is staged only when with_version, otherwise the fetched version.json is kept.
+local function fetch_bundle(bundle_id, with_version)
+  local s3file = get_s3_path(types.BUNDLE, nil, nil, bundle_id)
+  fetch_from_s3(s3file, BUNDLE_FILE)
+  local exclude = ""
+  if not with_version then
+    exclude = string.format(" --exclude=%s", VERSION_FILE)
+  end
+  local cmd = string.format("tar -xf /tmp/%s%s -C /tmp", BUNDLE_FILE, exclude)
+  local status, output, err = shell.execute(cmd)
+  if status ~= 0 then
+    log(ERR, err)
+    error (string.format("cmd:%s failed with error code:%d", cmd, status))
+  end
   return
 end
 
@@ -109,6 +204,102 @@ local function copy_config(src, dest)
   return
 end
 
+-- journal segments (deltas) of a module on top of its snapshot version, see bg_s3cli journal mode
+local function get_journal_segments(data, name, phase)
+  local journal = data[types.JOURNAL]
+  if journal == nil or journal[phase] == nil or journal[phase][name] == nil then
+    return nil
+  end
+  local segments = journal[phase][name]
+  if #segments == 0 then
+    return nil
+  end
+  return segments
+end
+
+-- version of the rules of a module, a journaled module is at its snapshot version with the segments on top of it
+local function get_rules_version(data, name, phase)
+  local version = data.modules[phase][name]
+  local segments = get_journal_segments(data, name, phase)
+  if version == nil or segments == nil then
+    return version
+  end
+  return version .. "+" .. table.concat(segments, "+")
+end
+
+-- number of the journal segments of a module the node applied, when it is at the same snapshot version
+-- and they are the first segments of the journal, nil otherwise
+local function get_applied_segments(name, phase, version, segments)
+  local modules = get_modules_version()
+  if modules == nil or modules[phase] == nil or modules[phase][name] ~= version then
+    return nil
+  end
+  local applied = get_journal_segments(_config_version, name, phase) or {}
+  if #applied > #segments then
+    return nil
+  end
+  for i, segment in ipairs(applied) do
+    if segments[i] ~= segment then
+      return nil
+    end
+  end
+  return #applied
+end
+
+-- stages the rules of a journaled module, its snapshot version with the journal segments replayed.
+-- When the node already applied the first segments of the journal, only the new ones are fetched and
+-- replayed on the rules it has. snapshot_staged is true when the bundle staged the snapshot rules.
+local function stage_journaled(name, phase, data, snapshot_staged)
+  local version = data.modules[phase][name]
+  local segments = get_journal_segments(data, name, phase)
+  local localfile = string.format("%s_%s", name, phase)
+  local rules = nil
+  local applied = get_applied_segments(name, phase, version, segments)
+  if applied ~= nil then
+    rules = read_json(gk.get_rule_file(name, phase))
+  end
+  if rules == nil then
+    applied = 0
+    if not snapshot_staged then
+      fetch_from_s3(get_s3_path(types.MODULES, name, phase, version), localfile)
+    end
+    rules = read_json(string.format("/tmp/%s", localfile))
+    if rules == nil then
+      error (string.format("failed to read the rules of %s_%s at %s", name, phase, version))
+    end
+  end
+
+  local deltas = {}
+  local deltafile = string.format("%s.delta", localfile)
+  for i = applied + 1, #segments do
+    fetch_from_s3(get_s3_path(types.JOURNAL, name, phase, version, segments[i]), deltafile)
+    local delta = read_json(string.format("/tmp/%s", deltafile))
+    if delta == nil then
+      error (string.format("failed to read the journal segment %s of %s", segments[i], localfile))
+    end
+    deltas[#deltas + 1] = delta
+  end
+  os.remove(string.format("/tmp/%s", deltafile))
+  log(INFO, "replayed ", #deltas, " journal segment(s) of ", localfile)
+  write_file(localfile, cjson.encode(journal.replay(name, rules, deltas)))
+  -- the index is of the snapshot rules, the plugin builds its tables from the replayed rules
+  os.remove(string.format("/tmp/%s", get_staged_index(name, phase)))
+end
+
+-- stages the replayed rules of the changed journaled modules, after the bundle staged their snapshots
+local function stage_journals(changed, data)
+  if changed.modules == nil then
+    return
+  end
+  for phase, phase_table in pairs(changed.modules) do
+    for name, version in pairs(phase_table) do
+      if get_journal_segments(data, name, phase) ~= nil then
+        stage_journaled(name, phase, data, true)
+      end
+    end
+  end
+end
+
 local function is_changed(type, name, phase, data)
   local cur_ver = nil
   local new_ver = nil
@@ -117,8 +308,8 @@ local function is_changed(type, name, phase, data)
     cur_ver = _config_version[types.CONF]
     new_ver = data[types.CONF]
   elseif type == types.MODULES then
-    cur_ver = _config_version.modules[phase][name]
-    new_ver = data.modules[phase][name]
+    cur_ver = get_rules_version(_config_version, name, phase)
+    new_ver = get_rules_version(data, name, phase)
   end
 
   if new_ver ~= nil and cur_ver ~= nil and cur_ver ~= new_ver then
@@ -152,7 +343,35 @@ local function get_changed(modules, data)
   return changed
 end
 
-local function fetch_changed(changed)
+local function count_changed(changed)
+  local count = 0
+  if changed[types.CONF] ~= nil then count = count + 1 end
+  if changed.modules ~= nil then
+    for phase, phase_table in pairs(changed.modules) do
+      for name, version in pairs(phase_table) do
+        count = count + 1
+      end
+    end
+  end
+  return count
+end
+
+-- everything registered, for warming up a node which has no config yet
+local function get_all(modules, data)
+  local all = {}
+  all[types.CONF] = data[types.CONF]
+  all[types.MODULES] = {}
+  for phase, phase_table in pairs(modules) do
+    local versions = data.modules[phase] or {}
+    all.modules[phase] = {}
+    for name, path in pairs(phase_table) do
+      all.modules[phase][name] = versions[name]
+    end
+  end
+  return all
+end
+
+local function fetch_changed(changed, data)
   -- fetch nginx
   if changed[types.CONF] ~= nil then
     local s3file = get_s3_path(types.CONF, NGINX, nil, changed[types.CONF])
@@ -162,9 +381,14 @@ local function fetch_changed(changed)
   if changed.modules ~= nil then
     for phase, phase_table in pairs(changed.modules) do
       for name, version in pairs(phase_table) do
-        local s3file = get_s3_path(types.MODULES, name, phase, version)
-        local localfile = string.format("%s_%s", name, phase)
-        fetch_from_s3(s3file, localfile)
+        if get_journal_segments(data, name, phase) ~= nil then
+          stage_journaled(name, phase, data, false)
+        else
+          local s3file = get_s3_path(types.MODULES, name, phase, version)
+          local localfile = string.format("%s_%s", name, phase)
+          fetch_from_s3(s3file, localfile)
+          fetch_index(name, phase, version)
+        end
       end
     end
   end
@@ -182,6 +406,12 @@ local function update_changed(changed)
       for name, version in pairs(phase_table) do
         local localfile = string.format("%s_%s", name, phase)
         copy_config(localfile, gk.get_rule_file(name, phase))
+        -- an index is of the rules of its version, the previous one is removed when there is none
+        if is_staged(get_staged_index(name, phase)) then
+          copy_config(get_staged_index(name, phase), gk.get_rule_index_file(name, phase))
+        else
+          os.remove(gk.get_rule_index_file(name, phase))
+        end
       end
     end
   end
@@ -205,7 +435,42 @@ local function reload_changed()
   return
 end
 
+-- fetches version.json and the files of its version one by one, for a cluster without latest bundle
+-- (created before the bundles, or whose latest bundle failed to publish)
+local function fetch_version_files()
+  fetch_from_s3(get_s3_path(types.VERSION), VERSION_FILE)
+  local data, err = get_version(string.format("/tmp/%s", VERSION_FILE))
+  if not data then
+    error(err)
+  end
+  fetch_changed(get_all(gk.get_modules(), data), data)
+  return data
+end
+
+local function warm_up()
+  -- a new node fetches the latest bundle with one GET, it has version.json too, without the journal
+  -- segments, which the next check fetches and replays
+  remove_staged_indexes(gk.get_modules())
+  local data = nil
+  local ok, err = pcall(fetch_bundle, LATEST_BUNDLE, true)
+  if ok then
+    data, err = get_version(string.format("/tmp/%s", VERSION_FILE))
+  end
+  if not data then
+    log(WARN, "No latest bundle (", err, "), warming up from version.json and the files of its version")
+    remove_staged_indexes(gk.get_modules())
+    data = fetch_version_files()
+  end
+  update_changed(get_all(gk.get_modules(), data))
+  reload_changed()
+end
+
 local function check(pid)
+  if get_modules_version() == nil then
+    log(INFO, "No config version, warming up from the latest bundle!!")
+    return warm_up()
+  end
+
   -- fetch version file (s3cmd get s3path/version.json /tmp/version.json)
   local s3file = get_s3_path(types.VERSION)
   fetch_from_s3(s3file, VERSION_FILE)
@@ -215,7 +480,17 @@ local function check(pid)
   local data = get_version(version_file)
   local changed = get_changed(gk.get_modules(), data)
   if changed ~= nil then
-    fetch_changed(changed)
+    if changed.modules ~= nil then
+      remove_staged_indexes(changed.modules)
+    end
+    -- many changed files are fetched with the single GET of the bundle of the version,
+    -- the journal segments of journaled modules are fetched and replayed on top of it
+    if data[types.BUNDLE] ~= nil and count_changed(changed) > 1 then
+      fetch_bundle(data[types.BUNDLE], false)
+      stage_journals(changed, data)
+    else
+      fetch_changed(changed, data)
+    end
     update_changed(changed)
     reload_changed()
   end
@@ -276,7 +551,10 @@ local function init()
 
   local data, err = load_config_version()
   if not data then
+    -- a new node, the pull job warms it up from the latest bundle
     log(ERR, "Failure:", err)
+    set_config_version({})
+    set_timer(0, handler)
     return
   end
 
@@ -0,0 +1,94 @@
+--[[
+Copyright 2016 BloomReach, Inc.
+Copyright 2016 Ronak Kothari <ronak.kothari@gmail.com>.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+--]]
+
+
+--[[
+Precompiled index of the rules of a module, pushed by bg_s3cli (rule_index.py) next to the rules
+of every version. It holds the lookup tables of the plugin exactly as the plugin init builds them
+from the rules, so a plugin loads them with a single decode instead of rebuilding them on every
+worker at every reload. An index is used only when it is of the rules version the node is at
+(config.version), otherwise the plugin builds its tables from the rules as before.
+--]]
+
+local cjson = require "cjson"
+local gk = require "bb.core.gatekeeper"
+local io = io
+local log = ngx.log
+local ERR = ngx.ERR
+local INFO = ngx.INFO
+
+local FORMAT = 1
+
+local function read_json(filename)
+  local file, err = io.open(filename, "r")
+  if file == nil then
+    return nil
+  end
+  local contents = file:read("*a")
+  file:close()
+  if contents == nil or contents == '' then
+    return nil
+  end
+
+  local ok, data = pcall(cjson.decode, contents)
+  if not ok then
+    log(ERR, "failed to decode ", filename, " : ", data)
+    return nil
+  end
+  return data
+end
+
+local function get_rules_version(name, phase)
+  local data = read_json(gk.get_version_file())
+  if type(data) ~= "table" or type(data.modules) ~= "table" or type(data.modules[phase]) ~= "table" then
+    return nil
+  end
+  -- the rules of a journaled module have the journal on top of the snapshot the index is of
+  local journal = data.journal
+  if type(journal) == "table" and type(journal[phase]) == "table" and type(journal[phase][name]) == "table"
+      and #journal[phase][name] > 0 then
+    return nil
+  end
+  return data.modules[phase][name]
+end
+
+local _M = {}
+
+-- gives the lookup tables of the index of a module's rules file, nil when there is no usable index
+function _M.load(rule_file, name)
+  local filename = rule_file .. gk.RULE_INDEX_SUFFIX
+  local index = read_json(filename)
+  if type(index) ~= "table" then
+    return nil
+  end
+
+  if index.format ~= FORMAT or index.module ~= name or type(index.tables) ~= "table" then
+    log(INFO, "rule index ", filename, " is not of format ", FORMAT, " for ", name, ", skipped")
+    return nil
+  end
+
+  local version = get_rules_version(name, index.phase)
+  if version == nil or version ~= index.version then
+    log(INFO, "rule index ", filename, " is not of the current rules version, skipped")
+    return nil
+  end
+
+  log(INFO, "loaded rule index ", filename)
+  return index.tables
+end
+
+return _M
@@ -17,6 +17,7 @@ limitations under the License.
 
 local cjson = cjson
 local bb = require "bb.core.gatekeeper"
+local rule_index = require "bb.core.rule_index"
 
 -- module level rules table : it holds the rules after reading from access.rule file
 local _rules = {}
@@ -65,7 +66,12 @@ end
 local _M = {}
 
 function _M.init(rule_file)
-  _rules = load_rules(rule_file)
+  local index = rule_index.load(rule_file, "access")
+  if index ~= nil then
+    _rules = index.rules
+  else
+    _rules = load_rules(rule_file)
+  end
   --[[
   -- testing code
   -- print all param rules
@@ -19,6 +19,7 @@ local io = require 'io'
 local os = require 'os'
 local shmem = require "bb.core.shmem"
 local bb = require "bb.core.gatekeeper"
+local rule_index = require "bb.core.rule_index"
 
 local _rate_limit_node = {}
 local _rate_limit_api = {}
@@ -182,8 +183,25 @@ end
 -- exponse module functionality
 local _M = {}
 
+-- tables of the precompiled index, in the shapes process_rule builds
+local function load_index(index)
+  _rate_limit_node = index.node
+  _rate_limit_api = index.api
+  _rate_limit_param = index.param
+  _rate_limit_params_key_values = index.params_key_values
+  _rate_limit_header = index.header
+  _rate_limit_headers_key_values = index.headers_key_values
+end
+
 function _M.init(rule_file)
   ngx.log(ngx.INFO, "rate limiter init begin")
+  local index = rule_index.load(rule_file, "ratelimiter")
+  if index ~= nil then
+    load_index(index)
+    ngx.log(ngx.INFO, "rate limiter init complete")
+    return
+  end
+
   local io = io
   local rule_file = rule_file
   local file, err = io.open(rule_file, "r")
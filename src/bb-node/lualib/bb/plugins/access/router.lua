@@ -15,6 +15,8 @@ See the License for the specific language governing permissions and
 limitations under the License.
 --]]
 
+local rule_index = require "bb.core.rule_index"
+
 local _router_params_key_values = {}
 local _router_headers_key_values = {}
 
@@ -108,6 +110,14 @@ local _M = {}
 
 function _M.init(rule_file)
   ngx.log(ngx.INFO, "router init begin")
+  local index = rule_index.load(rule_file, "router")
+  if index ~= nil then
+    _router_params_key_values = index.param
+    _router_headers_key_values = index.header
+    ngx.log(ngx.INFO, "router init complete")
+    return
+  end
+
   local file, err = io.open(rule_file, "r")
   if file ~= nil then
     ngx.log(ngx.INFO, "reading routing rules")
@@ -20,6 +20,8 @@ This component is part of an error phase/state. Whenever main requests failed wi
 it executes this module and tries for configured fallback
 --]]
 
+local rule_index = require "bb.core.rule_index"
+
 local _M = {}
 
 local _fallback_endpoints = {}
@@ -97,6 +99,13 @@ end
 
 function _M.init(rule_file)
   ngx.log(ngx.INFO, "fallback init begin")
+  local index = rule_index.load(rule_file, "fallback")
+  if index ~= nil then
+    _fallback_endpoints = index.endpoints
+    ngx.log(ngx.INFO, "fallback init executed")
+    return
+  end
+
 
   local filename = rule_file
   local file, err = io.open(filename, "r")